@@ -95,6 +95,7 @@ class Handler(BaseHandler):
                 seek_query_form_custom_htmls={'en': '', 'fr': ''},
                 footer_custom_htmls={'en': '', 'fr': ''},
                 bad_words='',
+                notification_digest_minutes=0,
                 published_date=get_utcnow_timestamp(),
                 updated_date=get_utcnow_timestamp(),
                 test_mode=False,
@@ -119,7 +120,7 @@ class Handler(BaseHandler):
                 'deactivated', 'start_page_custom_htmls',
                 'results_page_custom_htmls', 'view_page_custom_htmls',
                 'seek_query_form_custom_htmls', 'footer_custom_htmls',
-                'test_mode', 'force_https',
+                'test_mode', 'force_https', 'notification_digest_minutes',
             ]:
                 try:
                     values[name] = simplejson.loads(self.request.get(name))
@@ -18,7 +18,7 @@ import urllib
 from google.appengine.ext import db
 from google.appengine.api import users
 
-from model import Authorization, ApiKeyManagementLog
+from model import Authorization, ApiKeyManagementLog, authorization_cache
 import utils
 
 from django.utils.html import escape
@@ -163,6 +163,9 @@ class CreateOrUpdateApiKey(utils.BaseHandler):
             self.repo, key_str,
             **to_authorization_params(self.params))
         authorization.put()
+        # Make the change take effect on all instances, for keys of this repo
+        # and global keys alike.
+        authorization_cache.invalidate()
 
         management_log = ApiKeyManagementLog(repo=self.repo,
                                              api_key=authorization.api_key,
@@ -78,33 +78,12 @@ class Handler(utils.BaseHandler):
         elif status != 'all':
             query.filter('status =', status)
         if source != 'all':
-            query.filter('person_record_id >=', '%s/' % source)
-            query.filter('person_record_id <', '%s0' % source)
-            # TODO(ryok): we really want to order by entry_date, but GAE
-            # restriction applies here, and we can not use two different
-            # properties for comparison and ordering. The proper solution seems
-            # to add a property source_domain to Note.
-            query.order('-person_record_id')
-        else:
-            query.order('-entry_date')
+            query.filter('source_domain =', source)
+        query.order('-entry_date')
 
         skip = self.params.skip or 0
         notes = query.fetch(NOTES_PER_PAGE + 1, skip)
-        for note in notes[:NOTES_PER_PAGE]:
-            person = model.Person.get(self.repo, note.person_record_id)
-            if person:
-                # Copy in the fields of the associated Person.
-                for name in person.properties():
-                    setattr(note, 'person_' + name, getattr(person, name))
-
-                # Get the statuses of the other notes on this Person.
-                status_codes = ''
-                for other_note in person.get_notes():
-                    code = STATUS_CODES[other_note.status]
-                    if other_note.note_record_id == note.note_record_id:
-                        code = code.upper()
-                    status_codes += code
-                note.person_status_codes = status_codes
+        self.add_person_fields(notes[:NOTES_PER_PAGE])
 
         if len(notes) > NOTES_PER_PAGE:
             notes = notes[:NOTES_PER_PAGE]
@@ -124,21 +103,63 @@ class Handler(utils.BaseHandler):
             first=skip + 1,
             last=skip + len(notes[:NOTES_PER_PAGE]))
 
+    def add_person_fields(self, notes):
+        """Copies the fields of the associated Person into each Note, along
+        with the statuses of all the Notes on that Person."""
+        person_record_ids = set(note.person_record_id for note in notes)
+        persons = dict(
+            (person.record_id, person)
+            for person in model.Person.get_all(self.repo, person_record_ids)
+            if not person.is_expired)
+        # Start all the queries for the other notes before reading any of
+        # them, so that they run in parallel instead of one after another.
+        other_notes_queries = dict(
+            (person_record_id, model.Note.all_in_repo(self.repo
+                ).filter('person_record_id =', person_record_id
+                ).order('source_date'
+                ).run(batch_size=model.Note.FETCH_LIMIT))
+            for person_record_id in persons)
+        other_notes = dict(
+            (person_record_id, list(query))
+            for person_record_id, query in other_notes_queries.items())
+
+        for note in notes:
+            person = persons.get(note.person_record_id)
+            if person:
+                for name in person.properties():
+                    setattr(note, 'person_' + name, getattr(person, name))
+                status_codes = ''
+                for other_note in other_notes[person.record_id]:
+                    code = STATUS_CODES[other_note.status]
+                    if other_note.note_record_id == note.note_record_id:
+                        code = code.upper()
+                    status_codes += code
+                note.person_status_codes = status_codes
+
     def post(self):
         if not self.is_current_user_authorized():
             return self.redirect(users.create_login_url('/admin/review'))
 
         notes = []
+        old_queues = []
         for name, value in self.request.params.items():
             if name.startswith('note.'):
                 note = model.Note.get(self.repo, name[5:])
                 if note:
+                    old_queues.append(model.ReviewQueueCount.get_queue(note))
                     if value in ['accept', 'flag']:
                         note.reviewed = True
                     if value == 'flag':
                         note.hidden = True
                     notes.append(note)
         db.put(notes)
+        model.ReviewQueueCount.update(
+            self.repo, old_queues,
+            [model.ReviewQueueCount.get_queue(note) for note in notes])
+        # Hiding notes can change the status of the Persons they belong to.
+        for person_record_id in set(note.person_record_id for note in notes
+                                    if note.hidden):
+            self.add_update_status_task(person_record_id)
         self.redirect('/admin/review',
                       status=self.params.status,
                       source=self.params.source,
@@ -17,17 +17,21 @@
 
 __author__ = 'kpy@google.com (Ka-Ping Yee)'
 
+import base64
 import calendar
 import csv
+import datetime
+import itertools
 import logging
 import re
 import StringIO
-import xml.dom.minidom
+import time
 
 import django.utils.html
 from google.appengine import runtime
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
 
-import external_search
 import importer
 import indexing
 import model
@@ -42,6 +46,17 @@ from utils import Struct
 
 HARD_MAX_RESULTS = 200  # Clients can ask for more, but won't get more.
 
+# Uploads larger than this are imported in the background by ImportWorker.
+MAX_INLINE_IMPORT_BYTES = 200*1000
+
+# The most skipped records to keep for the status report of an import job.
+MAX_REPORTED_SKIPPED = 1000
+
+# api/changes leaves out the most recent changes, in case entities written
+# at the same time with earlier last_modified times are not visible yet.
+CHANGES_SAFETY_LAG = datetime.timedelta(seconds=30)
+EPOCH = datetime.datetime(1970, 1, 1)
+
 
 class InputFileError(Exception):
     pass
@@ -96,6 +111,17 @@ def generate_note_record_ids(records):
         yield record
 
 
+def fill_in_record_ids(records, field, prefix, start=0):
+    """Gives each record that has no value for the given field an ID that is
+    determined by its position in the file, so that importing the same rows
+    again overwrites the same records instead of creating new ones.  'start'
+    is the position of the first of the given records."""
+    for index, record in enumerate(records):
+        if not record.get(field, '').strip():
+            record[field] = '%s.%d' % (prefix, start + index)
+        yield record
+
+
 def convert_time(text, offset):
     """Converts a textual date and time into an RFC 3339 UTC timestamp."""
     if utils.DATETIME_RE.match(text.strip()):  # don't apply offset
@@ -170,6 +196,9 @@ class Import(utils.BaseHandler):
             self.error(400, message='Please specify at least one CSV file.')
             return
 
+        if len(content) > MAX_INLINE_IMPORT_BYTES:
+            return self.start_import_job(content)
+
         try:
             lines = content.splitlines()  # handles \r, \n, or \r\n
             if self.request.get('format') == 'notes':
@@ -184,6 +213,26 @@ class Import(utils.BaseHandler):
                 'smaller files (keeping the header rows in each file) and '
                 'uploading each part separately.')
 
+    def start_import_job(self, content):
+        """Stores a large upload and queues a task to import it."""
+        if isinstance(content, unicode):
+            content = content.encode('utf-8')
+        job = model.ImportJob.create(
+            self.repo, content,
+            format=self.request.get('format') == 'notes' and 'notes' or
+                'persons',
+            domain=self.auth.domain_write_permission,
+            believed_dead_permission=bool(self.auth.believed_dead_permission))
+        add_import_task(job)
+        utils.log_api_action(self, ApiActionLog.WRITE)
+        self.render('import.html',
+                    formats=get_requested_formats(self.env.path),
+                    params=self.params,
+                    job=job,
+                    status_url=self.get_url('/api/import/status',
+                                            id=job.job_id, key=self.params.key),
+                    **get_tag_params(self))
+
     def import_notes(self, lines):
         source_domain = self.auth.domain_write_permission
         records = importer.utf8_decoder(generate_note_record_ids(
@@ -195,10 +244,11 @@ class Import(utils.BaseHandler):
                 'The CSV file is formatted incorrectly. (%s)' % e)
             return
 
-        notes_written, notes_skipped, notes_total = importer.import_records(
-            self.repo, source_domain, importer.create_note, records,
-            believed_dead_permission=self.auth.believed_dead_permission,
-            omit_duplicate_notes=True)
+        notes_written, notes_skipped, notes_total, notes_unchanged = \
+            importer.import_records(
+                self.repo, source_domain, importer.create_note, records,
+                believed_dead_permission=self.auth.believed_dead_permission,
+                omit_duplicate_notes=True)
 
         utils.log_api_action(self, ApiActionLog.WRITE,
                              0, notes_written, 0, len(notes_skipped))
@@ -210,7 +260,8 @@ class Import(utils.BaseHandler):
                         Struct(type='Note',
                                written=notes_written,
                                skipped=notes_skipped,
-                               total=notes_total)],
+                               total=notes_total,
+                               unchanged=notes_unchanged)],
                     **get_tag_params(self))
 
     def import_persons(self, lines):
@@ -229,11 +280,13 @@ class Import(utils.BaseHandler):
         persons = [r for r in records if is_not_empty(r.get('full_name'))]
         notes = [r for r in records if is_not_empty(r.get('note_record_id'))]
 
-        people_written, people_skipped, people_total = importer.import_records(
-            self.repo, source_domain, importer.create_person, persons)
-        notes_written, notes_skipped, notes_total = importer.import_records(
-            self.repo, source_domain, importer.create_note, notes,
-            believed_dead_permission=self.auth.believed_dead_permission)
+        people_written, people_skipped, people_total, people_unchanged = \
+            importer.import_records(
+                self.repo, source_domain, importer.create_person, persons)
+        notes_written, notes_skipped, notes_total, notes_unchanged = \
+            importer.import_records(
+                self.repo, source_domain, importer.create_note, notes,
+                believed_dead_permission=self.auth.believed_dead_permission)
 
         utils.log_api_action(self, ApiActionLog.WRITE,
                              people_written, notes_written,
@@ -246,14 +299,219 @@ class Import(utils.BaseHandler):
                         Struct(type='Person',
                                written=people_written,
                                skipped=people_skipped,
-                               total=people_total),
+                               total=people_total,
+                               unchanged=people_unchanged),
                         Struct(type='Note',
                                written=notes_written,
                                skipped=notes_skipped,
-                               total=notes_total)],
+                               total=notes_total,
+                               unchanged=notes_unchanged)],
                     **get_tag_params(self))
 
 
+def add_import_task(job):
+    """Queues a task to continue an ImportJob from its current row offset.
+    The task is named after the offset, so the same rows are never queued
+    twice.  Only call this after recording progress, as a task with the
+    current offset may already have run."""
+    try:
+        taskqueue.add(
+            name='import-%s-%s-%d' % (job.repo, job.job_id, job.row_offset),
+            method='GET',
+            url='/%s/%s' % (job.repo, ImportWorker.ACTION),
+            params={'id': job.job_id})
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+class CsvRows:
+    """Iterates over the CSV rows in a piece of an uploaded file, keeping
+    track of the byte position in the file just past the last row read, so
+    that an import can later resume from there."""
+
+    def __init__(self, content, start=0):
+        self.content = content
+        self.position = start  # byte position of 'content' in the file
+        self.header_end = None  # byte position just past the header row
+
+    def get_lines(self):
+        for line in self.content.splitlines(True):
+            self.position += len(line)
+            yield line
+
+    def __iter__(self):
+        # csv.reader reads only as many lines as it needs for each row.
+        for row in csv.reader(self.get_lines()):
+            if self.header_end is None and 'person_record_id' in row:
+                self.header_end = self.position
+            yield row
+
+
+def parse_import_rows(job, rows, start=0):
+    """Generates the records for an ImportJob from an iterable of CSV rows
+    that starts with the preamble and header rows.  'start' is the position
+    of the first record among all the records in the file."""
+    records = convert_time_fields(rows)
+    prefix = 'import.%s' % job.job_id
+    if job.format == 'notes':
+        records = fill_in_record_ids(records, 'note_record_id', prefix, start)
+    else:
+        records = fill_in_record_ids(
+            records, 'person_record_id', prefix, start)
+    return importer.utf8_decoder(
+        complete_record_ids(r, job.domain) for r in records)
+
+
+def record_import_progress(key, row_offset, row_count, byte_offset, stats,
+                           skipped):
+    """Adds the results for a batch of rows to an ImportJob, in a transaction.
+    Returns the updated job, or None if another task has already recorded
+    the results for these rows."""
+    job = db.get(key)
+    if job.row_offset != row_offset:
+        return None
+    job.row_offset += row_count
+    job.byte_offset = byte_offset
+    for name, value in stats.items():
+        setattr(job, name, getattr(job, name) + value)
+    job.skipped_count += len(skipped)
+    reported = simplejson.loads(job.skipped_json)
+    reported += skipped[:MAX_REPORTED_SKIPPED - len(reported)]
+    job.skipped_json = simplejson.dumps(reported)
+    job.status = 'running'
+    job.put()
+    return job
+
+
+class ImportWorker(utils.BaseHandler):
+    """Imports the rows of an ImportJob in batches, recording its progress
+    after each batch.  If the task is interrupted, the next task resumes from
+    the last recorded batch; rows in that batch are written again with the
+    same record IDs, so no duplicates are created."""
+    ACTION = 'tasks/import'
+
+    ROWS_PER_BATCH = importer.MAX_PUT_BATCH
+    # Continue in a new task after this long, well within the task deadline.
+    SECONDS_PER_TASK = 60
+
+    def get(self):
+        job = model.ImportJob.get(self.repo, self.params.id)
+        if not job or job.status in ['done', 'failed']:
+            return
+        if job.row_count is None:
+            # Check and count the rows of the whole file once, and remember
+            # where the header ends, so that later tasks only have to parse
+            # the header and the rows that are left.
+            rows = CsvRows(job.get_content())
+            try:
+                job.row_count = len(list(parse_import_rows(job, rows)))
+            except (InputFileError, csv.Error, UnicodeDecodeError), e:
+                job.status = 'failed'
+                job.error = 'Problem in the uploaded file: %s' % e
+                job.put()
+                job.delete_content()
+                return
+            job.header_end = job.byte_offset = rows.header_end or 0
+            job.put()
+
+        header_rows = CsvRows(job.get_content(0, job.header_end))
+        rows = CsvRows(job.get_content(job.byte_offset), job.byte_offset)
+        records = parse_import_rows(
+            job, itertools.chain(header_rows, rows), job.row_offset)
+
+        start_time = time.time()
+        progressed = False
+        try:
+            while job.row_offset < job.row_count:
+                # Always finish at least one batch, so that the next task has
+                # a new offset and a new name.
+                if progressed and (
+                    time.time() - start_time > self.SECONDS_PER_TASK):
+                    return add_import_task(job)
+                batch = list(itertools.islice(records, self.ROWS_PER_BATCH))
+                if not batch:
+                    break
+                stats, skipped = self.import_batch(job, batch)
+                job = db.run_in_transaction(
+                    record_import_progress, job.key(), job.row_offset,
+                    len(batch), rows.position, stats, skipped)
+                if not job:
+                    return  # another task is working on this job
+                progressed = True
+        except runtime.DeadlineExceededError:
+            if progressed:
+                return add_import_task(job)
+            # Fail the task, so that the task queue retries it.
+            raise
+        job.status = 'done'
+        job.put()
+        job.delete_content()
+
+    def import_batch(self, job, records):
+        """Imports a batch of records.  Returns a dictionary of counts to add
+        to the job and a list of [error_message, record] pairs."""
+        stats = {}
+        skipped = []
+        if job.format == 'notes':
+            persons = []
+            notes = records
+        else:
+            is_not_empty = lambda x: (x or '').strip()
+            persons = [r for r in records if is_not_empty(r.get('full_name'))]
+            notes = [r for r in records
+                     if is_not_empty(r.get('note_record_id'))]
+        if persons:
+            written, persons_skipped, total, unchanged = \
+                importer.import_records(
+                    self.repo, job.domain, importer.create_person, persons)
+            stats.update(persons_written=written, persons_total=total,
+                         persons_unchanged=unchanged)
+            skipped += [list(pair) for pair in persons_skipped]
+        if notes:
+            written, notes_skipped, total, unchanged = \
+                importer.import_records(
+                    self.repo, job.domain, importer.create_note, notes,
+                    believed_dead_permission=job.believed_dead_permission,
+                    omit_duplicate_notes=(job.format == 'notes'))
+            stats.update(notes_written=written, notes_total=total,
+                         notes_unchanged=unchanged)
+            skipped += [list(pair) for pair in notes_skipped]
+        return stats, skipped
+
+
+class ImportStatus(utils.BaseHandler):
+    """Reports the progress of an ImportJob as JSON."""
+    https_required = True
+
+    def get(self):
+        job = self.params.id and model.ImportJob.get(self.repo, self.params.id)
+        if not (self.auth and job and
+                self.auth.domain_write_permission == job.domain):
+            self.info(
+                403,
+                message='Missing or invalid authorization key or job ID',
+                style='plain')
+            return
+
+        self.response.headers['Content-Type'] = 'application/json'
+        self.write(simplejson.dumps({
+            'id': job.job_id,
+            'format': job.format,
+            'status': job.status,
+            'error': job.error,
+            'rows_imported': job.row_offset,
+            'row_count': job.row_count,
+            'person': {'written': job.persons_written,
+                       'unchanged': job.persons_unchanged,
+                       'total': job.persons_total},
+            'note': {'written': job.notes_written,
+                     'unchanged': job.notes_unchanged,
+                     'total': job.notes_total},
+            'skipped_count': job.skipped_count,
+            'skipped': simplejson.loads(job.skipped_json),
+        }))
+
+
 class Read(utils.BaseHandler):
     https_required = True
 
@@ -297,6 +555,115 @@ class Read(utils.BaseHandler):
             self, ApiActionLog.READ, len(records), len(notes))
 
 
+def encode_changes_cursor(since, seen_keys):
+    """Packs a position in the change stream into an opaque string: the
+    last_modified time reached, and the key names of the entities with that
+    time that have already been returned."""
+    delta = since - EPOCH
+    microseconds = (delta.days*86400 + delta.seconds)*1000000 + \
+        delta.microseconds
+    return base64.urlsafe_b64encode(simplejson.dumps(
+        {'t': microseconds, 'seen': sorted(seen_keys)}))
+
+
+def decode_changes_cursor(cursor):
+    """Unpacks a string from encode_changes_cursor.  An empty string means
+    the beginning of the change stream."""
+    if not cursor:
+        return EPOCH, set()
+    position = simplejson.loads(base64.urlsafe_b64decode(str(cursor)))
+    return (EPOCH + datetime.timedelta(microseconds=position['t']),
+            set(position['seen']))
+
+
+class Changes(utils.BaseHandler):
+    """Lists the changes to the Persons and Notes in a repository as JSON,
+    in order of last_modified, including the expired or hidden records and
+    Tombstones for deleted ones.  Each response has a cursor for fetching
+    the changes that follow, so a mirror can poll for just the changes since
+    its last request.  A mirror that doesn't poll within Tombstone.TTL can
+    miss deletions and should start over with an empty cursor.
+
+    Notes stored before Note.last_modified existed are only listed after
+    tasks/count/note_last_modified has run in the repository."""
+    https_required = True
+
+    def get(self):
+        if self.config.read_auth_key_required and not (
+            self.auth and self.auth.read_permission):
+            self.info(
+                403,
+                message='Missing or invalid authorization key',
+                style='plain')
+            return
+
+        try:
+            since, seen_keys = decode_changes_cursor(self.params.cursor)
+        except (TypeError, ValueError, KeyError):
+            self.info(400, message='Invalid cursor', style='plain')
+            return
+        max_results = min(self.params.max_results or 100, HARD_MAX_RESULTS)
+        until = utils.get_utcnow() - CHANGES_SAFETY_LAG
+
+        # Fetch enough of each kind that, after dropping the entities already
+        # returned, the first max_results of them all are sure to be here.
+        entities = []
+        for kind in [model.Person, model.Note, model.Tombstone]:
+            query = db.Query(kind).filter('repo =', self.repo
+                ).filter('last_modified >=', since
+                ).filter('last_modified <', until
+                ).order('last_modified')
+            entities += query.fetch(max_results + len(seen_keys))
+        entities = [e for e in entities
+                    if not (e.last_modified == since and
+                            e.key().name() in seen_keys)]
+        entities.sort(key=lambda e: (e.last_modified, e.kind(), e.key().name()))
+        entities = entities[:max_results]
+
+        if entities:
+            if entities[-1].last_modified != since:
+                since = entities[-1].last_modified
+                seen_keys = set()
+            seen_keys.update(e.key().name() for e in entities
+                             if e.last_modified == since)
+        changes = map(self.get_change, entities)
+        records = [change['record'] for change in changes if 'record' in change]
+        utils.optionally_filter_sensitive_fields(records, self.auth)
+
+        self.response.headers['Content-Type'] = 'application/json'
+        self.write(simplejson.dumps({
+            'changes': changes,
+            'cursor': encode_changes_cursor(since, seen_keys),
+            'more': len(entities) == max_results,
+        }))
+        utils.log_api_action(
+            self, ApiActionLog.READ,
+            len([e for e in entities if isinstance(e, Person)]),
+            len([e for e in entities if isinstance(e, Note)]))
+
+    def get_change(self, entity):
+        """Describes the change to one entity as a dictionary."""
+        pfif_version = self.params.version
+        if isinstance(entity, model.Tombstone):
+            return {'type': entity.record_kind.lower(),
+                    'record_id': entity.record_id,
+                    'deleted': True}
+        if isinstance(entity, Person):
+            return {'type': 'person',
+                    'record_id': entity.record_id,
+                    'expired': entity.is_expired,
+                    'record': pfif_version.person_to_dict(
+                        entity, entity.is_expired)}
+        change = {'type': 'note',
+                  'record_id': entity.record_id,
+                  'expired': entity.is_expired,
+                  'hidden': entity.hidden}
+        # Like api/read, don't reveal the contents of hidden Notes.
+        if not (entity.is_expired or entity.hidden):
+            change['record'] = pfif_version.note_to_dict(entity)
+        return change
+
+
 class Write(utils.BaseHandler):
     https_required = True
 
@@ -325,19 +692,22 @@ class Write(utils.BaseHandler):
         self.write('<status:status>\n')
 
         create_person = importer.create_person
-        num_people_written, people_skipped, total = importer.import_records(
-            self.repo, source_domain, create_person, person_records)
+        num_people_written, people_skipped, total, unchanged = \
+            importer.import_records(
+                self.repo, source_domain, create_person, person_records)
         self.write_status(
-            'person', num_people_written, people_skipped, total, 
+            'person', num_people_written, people_skipped, total, unchanged,
             'person_record_id')
 
         create_note = importer.create_note
-        num_notes_written, notes_skipped, total = importer.import_records(
-            self.repo, source_domain, create_note, note_records,
-            mark_notes_reviewed, believed_dead_permission, self)
+        num_notes_written, notes_skipped, total, unchanged = \
+            importer.import_records(
+                self.repo, source_domain, create_note, note_records,
+                mark_notes_reviewed, believed_dead_permission, self)
 
         self.write_status(
-            'note', num_notes_written, notes_skipped, total, 'note_record_id')
+            'note', num_notes_written, notes_skipped, total, unchanged,
+            'note_record_id')
 
         self.write('</status:status>\n')
         utils.log_api_action(self, ApiActionLog.WRITE,          
@@ -345,8 +715,12 @@ class Write(utils.BaseHandler):
                              len(people_skipped), len(notes_skipped))
 
 
-    def write_status(self, type, written, skipped, total, id_field):
-        """Emit status information about the results of an attempted write."""
+    def write_status(self, type, written, skipped, total, unchanged,
+                     id_field):
+        """Emit status information about the results of an attempted write.
+        Records not written because they are identical to the stored ones
+        are reported as written, so partners get the same response as when
+        every record was rewritten."""
         skipped_records = []
         for error, record in skipped:
             skipped_records.append(
@@ -364,7 +738,8 @@ class Write(utils.BaseHandler):
 %s
     </status:skipped>
   </status:write>
-''' % (type, total, written, ''.join(skipped_records).rstrip()))
+''' % (type, total, written + unchanged,
+       ''.join(skipped_records).rstrip()))
 
 
 class Search(utils.BaseHandler):
@@ -396,6 +771,7 @@ class Search(utils.BaseHandler):
             # Search by query words.
             query = TextQuery(query_string)
             if self.config.external_search_backends:
+                import external_search
                 results = external_search.search(self.repo, query, max_results,
                     self.config.external_search_backends)
             # External search backends are not always complete. Fall back to
@@ -466,15 +842,6 @@ class Unsubscribe(utils.BaseHandler):
         return self.info(200, 'Not subscribed')
 
 
-def fetch_all(query):
-    results = []
-    batch = query.fetch(500)
-    while batch:
-        results += batch
-        batch = query.with_cursor(query.cursor()).fetch(500)
-    return results
-
-
 class Stats(utils.BaseHandler):
     def get(self):
         if not (self.auth and self.auth.stats_permission):
@@ -484,29 +851,11 @@ class Stats(utils.BaseHandler):
                 style='plain')
             return
 
+        # The other counts are as of the last run of tasks/count/*, but the
+        # sizes of the review queues are kept up to date as Notes change.
         person_counts = model.Counter.get_all_counts(self.repo, 'person')
-        note_counts = model.Counter.get_all_counts(self.repo, 'note')
-
-        # unreviewed
-        note_counts['hidden=FALSE,reviewed=FALSE'] = len(fetch_all(
-            model.Note.all(keys_only=True
-            ).filter('repo =', self.repo
-            ).filter('reviewed =', False
-            ).filter('hidden =', False
-            ).order('-entry_date')))
-        # accepted
-        note_counts['hidden=FALSE,reviewed=TRUE'] = len(fetch_all(
-            model.Note.all(keys_only=True
-            ).filter('repo =', self.repo
-            ).filter('reviewed =', True
-            ).filter('hidden =', False
-            ).order('-entry_date')))
-        # flagged
-        note_counts['hidden=TRUE'] = len(fetch_all(
-            model.Note.all(keys_only=True
-            ).filter('repo =', self.repo
-            ).filter('hidden =', True
-            ).order('-entry_date')))
+        note_counts = dict(model.Counter.get_all_counts(self.repo, 'note'))
+        note_counts.update(model.ReviewQueueCount.get_counts(self.repo))
 
         self.response.headers['Content-Type'] = 'application/json'
         self.write(simplejson.dumps({'person': person_counts,
@@ -530,6 +879,7 @@ class HandleSMS(utils.BaseHandler):
                 style='plain')
             return
 
+        import xml.dom.minidom  # loaded only when needed
         body = self.request.body_file.read()
         doc = xml.dom.minidom.parseString(body)
         message_text = self.get_element_text(doc, 'message_text')
@@ -16,13 +16,23 @@
 """Storage for configuration settings.  Settings can be global or specific
 to a repository, and their values can be of any JSON-encodable type."""
 
+from google.appengine.api import memcache
 from google.appengine.ext import db
 import UserDict, model, random, simplejson
 import logging
 import datetime
+import threading
+import time
 import utils
 from datetime import timedelta
 
+# The memcache key of a number that set() increments whenever a setting
+# changes, so that every instance knows to drop its cached settings.
+VERSION_KEY = 'config_version'
+
+# How often each instance checks the version number in memcache.
+VERSION_CHECK_SECONDS = 2
+
 
 class ConfigurationCache:
     """This class implements an in-memory cache used to store the config
@@ -32,7 +42,10 @@ class ConfigurationCache:
     returned. Cache is enabled by setting a config entry *:config_cache_enable.
     Config entries are stored with the key repo:entry_name in database.
     This cache uses the repo as the key and stores all configs for a
-    repository in one cache element. The global configs have repo='*'."""
+    repository in one cache element. The global configs have repo='*'.
+    Changes made with set() on any instance flush the cache on all instances
+    within VERSION_CHECK_SECONDS; the lifetime only matters for changes made
+    directly in the datastore."""
     storage = {}
     expiry_time = 600
     miss_count = 0
@@ -40,43 +53,52 @@ class ConfigurationCache:
     evict_count = 0
     items_count = 0
     max_items = 0
+    version = None  # the last version number seen in memcache
+    version_check_time = 0  # when we last looked at the version number
+    local_version = 0  # incremented by set() on this instance
+
+    lock = threading.RLock()  # guards the storage and the counters
 
     def flush(self):
-        self.storage.clear()
-        self.items_count=0
+        with self.lock:
+            self.storage.clear()
+            self.items_count=0
 
     def delete(self,key):
         """Deletes the entry with given key from config_cache."""
-        if key in self.storage:
-            self.storage.pop(key)
-            self.items_count -= 1
+        with self.lock:
+            if key in self.storage:
+                self.storage.pop(key)
+                self.items_count -= 1
 
     def add(self, key, value, time_to_live_in_seconds):
         """Adds the key/value pair to cache and updates the expiry time.
            If key already exists, its value and expiry are updated."""
         expiry = utils.get_utcnow() + timedelta(seconds=time_to_live_in_seconds)
-        self.storage[key] = (value, expiry)
-        self.items_count += 1
-        self.max_items += 1
+        with self.lock:
+            self.storage[key] = (value, expiry)
+            self.items_count += 1
+            self.max_items += 1
 
     def read(self, key, default=None):
         """Gets the value corresponding to the key from cache. If cache entry
            has expired, it is deleted from the cache and None is returned."""
-        value, expiry = self.storage.get(key, (None, 0))
-        if value is None :
-            self.miss_count += 1
-            return default
-
-        now = utils.get_utcnow()
-        if (expiry > now) :
-            self.hit_count += 1
-            return value
-        else:
-            # Stale cache entry. Evicting from cache
-            self.delete(key)
-            self.evict_count += 1
-            self.miss_count += 1
-            return default
+        with self.lock:
+            value, expiry = self.storage.get(key, (None, 0))
+            if value is None :
+                self.miss_count += 1
+                return default
+
+            now = utils.get_utcnow()
+            if (expiry > now) :
+                self.hit_count += 1
+                return value
+            else:
+                # Stale cache entry. Evicting from cache
+                self.delete(key)
+                self.evict_count += 1
+                self.miss_count += 1
+                return default
 
     def stats(self):
         logging.info("Hit Count - %r" % self.hit_count)
@@ -85,20 +107,38 @@ class ConfigurationCache:
         logging.info("Eviction Count - %r" % self.evict_count)
         logging.info("Max Items - %r" % self.max_items)
 
-    def get_config(self, repo, name, default=None):
-        """Looks for data in cache. If not present, retrieves from
-           database, stores it in cache and returns the required value."""
+    def check_version(self):
+        """Flushes the cache if the settings have been changed by set() on any
+        instance since the last check.  To avoid a memcache call on every
+        lookup, this checks at most once every VERSION_CHECK_SECONDS."""
+        now = time.time()
+        with self.lock:
+            if now < (ConfigurationCache.version_check_time +
+                      VERSION_CHECK_SECONDS):
+                return
+            ConfigurationCache.version_check_time = now
+        version = memcache.get(VERSION_KEY)
+        with self.lock:
+            if version != ConfigurationCache.version:
+                self.flush()
+                ConfigurationCache.version = version
+
+    def get_dict(self, repo):
+        """Gets a dictionary of all the settings for the given repo (not
+        including global settings), loading them into the cache if needed."""
+        self.check_version()
         config_dict = self.read(repo, None)
         if config_dict is None:
             # Cache miss
-            entries = model.filter_by_prefix(ConfigEntry.all(), repo + ':')
-            if entries is None:
-                return default
             logging.debug("Adding repository %r to config_cache" % repo)
-            config_dict = dict([(e.key().name().split(':', 1)[1],
-                         simplejson.loads(e.value)) for e in entries])
+            config_dict = load_dicts(repo)[repo]
             self.add(repo, config_dict, self.expiry_time)
+        return config_dict
 
+    def get_config(self, repo, name, default=None):
+        """Looks for data in cache. If not present, retrieves from
+           database, stores it in cache and returns the required value."""
+        config_dict = self.get_dict(repo)
         if name in config_dict:
             return config_dict[name]
         return default
@@ -109,6 +149,8 @@ class ConfigurationCache:
         db.put(ConfigEntry(key_name="*:config_cache_enable",
                            value=simplejson.dumps(bool(value))))
         self.delete('*')
+        request_settings.discard('*')
+        increment_version()
 
     def is_enabled(self):
         return self.get_config('*', 'config_cache_enable', None)
@@ -121,9 +163,57 @@ class ConfigEntry(db.Model):
     value = db.TextProperty(default='')
 
 
+class RequestSettings(threading.local):
+    """Holds the settings read while handling a request.  Each repository's
+    settings are loaded once per request, the first time any of them is read,
+    so get() needn't consult the cache (and check the version number) on
+    every call.  Outside of a request (i.e. before start() is called, as in
+    tools and tests), get() reads the settings afresh each time.  Each thread
+    has its own snapshot, so concurrent requests don't mix their settings."""
+
+    def __init__(self):
+        self.active = False
+        self.dicts = {}  # maps each repo to a dictionary of its settings
+
+    def start(self):
+        """Begins a new snapshot for a new request."""
+        self.active = True
+        self.dicts = {}
+
+    def stop(self):
+        """Ends the snapshot at the end of a request."""
+        self.active = False
+        self.dicts = {}
+
+    def get_dicts(self, *repos):
+        """Gets a dictionary of the settings for each of the given repos (not
+        including global settings), loading the missing ones together."""
+        missing = [repo for repo in repos if repo not in self.dicts]
+        if missing:
+            if cache.is_enabled():
+                for repo in missing:
+                    self.dicts[repo] = cache.get_dict(repo)
+            else:
+                self.dicts.update(load_dicts(*missing))
+        dicts = [self.dicts[repo] for repo in repos]
+        if not self.active:
+            self.dicts = {}
+        return dicts
+
+    def discard(self, repo):
+        """Drops a repo's settings so they are loaded again when next read."""
+        self.dicts.pop(repo, None)
+
+request_settings = RequestSettings()
+
+
 def get(name, default=None, repo='*'):
-    """Gets a configuration setting from cache if it is enabled,
-       otherwise from the database."""
+    """Gets a configuration setting.  While handling a request, this reads
+    the request's snapshot of the settings; otherwise it reads from cache if
+    it is enabled, or else from the database."""
+    if request_settings.active:
+        [repo_dict] = request_settings.get_dicts(repo)
+        return repo_dict.get(name, default)
     if cache.is_enabled():
         return cache.get_config(repo, name, default)
     entry = ConfigEntry.get_by_key_name(repo + ':' + name)
@@ -136,6 +226,31 @@ def set(repo='*', **kwargs):
     db.put(ConfigEntry(key_name=repo + ':' + name,
            value=simplejson.dumps(value)) for name, value in kwargs.items())
     cache.delete(repo)
+    request_settings.discard(repo)
+    increment_version()
+
+def increment_version():
+    """Tells all instances to drop their cached settings."""
+    with cache.lock:
+        ConfigurationCache.local_version += 1
+    memcache.incr(VERSION_KEY, initial_value=0)
+
+def get_version():
+    """Returns a value that changes whenever settings are changed with set(),
+    for use in the keys of cached values that are derived from settings."""
+    cache.check_version()
+    return (ConfigurationCache.version, ConfigurationCache.local_version)
+
+def load_dicts(*repos):
+    """Loads all the settings for the given repos from the datastore, with
+    the queries for all the repos running in parallel.  Returns a dictionary
+    that maps each repo to a dictionary of its settings."""
+    results = [(repo, model.filter_by_prefix(ConfigEntry.all(), repo + ':'
+                                             ).run(batch_size=1000))
+               for repo in repos]
+    return dict((repo, dict((e.key().name().split(':', 1)[1],
+                             simplejson.loads(e.value)) for e in entries))
+                for repo, entries in results)
 
 def get_for_repo(repo, name, default=None):
     """Gets a configuration setting for a particular repository.  Looks for a
@@ -153,8 +268,16 @@ def set_for_repo(repo, **kwargs):
 
 
 class Configuration(UserDict.DictMixin):
+    """A snapshot of the settings for one repository.  All the settings for
+    the repository and the global settings are loaded together the first time
+    any setting is read, and they don't change after that, so a request sees
+    one consistent configuration.  During a request, the settings come from
+    the same snapshot that get() reads."""
+
     def __init__(self, repo):
         self.repo = repo
+        self.repo_dict = None  # settings specific to this repository
+        self.merged_dict = None  # the above, falling back to global settings
 
     def __nonzero__(self):
         return True
@@ -162,11 +285,19 @@ class Configuration(UserDict.DictMixin):
     def __getattr__(self, name):
         return self[name]
 
+    def load(self):
+        if self.merged_dict is None:
+            global_dict, repo_dict = request_settings.get_dicts('*', self.repo)
+            self.merged_dict = dict(global_dict)
+            self.merged_dict.update(repo_dict)
+            self.repo_dict = repo_dict
+
     def __getitem__(self, name):
         """Gets a configuration setting for this repository.  Looks for a
         repository-specific setting, then falls back to a global setting."""
-        return get_for_repo(self.repo, name)
+        self.load()
+        return self.merged_dict.get(name)
 
     def keys(self):
-        entries = model.filter_by_prefix(ConfigEntry.all(), self.repo + ':')
-        return [entry.key().name().split(':', 1)[1] for entry in entries]
+        self.load()
+        return self.repo_dict.keys()
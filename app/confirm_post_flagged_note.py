@@ -137,10 +137,15 @@ class Handler(utils.BaseHandler):
         # Update the Person based on the Note.
         if person:
             person.update_from_note(note_confirmed)
-            # Send notification to all people
-            # who subscribed to updates on this person
-            subscribe.send_notifications(self, person, [note_confirmed])
             entities_to_put.append(person)
 
         # Write one or both entities to the store.
         db.put(entities_to_put)
+        model.ReviewQueueCount.update(
+            self.repo, new_queues=[
+                model.ReviewQueueCount.get_queue(note_confirmed)])
+
+        if person:
+            # Send notification to all people
+            # who subscribed to updates on this person
+            subscribe.send_notifications(self, person, [note_confirmed])
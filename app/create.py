@@ -15,9 +15,9 @@
 
 from datetime import datetime
 from model import *
-from photo import create_photo, PhotoError
+from photo import add_renditions_task, create_photo, PhotoError
 from utils import *
-from detect_spam import SpamDetector
+from detect_spam import get_spam_detector
 import simplejson
 
 from django.utils.translation import ugettext as _
@@ -102,8 +102,10 @@ class Handler(BaseHandler):
         # Finally, store the Photo. Past this point, we should NOT self.error.
         if photo:
             photo.put()
+            add_renditions_task(photo, self)
         if note_photo:
             note_photo.put()
+            add_renditions_task(note_photo, self)
 
         profile_urls = []
         if self.params.profile_url1:
@@ -162,7 +164,7 @@ class Handler(BaseHandler):
         person.update_index(['old', 'new'])
 
         if self.params.add_note:
-            spam_detector = SpamDetector(self.config.bad_words)
+            spam_detector = get_spam_detector(self.config.bad_words)
             spam_score = spam_detector.estimate_spam_score(self.params.text)
             if (spam_score > 0):
                 note = NoteWithBadWords.create_original(
@@ -218,6 +220,8 @@ class Handler(BaseHandler):
 
                 # Write the new Note to the datastore
                 db.put(note)
+                ReviewQueueCount.update(
+                    self.repo, new_queues=[ReviewQueueCount.get_queue(note)])
                 UserActionLog.put_new('add', note, copy_properties=False)
                 person.update_from_note(note)
 
@@ -16,6 +16,10 @@
 from model import *
 from utils import *
 
+# Stylesheets depend only on the URL parameters (lang, ui), so each
+# variant is rendered once and cached for this long.
+CSS_CACHE_SECONDS = 600
+
 class Handler(BaseHandler):
 
     repo_required = False
@@ -27,7 +31,7 @@ class Handler(BaseHandler):
             template_name = 'css-%s' % self.env.ui
         else:
             template_name = 'css-default'
-        self.render(
-            template_name,
+        self.render_with_etag(
+            template_name, CSS_CACHE_SECONDS,
             start='right' if self.env.rtl else 'left',
             end='left' if self.env.rtl else 'right')
@@ -18,6 +18,7 @@
 
 __author__ = 'shaomei@google.com (Shaomei Wu)'
 
+import collections
 import unicodedata
 import logging
 import re
@@ -31,18 +32,95 @@ def normalize(string):
     string = unicodedata.normalize('NFD', string)
     return string
 
+def is_word_char(char):
+    """Returns True if the character joins with its neighbours to form a word.
+    CJK text is written without spaces between words, so each wide character
+    is treated as a word of its own."""
+    if unicodedata.east_asian_width(char) in ['W', 'F']:
+        return False
+    return (char.isalnum() or char in "_-'" or
+            unicodedata.category(char) == 'Mn')
+
+
+class BadWordMatcher:
+    """Finds all the bad words and phrases that occur in a normalized text in
+    a single pass, using the Aho-Corasick algorithm.  A match must start and
+    end at word boundaries, so 'ham' is not found in 'hamster'."""
+
+    def __init__(self, phrases):
+        self.phrases = sorted(set(phrase for phrase in phrases if phrase))
+        # The trie of phrases: each state maps characters to the next state.
+        self.transitions = [{}]
+        # The indexes of the phrases that end at each state.
+        self.outputs = [[]]
+        for index, phrase in enumerate(self.phrases):
+            state = 0
+            for char in phrase:
+                if char not in self.transitions[state]:
+                    self.transitions[state][char] = len(self.transitions)
+                    self.transitions.append({})
+                    self.outputs.append([])
+                state = self.transitions[state][char]
+            self.outputs[state].append(index)
+
+        # Each state's failure link points to the state for the longest proper
+        # suffix of its text that is also in the trie.  The links are filled
+        # in breadth-first, so shorter suffixes are always done first.
+        self.failures = [0]*len(self.transitions)
+        queue = collections.deque(self.transitions[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.transitions[state].items():
+                queue.append(next_state)
+                failure = self.failures[state]
+                while failure and char not in self.transitions[failure]:
+                    failure = self.failures[failure]
+                failure = self.transitions[failure].get(char, 0)
+                self.failures[next_state] = failure
+                self.outputs[next_state] = (
+                    self.outputs[next_state] + self.outputs[failure])
+
+    def find(self, text):
+        """Returns the set of phrases found in the given normalized text."""
+        found = set()
+        if not self.phrases:
+            return found
+        transitions, failures, outputs = (
+            self.transitions, self.failures, self.outputs)
+        state = 0
+        for end, char in enumerate(text):
+            while state and char not in transitions[state]:
+                state = failures[state]
+            state = transitions[state].get(char, 0)
+            for index in outputs[state]:
+                phrase = self.phrases[index]
+                start = end + 1 - len(phrase)
+                if (self.is_boundary(text, start - 1, phrase[0]) and
+                    self.is_boundary(text, end + 1, phrase[-1])):
+                    found.add(phrase)
+        return found
+
+    def is_boundary(self, text, position, edge_char):
+        """Returns True if a phrase whose first or last character is edge_char
+        can be next to the character at text[position]."""
+        return (position < 0 or position >= len(text) or
+                not is_word_char(edge_char) or not is_word_char(text[position]))
+
 
 class SpamDetector():
-    bad_words_set = set()
     def __init__(self, bad_words):
-        if bad_words == '' or bad_words == None:
-            return
-
-        # Input bad words are seperated by comma.
-        for word in re.split(',\s*', bad_words):
-            # Normalized the bad word and add it to the list.
-            normalized_word = normalize(word)
-            self.bad_words_set.add(normalized_word)
+        # Each detector has its own set; a class-level set would be shared by
+        # every repository and every concurrent request.
+        self.bad_words_set = set()
+        if bad_words:
+            # Input bad words are seperated by comma.  A bad word can also be
+            # a phrase of several words.
+            for word in re.split(',\s*', bad_words):
+                # Normalized the bad word and add it to the list.
+                normalized_word = ' '.join(normalize(word).split())
+                if normalized_word:
+                    self.bad_words_set.add(normalized_word)
+        self.matcher = BadWordMatcher(self.bad_words_set)
 
     def estimate_spam_score(self, text):
         """Estimate the probability of the input text being spam.
@@ -50,8 +128,9 @@ class SpamDetector():
            a float score between [0,1], or None if text is empty
            after normalization.
         """
-        # Normalize text
-        normalized_text = normalize(text)
+        # Normalize text, collapsing whitespace so that phrases match across
+        # line breaks.
+        normalized_text = ' '.join(normalize(text).split())
 
         # Tokenize the text into words. Currently we keep hypen and
         # apostrophe in the words but filter all the other punctuation marks.
@@ -61,13 +140,35 @@ class SpamDetector():
         # the future.
         words = re.findall("\w+-\w+|[\w']+", normalized_text)
 
-        # Look for bad word in the text by string match.
-        bad_words_matched = self.bad_words_set.intersection( set(words) )
-
         # Simple way to calculate spam score for now.
         if len(words) == 0:
             logging.debug('input text contains no words.')
             return None
         else:
+            # Look for bad words and phrases in the text.
+            bad_words_matched = self.matcher.find(normalized_text)
             spam_score = float(len(bad_words_matched))/float(len(words))
-            return spam_score
+            return min(spam_score, 1.0)
+
+    def estimate_spam_scores(self, texts):
+        """Estimates the spam scores for many texts at once, such as the notes
+        in an import.  Returns a list of scores in the same order."""
+        scores = {}
+        for text in texts:
+            if text not in scores:
+                scores[text] = self.estimate_spam_score(text)
+        return [scores[text] for text in texts]
+
+
+spam_detectors = {}
+
+def get_spam_detector(bad_words):
+    """Gets a SpamDetector for a bad_words setting, reusing the one compiled
+    earlier for the same setting if there is one.  The cache is keyed by the
+    setting itself, so a change to a repo's bad_words takes effect at once."""
+    detector = spam_detectors.get(bad_words)
+    if detector is None:
+        if len(spam_detectors) >= 100:
+            spam_detectors.clear()
+        detector = spam_detectors[bad_words] = SpamDetector(bad_words)
+    return detector
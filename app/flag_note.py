@@ -50,6 +50,7 @@ class Handler(utils.BaseHandler):
 
         captcha_response = note.hidden and self.get_captcha_response()
         if not note.hidden or captcha_response.is_valid or self.env.test_mode:
+            old_queue = model.ReviewQueueCount.get_queue(note)
             note.hidden = not note.hidden
             # When "hidden" changes, update source_date and entry_date (melwitt)
             # http://code.google.com/p/googlepersonfinder/issues/detail?id=58
@@ -57,14 +58,16 @@ class Handler(utils.BaseHandler):
             note.source_date = now
             note.entry_date = now
             db.put(note)
+            model.ReviewQueueCount.update(
+                self.repo, [old_queue],
+                [model.ReviewQueueCount.get_queue(note)])
 
             model.UserActionLog.put_new(
                 (note.hidden and 'hide') or 'unhide',
                 note, self.request.get('reason_for_report', ''))
 
-            person = model.Person.get(self.repo, note.person_record_id)
-            if person:
-                person.update_latest_status()
+            # Hiding or revealing a note can change the Person's status.
+            self.add_update_status_task(note.person_record_id)
 
             self.redirect(self.get_url('/view', id=note.person_record_id,
                                        signature=self.params.signature))
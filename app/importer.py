@@ -27,6 +27,7 @@ import sys
 
 from google.appengine.api import datastore_errors
 
+import detect_spam
 import subscribe
 from model import *
 from utils import validate_sex, validate_status, validate_approximate_date, \
@@ -34,6 +35,8 @@ from utils import validate_sex, validate_status, validate_approximate_date, \
 
 DEFAULT_PUT_RETRIES = 3
 MAX_PUT_BATCH = 100
+# The datastore allows at most 30 values in an IN filter.
+MAX_IN_FILTER_VALUES = 30
 
 def utf8_decoder(dict_reader):
     """Yields a dictionary where all string values are converted to Unicode.
@@ -182,6 +185,17 @@ def filter_new_notes(entities, repo):
     return notes
 
 
+def update_review_queue_counts(repo, entities, stored_notes):
+    """Updates the sizes of the review queues for the Notes among the given
+    entities, which have just been written in place of stored_notes."""
+    notes = [entity for entity in entities if isinstance(entity, Note)]
+    ReviewQueueCount.update(
+        repo,
+        [ReviewQueueCount.get_queue(stored_notes[note.record_id])
+         for note in notes if note.record_id in stored_notes],
+        [ReviewQueueCount.get_queue(note) for note in notes])
+
+
 def send_notifications(handler, persons, notes):
     """For each note, send a notification to subscriber.
 
@@ -191,17 +205,58 @@ def send_notifications(handler, persons, notes):
                 indexed by person_record_id.
        handler: Handler used to send email notification.
     """
+    notes_by_person_id = {}
     for note in notes:
-        person = persons[note.person_record_id]
-        subscribe.send_notifications(handler, person, [note])
-
-
-def notes_match(a, b):
-    fields = ['person_record_id', 'author_name', 'author_email', 'author_phone',
-              'source_date', 'status', 'author_made_contact',
-              'email_of_found_person', 'phone_of_found_person',
-              'last_known_location', 'text', 'photo_url']
-    return [getattr(a, f) for f in fields] == [getattr(b, f) for f in fields]
+        notes_by_person_id.setdefault(note.person_record_id, []).append(note)
+    for person_id, person_notes in notes_by_person_id.items():
+        subscribe.send_notifications(handler, persons[person_id], person_notes)
+
+
+def get_stored_match_fingerprints(repo, fingerprints):
+    """Returns the set of the given Note match_fingerprints that belong to
+    Notes already stored in the given repository, including expired ones."""
+    fingerprints = list(set(fingerprints))
+    stored = set()
+    for start in range(0, len(fingerprints), MAX_IN_FILTER_VALUES):
+        query = Note.all_in_repo(repo, filter_expired=False).filter(
+            'match_fingerprint IN',
+            fingerprints[start:start + MAX_IN_FILTER_VALUES])
+        stored.update(note.match_fingerprint for note in query)
+    return stored
+
+
+def filter_unchanged_records(entities, fields_by_id, stored=None):
+    """Compares the given entities (a dictionary of Person or Note entities
+    keyed by record_id) with the records already stored under the same keys.
+    Removes the entities whose content is unchanged and the entities with a
+    source_date older than that of the stored record, and sets the
+    content_fingerprint on the rest.  Returns the number of unchanged
+    entities and a list of (error_message, record) pairs for the older ones,
+    taking the records from the fields_by_id dictionary.  If 'stored' is a
+    dictionary, the stored records that the remaining entities will replace
+    are added to it, keyed by record_id."""
+    unchanged = 0
+    skipped = []
+    record_ids = entities.keys()
+    for start in range(0, len(record_ids), MAX_PUT_BATCH):
+        batch = [entities[id] for id in record_ids[start:start + MAX_PUT_BATCH]]
+        for entity, existing in zip(batch, db.get([e.key() for e in batch])):
+            fingerprint = entity.get_content_fingerprint()
+            if existing and existing.source_date and entity.source_date and \
+                entity.source_date < existing.source_date:
+                skipped.append(
+                    ('Not updated: the existing record has a newer source_date',
+                     fields_by_id[entity.record_id]))
+                del entities[entity.record_id]
+            elif existing and not existing.is_expired and \
+                existing.content_fingerprint == fingerprint:
+                unchanged += 1
+                del entities[entity.record_id]
+            else:
+                entity.content_fingerprint = fingerprint
+                if existing and stored is not None:
+                    stored[entity.record_id] = existing
+    return unchanged, skipped
 
 
 def import_records(repo, domain, converter, records,
@@ -221,24 +276,28 @@ def import_records(repo, domain, converter, records,
             skip the bad record.  The key_name of the resulting datastore
             entity must begin with domain + '/', or the record will be skipped.
         records: A list of dictionaries representing the entries.
-        mark_notes_reviewed: If true, mark the new notes as reviewed.
+        mark_notes_reviewed: If true, mark the new notes as reviewed, except
+            for notes that contain any of the repository's bad words.
         believed_dead_permission: If true, allow importing notes with status 
             as 'believed_dead'; otherwise skip the note and return an error.
         handler: Handler to use to send e-mail notification for notes.  If this
             is None, then we do not send e-mail.
         omit_duplicate_notes: If true, skip any Notes that are identical to
-            existing Notes on the same Person.
+            existing Notes on the same Person or to earlier Notes in records.
 
     Returns:
         The number of passed-in records that were written (not counting other
         Person records that were updated because they have new Notes), a list
-        of (error_message, record) pairs for the skipped records, and the
-        number of records processed in total.
+        of (error_message, record) pairs for the skipped records, the number
+        of records processed in total, and the number of records that were
+        not written because they are identical to the stored records.
     """
     persons = {}  # Person entities to write
     notes = {}  # Note entities to write
     skipped = []  # entities skipped due to an error
     total = 0  # total number of entities for which conversion was attempted
+    fields_by_id = {}  # input records, keyed by record_id
+    match_fingerprints = set()  # match_fingerprints of the Notes in notes
     for fields in records:
         total += 1
         try:
@@ -251,8 +310,8 @@ def import_records(repo, domain, converter, records,
             skipped.append(
                 ('Not in authorized domain: %r' % entity.record_id, fields))
             continue
+        fields_by_id[entity.record_id] = fields
         if isinstance(entity, Person):
-            entity.update_index(['old', 'new'])
             persons[entity.record_id] = entity
         if isinstance(entity, Note):
             # Check whether reporting 'believed_dead' in note is permitted.
@@ -270,17 +329,48 @@ def import_records(repo, domain, converter, records,
                     ('The author has disabled new commenting on this record',
                      fields))
                 continue
-            # Check whether the note is a duplicate.
+            # Check whether the note duplicates one earlier in this import.
             if omit_duplicate_notes:
-                other_notes = Note.get_by_person_record_id(
-                    repo, entity.person_record_id, filter_expired=False)
-                if any(notes_match(entity, note) for note in other_notes):
+                if entity.match_fingerprint in match_fingerprints:
                     skipped.append(
                         ('This is a duplicate of an existing note', fields))
                     continue
+                match_fingerprints.add(entity.match_fingerprint)
             entity.reviewed = mark_notes_reviewed
             notes[entity.record_id] = entity
 
+    # Look up all the Notes at once to check for duplicates in the datastore.
+    if omit_duplicate_notes and notes:
+        stored = get_stored_match_fingerprints(repo, match_fingerprints)
+        for record_id, note in notes.items():
+            if note.match_fingerprint in stored:
+                skipped.append(('This is a duplicate of an existing note',
+                                fields_by_id[record_id]))
+                del notes[record_id]
+
+    # Partners often re-send their entire data set, so leave alone the records
+    # that have not changed or are older than what we already have.
+    unchanged = 0
+    stored_notes = {}  # stored Notes that will be overwritten, by record_id
+    for entities, stored in [(persons, None), (notes, stored_notes)]:
+        entities_unchanged, entities_skipped = filter_unchanged_records(
+            entities, fields_by_id, stored)
+        unchanged += entities_unchanged
+        skipped += entities_skipped
+    for person in persons.values():
+        person.update_index(['old', 'new'])
+
+    # Score all the notes at once with the repository's bad word list.  Notes
+    # that look like spam are left unreviewed so they show up for review.
+    if mark_notes_reviewed and notes:
+        spam_detector = detect_spam.get_spam_detector(
+            config.get_for_repo(repo, 'bad_words'))
+        scores = spam_detector.estimate_spam_scores(
+            [note.text for note in notes.values()])
+        for note, score in zip(notes.values(), scores):
+            if score > 0:
+                note.reviewed = False
+
     # We keep two dictionaries 'persons' and 'extra_persons', with disjoint
     # key sets: Person entities for the records passed in to import_records() 
     # go in 'persons', and any other Person entities affected by the import go
@@ -308,8 +398,6 @@ def import_records(repo, domain, converter, records,
             extra_persons[note.person_record_id] = person
         person.update_from_note(note)
 
-    # TODO(kpy): Don't overwrite existing Persons with newer source_dates.
-
     # Now store the imported Persons and Notes, and count them.
     entities = persons.values() + notes.values()
     all_persons = dict(persons, **extra_persons)
@@ -323,6 +411,9 @@ def import_records(repo, domain, converter, records,
             new_notes = filter_new_notes(entities[:MAX_PUT_BATCH], repo)
         written_batch = put_batch(entities[:MAX_PUT_BATCH])
         written += written_batch
+        if written_batch:
+            update_review_queue_counts(
+                repo, entities[:MAX_PUT_BATCH], stored_notes)
         # If we have new_notes and results did not fail then send notifications.
         if new_notes and written_batch:
             send_notifications(handler, all_persons, new_notes)
@@ -334,4 +425,4 @@ def import_records(repo, domain, converter, records,
         put_batch(entities[:MAX_PUT_BATCH])
         entities[:MAX_PUT_BATCH] = []
 
-    return written, skipped, total
+    return written, skipped, total, unchanged
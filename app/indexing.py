@@ -35,6 +35,7 @@ but will not be retrieved by:
 from text_query import TextQuery
 
 from google.appengine.ext import db
+import hashlib
 import unicodedata
 import logging
 import model
@@ -42,8 +43,25 @@ import re
 import jautils
 
 
-def update_index_properties(entity):
-    """Finds and updates all prefix-related properties on the given entity."""
+# The version of the tokenizer that produces the names_prefixes property.
+# Increment this whenever a change to get_index_tokens() would produce
+# different tokens for existing records, then run tasks/count/reindex to
+# migrate them.  Until the migration finishes, search() accepts a record that
+# matches under either the tokens stored with it or the current tokenizer.
+#
+# Records indexed before version 1 carry no version token, so search() has no
+# way to fetch them.  Before raising INDEX_VERSION above 1, tasks/count/reindex
+# MUST have run to completion in every repository at version 1, as shown by a
+# finished Counter with scan_name 'reindex'.
+INDEX_VERSION = 1
+
+# Put a cap on the number of tokens, just as a precaution.
+MAX_TOKENS = 100
+
+
+def get_index_tokens(entity):
+    """Returns the set of index tokens that the current tokenizer produces
+    for the given entity, without modifying the entity."""
     # Using set to make sure I'm not adding the same string more than once.
     names_prefixes = set()
     for property in entity._fields_to_index_properties:
@@ -63,12 +81,43 @@ def update_index_properties(entity):
     # languages?
     names_prefixes |= get_alternate_name_tokens(entity)
 
-    # Put a cap on the number of tokens, just as a precaution.
-    MAX_TOKENS = 100
-    entity.names_prefixes = list(names_prefixes)[:MAX_TOKENS]
+    # Mark the record with the version of the tokenizer, so that search() can
+    # find the records that haven't been migrated to a newer one yet.
+    names_prefixes.add(get_version_token(INDEX_VERSION))
+    return names_prefixes
+
+
+def get_version_token(version):
+    """Returns the index token that marks the records indexed by the given
+    version of the tokenizer.  TextQuery only makes words out of letters, so
+    this token never matches a query word."""
+    return '#%d' % version
+
+
+def get_index_fingerprint(tokens):
+    """Returns a short string that changes whenever the set of tokens does."""
+    text = u'\n'.join(sorted(tokens))
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def is_index_current(entity):
+    """Returns True if the index properties stored on the entity were produced
+    by the current tokenizer and would not change if rebuilt."""
+    return (entity.index_version == INDEX_VERSION and
+            entity.index_fingerprint ==
+                get_index_fingerprint(get_index_tokens(entity)))
+
+
+def update_index_properties(entity):
+    """Finds and updates all prefix-related properties on the given entity."""
+    names_prefixes = get_index_tokens(entity)
+    # Sort before truncating so that the stored tokens are deterministic.
+    entity.names_prefixes = sorted(names_prefixes)[:MAX_TOKENS]
     if len(names_prefixes) > MAX_TOKENS:
         logging.debug('MAX_TOKENS exceeded for %s' %
                       ' '.join(list(names_prefixes)))
+    entity.index_version = INDEX_VERSION
+    entity.index_fingerprint = get_index_fingerprint(names_prefixes)
 
 
 def get_alternate_name_tokens(person):
@@ -210,6 +259,10 @@ def sort_query_words(query_words):
 
 
 def search(repo, query_obj, max_results):
+    """Finds the Persons in a repository that match a TextQuery.  Records
+    indexed by an older tokenizer are found by their version token; those
+    indexed before version 1 have none, so tasks/count/reindex is a required
+    migration step before INDEX_VERSION is raised (see INDEX_VERSION)."""
     # As there are limits on the number of filters that we can apply and the
     # number of entries we can fetch at once, the order of query words could
     # potentially matter.  In particular, this is the case for most Japanese
@@ -235,18 +288,37 @@ def search(repo, query_obj, max_results):
             filters_to_try -= 1
             continue
     logging.debug('indexing.search fetched: %d' % len(fetched))
+    fetch_limit_reached = len(fetched) == fetch_limit
+
+    # A record indexed by an older tokenizer can lack the tokens that the
+    # current one produces, so the query above can miss it.  Until
+    # tasks/count/reindex has migrated them all, also fetch such records by
+    # their version token and check them against the current tokenizer below.
+    fetched_keys = set(result.key() for result in fetched)
+    for version in range(1, INDEX_VERSION):
+        query = model.Person.all_in_repo(repo).filter(
+            'names_prefixes =', get_version_token(version))
+        for result in query.fetch(fetch_limit):
+            if result.key() not in fetched_keys:
+                fetched.append(result)
+                fetched_keys.add(result.key())
 
     # Now perform any filtering that App Engine was unable to do for us.
     matched = []
     for result in fetched:
+        tokens = set(result.names_prefixes)
+        if result.index_version != INDEX_VERSION:
+            # This record was indexed by an older tokenizer and has not been
+            # migrated yet, so accept a match under either version.
+            tokens |= get_index_tokens(result)
         for word in query_words:
-            if word not in result.names_prefixes:
+            if word not in tokens:
                 break
         else:
             matched.append(result)
     logging.debug('indexing.search matched: %d' % len(matched))
 
-    if len(fetched) == fetch_limit and len(matched) < max_results:
+    if fetch_limit_reached and len(matched) < max_results:
         logging.debug('Warning: Fetch reached a limit of %d, but only %d '
                       'exact-matched the query (max_results = %d).' %
                       (fetch_limit, len(matched), max_results))
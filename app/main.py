@@ -21,6 +21,7 @@ import django_setup  # always keep this first
 import mimetypes
 import re
 import os
+import time
 import urlparse
 
 from google.appengine.api import memcache
@@ -41,6 +42,9 @@ import user_agents
 # When no action or repo is specified, redirect to this action.
 HOME_ACTION = 'home.html'
 
+# Static resources requested by hashed URLs can be cached for a year.
+HASHED_URL_MAX_AGE_SECONDS = 365*24*3600
+
 # Map of URL actions to Python module and class names.
 # TODO(kpy): Remove the need for this configuration information, either by
 # regularizing the module and class names or adding a URL attribute to handlers.
@@ -82,6 +86,8 @@ HANDLER_CLASSES['admin/api_keys/list'] = 'admin_api_keys.ListApiKeys'
 HANDLER_CLASSES['api/import'] = 'api.Import'
 HANDLER_CLASSES['api/import/notes'] = 'api.Import'
 HANDLER_CLASSES['api/import/persons'] = 'api.Import'
+HANDLER_CLASSES['api/import/status'] = 'api.ImportStatus'
+HANDLER_CLASSES['api/changes'] = 'api.Changes'
 HANDLER_CLASSES['api/read'] = 'api.Read'
 HANDLER_CLASSES['api/write'] = 'api.Write'
 HANDLER_CLASSES['api/search'] = 'api.Search'
@@ -95,10 +101,19 @@ HANDLER_CLASSES['feeds/person'] = 'feeds.Person'
 HANDLER_CLASSES['sitemap'] = 'sitemap.SiteMap'
 HANDLER_CLASSES['sitemap/ping'] = 'sitemap.SiteMapPing'
 HANDLER_CLASSES['tasks/count/note'] = 'tasks.CountNote'
+HANDLER_CLASSES['tasks/count/match_fingerprint'] = 'tasks.AddMatchFingerprint'
+HANDLER_CLASSES['tasks/count/source_domain'] = 'tasks.AddSourceDomain'
+HANDLER_CLASSES['tasks/count/note_last_modified'] = \
+    'tasks.AddNoteLastModified'
 HANDLER_CLASSES['tasks/count/person'] = 'tasks.CountPerson'
 HANDLER_CLASSES['tasks/count/reindex'] = 'tasks.Reindex'
 HANDLER_CLASSES['tasks/count/update_dead_status'] = 'tasks.UpdateDeadStatus'
 HANDLER_CLASSES['tasks/count/update_status'] = 'tasks.UpdateStatus'
+HANDLER_CLASSES['tasks/update_person_status'] = 'tasks.UpdatePersonStatus'
+HANDLER_CLASSES['tasks/notify_subscribers'] = 'subscribe.NotifySubscribers'
+HANDLER_CLASSES['tasks/flush_notifications'] = 'subscribe.FlushNotifications'
+HANDLER_CLASSES['tasks/import'] = 'api.ImportWorker'
+HANDLER_CLASSES['tasks/photo_renditions'] = 'photo.CreateRenditions'
 HANDLER_CLASSES['tasks/delete_expired'] = 'tasks.DeleteExpired'
 HANDLER_CLASSES['tasks/delete_old'] = 'tasks.DeleteOld'
 HANDLER_CLASSES['tasks/clean_up_in_test_mode'] = 'tasks.CleanUpInTestMode'
@@ -194,29 +209,39 @@ def select_lang(request, config=None):
     lang = re.sub('[^A-Za-z0-9-]', '', lang)
     return const.LANGUAGE_SYNONYMS.get(lang, lang)
 
-def get_repo_options(request, lang):
-    """Returns a list of the names and titles of the launched repositories."""
-    options = []
+def get_repo_titles(lang):
+    """Returns a list of (repo, title, test_mode) tuples for the launched
+    repositories, with the titles in the given language."""
+    repo_titles = []
     for repo in model.Repo.list_launched():
         titles = config.get_for_repo(repo, 'repo_titles', {})
         default_title = (titles.values() or ['?'])[0]
         title = titles.get(lang, titles.get('en', default_title))
-        url = utils.get_repo_url(request, repo)
         test_mode = config.get_for_repo(repo, 'test_mode')
-        options.append(utils.Struct(repo=repo, title=title, url=url,
-                                    test_mode=test_mode))
-    return options
+        repo_titles.append((repo, title, test_mode))
+    return repo_titles
+
+def get_repo_options(request, repo_titles):
+    """Returns a list of the names and titles of the launched repositories."""
+    return [utils.Struct(repo=repo, title=title, test_mode=test_mode,
+                         url=utils.get_repo_url(request, repo))
+            for repo, title, test_mode in repo_titles]
+
+def get_language_endonyms(config=None):
+    """Returns a list of (lang, endonym) pairs for the language menu."""
+    return [(lang, const.LANGUAGE_ENDONYMS.get(lang, '?'))
+            for lang in (config and config.language_menu_options or ['en'])]
 
-def get_language_options(request, config=None):
+def get_language_options(request, language_endonyms):
     """Returns a list of information needed to generate the language menu."""
     return [{'lang': lang,
-             'endonym': const.LANGUAGE_ENDONYMS.get(lang, '?'),
+             'endonym': endonym,
              'url': utils.set_url_param(request.url, 'lang', lang)}
-            for lang in (config and config.language_menu_options or ['en'])]
+            for lang, endonym in language_endonyms]
 
 def get_secret(name):
     """Gets a secret from the datastore by name, or returns None if missing."""
-    secret = model.Secret.get_by_key_name(name)
+    secret = model.secret_cache.get(name)
     if secret:
         return secret.secret
 
@@ -240,75 +265,158 @@ def get_hidden_input_tags_for_preserved_query_params(request):
                 django.utils.html.escape(value))
     return tags_str
 
-def setup_env(request):
-    """Constructs the 'env' object, which contains various template variables
-    that are commonly used by most handlers."""
-    env = utils.Struct()
-    env.repo, env.action = get_repo_and_action(request)
-    env.config = config.Configuration(env.repo or '*')
-    # TODO(ryok): Rename to local_test_mode or something alike to disambiguate
-    # better from repository's test_mode.
-    env.test_mode = (request.remote_addr == '127.0.0.1' and
-                     request.get('test_mode'))
+def get_ui_settings(ui):
+    """Returns a dictionary of the env settings for the given UI variant."""
+    settings = utils.Struct()
+
+    # Enables features which require JavaScript.
+    settings.enable_javascript = True
+    # Enables operations which requires Captcha.
+    settings.enable_captcha = True
+    # Enables photo upload.
+    settings.enable_photo_upload = True
+    # Enables to flag/unflag notes as spam, and to reveal spam notes.
+    settings.enable_spam_ops = True
+    # Enables duplicate marking mode.
+    settings.enable_dup_mode = True
+    # Shows a logo on top of the page.
+    settings.show_logo = True
+    # Shows language menu.
+    settings.show_language_menu = True
+    # Uses short labels for buttons.
+    settings.use_short_buttons = False
+    # Optional "target" attribute for links to non-small pages.
+    settings.target_attr = ''
+    # Shows record IDs in the results page.
+    settings.show_record_ids_in_results = True
+
+    if ui == 'small':
+        settings.show_logo = False
+        settings.target_attr = ' target="_blank" '
+
+    elif ui == 'light':
+        # Disables features which requires JavaScript. Some feature phones
+        # doesn't support JavaScript.
+        settings.enable_javascript = False
+        # Disables operations which requires Captcha because Captcha requires
+        # JavaScript.
+        settings.enable_captcha = False
+        # Uploading is often not supported in feature phones.
+        settings.enable_photo_upload = False
+        # Disables spam operations because it requires JavaScript and
+        # supporting more pages on ui=light.
+        settings.enable_spam_ops = False
+        # Disables duplicate marking mode because it doesn't support
+        # small screens and it requires JavaScript.
+        settings.enable_dup_mode = False
+        # Hides the logo on the top to save the space. Also, the logo links
+        # to the global page which doesn't support small screens.
+        settings.show_logo = False
+        # Hides language menu because the menu in the current position is
+        # annoying in feature phones.
+        # TODO(ichikawa): Consider layout of the language menu.
+        settings.show_language_menu = False
+        # Too long buttons are not fully shown in some feature phones.
+        settings.use_short_buttons = True
+        # To make it simple.
+        settings.show_record_ids_in_results = False
+
+    return settings.__dict__
+
+# The parts of the env that depend only on the repo, language, UI, and
+# settings are computed once and kept here (see get_env_fragment).
+ENV_FRAGMENT_CACHE = resources.RamCache(max_entries=1000)
+
+def get_env_fragment(env):
+    """Gets the parts of the env that are the same for every request with the
+    same repo, language, UI, and settings version.  Returns a Struct whose
+    'vars' are ready to be copied into the env, and whose other attributes
+    are used by setup_env to compute request-dependent variables."""
+    cache_key = (env.repo, env.lang, env.ui, config.get_version())
+    fragment = ENV_FRAGMENT_CACHE.get(cache_key)
+    if fragment is None:
+        fragment = make_env_fragment(env)
+        ENV_FRAGMENT_CACHE.put(cache_key, fragment, config.cache.expiry_time)
+    return fragment
+
+def make_env_fragment(env):
+    """Computes the value returned by get_env_fragment."""
+    fragment = utils.Struct(vars=get_ui_settings(env.ui))
+    vars = utils.Struct()
 
     # We sometimes want to disable analytics/maps for requests from a specific
     # mobile carrier (specified by IP ranges).
     # In this way, we can avoid requests to sites outside google.org, and
     # allow the carrier to zero-rate access to Person Finder.
     # TODO(ichikawa): Add server test for this feature.
-    #
-    # TODO(kpy): Make these global config settings and get rid of get_secret().
-
-    if utils.is_ip_address_in_one_of_networks(
-            request.remote_addr, env.config.ip_networks_to_disable_analytics):
-        env.analytics_id = None
-    else:
-        env.analytics_id = get_secret('analytics_id')
-
-    if utils.is_ip_address_in_one_of_networks(
-            request.remote_addr, env.config.ip_networks_to_disable_maps):
-        env.maps_api_key = None
-    else:
-        env.maps_api_key = get_secret('maps_api_key')
+    fragment.analytics_networks = utils.get_ip_network_matcher(
+        env.config.ip_networks_to_disable_analytics or [])
+    fragment.maps_networks = utils.get_ip_network_matcher(
+        env.config.ip_networks_to_disable_maps or [])
 
     # Internationalization-related stuff.
-    env.charset = select_charset(request)
-    env.lang = select_lang(request, env.config)
-    env.rtl = env.lang in django_setup.LANGUAGES_BIDI
-    env.virtual_keyboard_layout = const.VIRTUAL_KEYBOARD_LAYOUTS.get(env.lang)
-
-    # Used for parsing query params. This must be done before accessing any
-    # query params which may have multi-byte value, such as "given_name" below
-    # in this function.
-    request.charset = env.charset
-
-    # Determine the resource bundle to use.
-    env.default_resource_bundle = config.get('default_resource_bundle', '1')
-    env.resource_bundle = (request.cookies.get('resource_bundle', '') or
-                           env.default_resource_bundle)
-
-    # Information about the request.
-    env.url = utils.set_url_param(request.url, 'lang', env.lang)
-    env.scheme, env.netloc, env.path, _, _ = urlparse.urlsplit(request.url)
-    env.force_https = False
-    env.domain = env.netloc.split(':')[0]
-    env.global_url = utils.get_repo_url(request, 'global')
+    vars.rtl = env.lang in django_setup.LANGUAGES_BIDI
+    vars.virtual_keyboard_layout = const.VIRTUAL_KEYBOARD_LAYOUTS.get(env.lang)
 
     # Commonly used information that's rendered or localized for templates.
-    env.language_options = get_language_options(request, env.config)
-    env.repo_options = get_repo_options(request, env.lang)
-    env.expiry_options = [
+    fragment.language_endonyms = get_language_endonyms(env.config)
+    fragment.repo_titles = get_repo_titles(env.lang)
+    vars.expiry_options = [
         utils.Struct(value=value, text=const.PERSON_EXPIRY_TEXT[value])
         for value in sorted(const.PERSON_EXPIRY_TEXT.keys(), key=int)
     ]
-    env.status_options = [
+    vars.status_options = [
         utils.Struct(value=value, text=const.NOTE_STATUS_TEXT[value])
         for value in pfif.NOTE_STATUS_VALUES
         if (value != 'believed_dead' or
             not env.config or env.config.allow_believed_dead_via_ui)
     ]
-    env.hidden_input_tags_for_preserved_query_params = (
-        get_hidden_input_tags_for_preserved_query_params(request))
+
+    # Repo-specific information.
+    vars.force_https = False
+    if env.repo:
+        vars.repo_title = get_localized_message(
+            env.config.repo_titles, env.lang, '?')
+        vars.start_page_custom_html = get_localized_message(
+            env.config.start_page_custom_htmls, env.lang, '')
+        vars.results_page_custom_html = get_localized_message(
+            env.config.results_page_custom_htmls, env.lang, '')
+        vars.view_page_custom_html = get_localized_message(
+            env.config.view_page_custom_htmls, env.lang, '')
+        vars.seek_query_form_custom_html = get_localized_message(
+            env.config.seek_query_form_custom_htmls, env.lang, '')
+        vars.footer_custom_html = get_localized_message(
+            env.config.footer_custom_htmls, env.lang, '')
+        # If the repository is deactivated, we should not show test mode
+        # notification.
+        vars.repo_test_mode = (
+            env.config.test_mode and not env.config.deactivated)
+        vars.force_https = env.config.force_https
+
+    fragment.vars.update(vars.__dict__)
+    return fragment
+
+def setup_env(request):
+    """Constructs the 'env' object, which contains various template variables
+    that are commonly used by most handlers.  Set the 'log_setup_env_time'
+    setting to log how long this takes."""
+    start_time = time.time()
+    env = utils.Struct()
+    env.repo, env.action = get_repo_and_action(request)
+    env.config = config.Configuration(env.repo or '*')
+    # TODO(ryok): Rename to local_test_mode or something alike to disambiguate
+    # better from repository's test_mode.
+    env.test_mode = (request.remote_addr == '127.0.0.1' and
+                     request.get('test_mode'))
+
+    # Internationalization-related stuff.
+    env.charset = select_charset(request)
+    env.lang = select_lang(request, env.config)
+
+    # Used for parsing query params. This must be done before accessing any
+    # query params which may have multi-byte value, such as "given_name" below
+    # in this function.
+    request.charset = env.charset
 
     ui_param = request.get('ui', '').strip().lower()
 
@@ -329,59 +437,41 @@ def setup_env(request):
     else:
         env.ui = 'default'
 
-    # UI configurations.
-    #
-    # Enables features which require JavaScript.
-    env.enable_javascript = True
-    # Enables operations which requires Captcha.
-    env.enable_captcha = True
-    # Enables photo upload.
-    env.enable_photo_upload = True
-    # Enables to flag/unflag notes as spam, and to reveal spam notes.
-    env.enable_spam_ops = True
-    # Enables duplicate marking mode.
-    env.enable_dup_mode = True
-    # Shows a logo on top of the page.
-    env.show_logo = True
-    # Shows language menu.
-    env.show_language_menu = True
-    # Uses short labels for buttons.
-    env.use_short_buttons = False
-    # Optional "target" attribute for links to non-small pages.
-    env.target_attr = ''
-    # Shows record IDs in the results page.
-    env.show_record_ids_in_results = True
+    # Everything that doesn't depend on the request itself.
+    misses = ENV_FRAGMENT_CACHE.misses
+    fragment = get_env_fragment(env)
+    env.__dict__.update(fragment.vars)
 
-    if env.ui == 'small':
-        env.show_logo = False
-        env.target_attr = ' target="_blank" '
+    # Analytics and maps may be disabled for some networks (see
+    # make_env_fragment).
+    # TODO(kpy): Make these global config settings and get rid of get_secret().
+    if request.remote_addr in fragment.analytics_networks:
+        env.analytics_id = None
+    else:
+        env.analytics_id = get_secret('analytics_id')
 
-    elif env.ui == 'light':
-        # Disables features which requires JavaScript. Some feature phones
-        # doesn't support JavaScript.
-        env.enable_javascript = False
-        # Disables operations which requires Captcha because Captcha requires
-        # JavaScript.
-        env.enable_captcha = False
-        # Uploading is often not supported in feature phones.
-        env.enable_photo_upload = False
-        # Disables spam operations because it requires JavaScript and
-        # supporting more pages on ui=light.
-        env.enable_spam_ops = False
-        # Disables duplicate marking mode because it doesn't support
-        # small screens and it requires JavaScript.
-        env.enable_dup_mode = False
-        # Hides the logo on the top to save the space. Also, the logo links
-        # to the global page which doesn't support small screens.
-        env.show_logo = False
-        # Hides language menu because the menu in the current position is
-        # annoying in feature phones.
-        # TODO(ichikawa): Consider layout of the language menu.
-        env.show_language_menu = False
-        # Too long buttons are not fully shown in some feature phones.
-        env.use_short_buttons = True
-        # To make it simple.
-        env.show_record_ids_in_results = False
+    if request.remote_addr in fragment.maps_networks:
+        env.maps_api_key = None
+    else:
+        env.maps_api_key = get_secret('maps_api_key')
+
+    # Determine the resource bundle to use.
+    env.default_resource_bundle = config.get('default_resource_bundle', '1')
+    env.resource_bundle = (request.cookies.get('resource_bundle', '') or
+                           env.default_resource_bundle)
+
+    # Information about the request.
+    env.url = utils.set_url_param(request.url, 'lang', env.lang)
+    env.scheme, env.netloc, env.path, _, _ = urlparse.urlsplit(request.url)
+    env.domain = env.netloc.split(':')[0]
+    env.global_url = utils.get_repo_url(request, 'global')
+
+    # Commonly used information that's rendered or localized for templates.
+    env.language_options = get_language_options(
+        request, fragment.language_endonyms)
+    env.repo_options = get_repo_options(request, fragment.repo_titles)
+    env.hidden_input_tags_for_preserved_query_params = (
+        get_hidden_input_tags_for_preserved_query_params(request))
 
     env.back_chevron = u'\xab'
     back_chevron_in_charset = True
@@ -409,23 +499,6 @@ def setup_env(request):
         # user agents when ui parameter is not specified.
         env.default_ui_url = utils.get_url(request, env.repo, '', ui='default')
         env.repo_path = urlparse.urlsplit(env.repo_url)[2]
-        env.repo_title = get_localized_message(
-            env.config.repo_titles, env.lang, '?')
-        env.start_page_custom_html = get_localized_message(
-            env.config.start_page_custom_htmls, env.lang, '')
-        env.results_page_custom_html = get_localized_message(
-            env.config.results_page_custom_htmls, env.lang, '')
-        env.view_page_custom_html = get_localized_message(
-            env.config.view_page_custom_htmls, env.lang, '')
-        env.seek_query_form_custom_html = get_localized_message(
-            env.config.seek_query_form_custom_htmls, env.lang, '')
-        env.footer_custom_html = get_localized_message(
-            env.config.footer_custom_htmls, env.lang, '')
-        # If the repository is deactivated, we should not show test mode
-        # notification.
-        env.repo_test_mode = (
-            env.config.test_mode and not env.config.deactivated)
-        env.force_https = env.config.force_https
 
         env.params_full_name = request.get('full_name', '').strip()
         if not env.params_full_name:
@@ -435,16 +508,26 @@ def setup_env(request):
             env.params_full_name = utils.get_full_name(
                 given_name, family_name, env.config)
 
+    if env.config.log_setup_env_time:
+        logging.info('setup_env took %.1f ms (env fragment %s)' % (
+            (time.time() - start_time)*1000,
+            ENV_FRAGMENT_CACHE.misses > misses and 'computed' or 'cached'))
     return env
 
 def flush_caches(*keywords):
     """Flushes the specified set of caches.  Pass '*' to flush everything."""
     if '*' in keywords or 'resource' in keywords:
        resources.clear_caches()
+    if '*' in keywords or 'env' in keywords or [
+        keyword for keyword in keywords if keyword.startswith('config')]:
+       ENV_FRAGMENT_CACHE.clear()
     if '*' in keywords or 'memcache' in keywords:
        memcache.flush_all()
     if '*' in keywords or 'config' in keywords:
        config.cache.flush()
+    if '*' in keywords or 'auth' in keywords:
+       model.authorization_cache.flush()
+       model.secret_cache.flush()
     for keyword in keywords:
         if keyword.startswith('config/'):
             config.cache.delete(keyword[7:])
@@ -470,6 +553,9 @@ class Main(webapp.RequestHandler):
         # If requested, flush caches before we touch anything that uses them.
         flush_caches(*request.get('flush', '').split(','))
 
+        # Settings are read from one snapshot for the rest of the request.
+        config.request_settings.start()
+
         # check for legacy redirect:
         # TODO(lschumacher|kpy): remove support for legacy URLS Q1 2012.
         if legacy_redirect.do_redirect(self):
@@ -500,6 +586,16 @@ class Main(webapp.RequestHandler):
         resources.set_active_bundle_name(self.env.resource_bundle)
 
     def serve(self):
+        # Audit log entries written by the handler are stored in one batch
+        # once the handler has finished.
+        model.log_buffer.start()
+        try:
+            self.dispatch_action()
+        finally:
+            model.log_buffer.flush()
+            config.request_settings.stop()
+
+    def dispatch_action(self):
         request, response, env = self.request, self.response, self.env
         if not env.action and not env.repo:
             # Redirect to the default home page.
@@ -518,15 +614,21 @@ class Main(webapp.RequestHandler):
             # Serve a static page or file.
             env.robots_ok = True
             get_vars = lambda: {'env': env, 'config': env.config}
-            content = resources.get_rendered(
+            rendering = resources.get_rendering(
                 env.action, env.lang, (env.repo, env.charset), get_vars)
-            if content is None:
+            if rendering is None:
                 response.set_status(404)
                 response.out.write('Not found')
             else:
                 content_type, encoding = mimetypes.guess_type(env.action)
                 response.headers['Content-Type'] = content_type or 'text/plain'
-                response.out.write(content)
+                # A URL with a hash of the content (see resources.
+                # get_hashed_url) always yields the same content.
+                max_age = None
+                if request.get('v') == rendering.get_hash():
+                    max_age = HASHED_URL_MAX_AGE_SECONDS
+                utils.write_variant(request, response,
+                                    rendering.get_variant(), max_age)
 
     def get(self):
         self.serve()
@@ -539,5 +641,7 @@ class Main(webapp.RequestHandler):
         self.serve()
         self.response.clear()
 
+application = webapp.WSGIApplication([('.*', Main)])
+
 if __name__ == '__main__':
-    webapp.util.run_wsgi_app(webapp.WSGIApplication([('.*', Main)]))
+    webapp.util.run_wsgi_app(application)
@@ -18,6 +18,12 @@
 __author__ = 'kpy@google.com (Ka-Ping Yee) and many other Googlers'
 
 from datetime import timedelta
+import hashlib
+import logging
+import random
+import threading
+import time
+import uuid
 
 from google.appengine.api import datastore_errors
 from google.appengine.api import memcache
@@ -153,26 +159,64 @@ class Base(db.Model):
     # NOTE: is_expired should ONLY be modified in Person.put_expiry_flags().
     is_expired = db.BooleanProperty(required=False, default=False)
 
+    # A hash of the CONTENT_FIELDS as of the last import, so that re-importing
+    # an unchanged record can skip the write.  Only the importer sets this.
+    content_fingerprint = db.StringProperty(default='', indexed=False)
+
+    # Names of the fields covered by content_fingerprint (see subclasses).
+    CONTENT_FIELDS = []
+
+    def get_content_fingerprint(self):
+        """Returns a short string that changes whenever the value of any of
+        the CONTENT_FIELDS does."""
+        parts = []
+        for name in self.CONTENT_FIELDS:
+            value = getattr(self, name)
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            parts.append('%s=%r' % (name, value))
+        return hashlib.sha1('\n'.join(parts)).hexdigest()
+
+    def get_photo_rendition_url(self, size):
+        """Returns the URL of the given rendition ('thumb', 'medium', or
+        'full') of this record's photo.  Only photos hosted by this app have
+        smaller renditions; other photo URLs are returned unchanged."""
+        import utils
+        if size != 'full' and type(self).photo.get_value_for_datastore(self):
+            return utils.set_url_param(self.photo_url, 'size', size)
+        return self.photo_url
+
+    @property
+    def photo_thumbnail_url(self):
+        return self.get_photo_rendition_url('thumb')
+
+    @property
+    def photo_medium_url_no_scheme(self):
+        import utils
+        return utils.strip_url_scheme(self.get_photo_rendition_url('medium'))
+
     @classmethod
-    def all(cls, keys_only=False, filter_expired=True):
+    def all(cls, keys_only=False, filter_expired=True, projection=None):
         """Returns a query for all records of this kind; by default this
         filters out the records marked as expired.
 
         Args:
           keys_only - If true, return only the keys.
           filter_expired - If true, omit records with is_expired == True.
+          projection - If given, a list of the only properties to fetch.
         Returns:
           query - A Query object for the results.
         """
-        query = super(Base, cls).all(keys_only=keys_only)
+        query = super(Base, cls).all(keys_only=keys_only, projection=projection)
         if filter_expired:
             query.filter('is_expired =', False)
         return query
 
     @classmethod
-    def all_in_repo(cls, repo, filter_expired=True):
+    def all_in_repo(cls, repo, filter_expired=True, projection=None):
         """Gets a query for all entities in a given repository."""
-        return cls.all(filter_expired=filter_expired).filter('repo =', repo)
+        return cls.all(filter_expired=filter_expired, projection=projection
+                       ).filter('repo =', repo)
 
     def get_record_id(self):
         """Returns the record ID of this record."""
@@ -219,13 +263,13 @@ class Base(db.Model):
         # which is more consitent with repo id format.
         record_id = '%s.%s/%s.%d' % (
             repo, HOME_DOMAIN, cls.__name__.lower(), UniqueId.create_id())
-        return cls(key_name=repo + ':' + record_id, repo=repo, **kwargs)
+        return cls._create(repo, record_id, **kwargs)
 
     @classmethod
     def create_clone(cls, repo, record_id, **kwargs):
         """Creates a new clone entity with the given field values."""
         assert is_clone(repo, record_id)
-        return cls(key_name=repo + ':' + record_id, repo=repo, **kwargs)
+        return cls._create(repo, record_id, **kwargs)
 
     # TODO(kpy): Rename this function (maybe to create_with_record_id?).
     @classmethod
@@ -234,6 +278,12 @@ class Base(db.Model):
         values, overwriting any existing entity with the same record_id.
         This should be rarely used in practice (e.g. for an administrative
         import into a home repository), hence the long method name."""
+        return cls._create(repo, record_id, **kwargs)
+
+    @classmethod
+    def _create(cls, repo, record_id, **kwargs):
+        """Creates an entity with the given record_id and field values.  All
+        the create_* methods go through here."""
         return cls(key_name=repo + ':' + record_id, repo=repo, **kwargs)
 
 
@@ -250,6 +300,14 @@ class Person(Base):
     """
     # If you add any new fields, be sure they are handled in wipe_contents().
 
+    CONTENT_FIELDS = [
+        'expiry_date', 'author_name', 'author_email', 'author_phone',
+        'source_name', 'source_url', 'source_date', 'full_name', 'given_name',
+        'family_name', 'alternate_names', 'description', 'sex',
+        'date_of_birth', 'age', 'home_street', 'home_neighborhood',
+        'home_city', 'home_state', 'home_postal_code', 'home_country',
+        'photo_url', 'profile_urls']
+
     # entry_date should update every time a record is created or re-imported.
     entry_date = db.DateTimeProperty(required=True)
     expiry_date = db.DateTimeProperty(required=False)
@@ -314,6 +372,11 @@ class Person(Base):
 
     # attributes used by indexing.py
     names_prefixes = db.StringListProperty()
+    # The indexing.INDEX_VERSION that produced names_prefixes, and a
+    # fingerprint of the tokens, so that re-indexing can skip records whose
+    # tokens would not change.
+    index_version = db.IntegerProperty(default=0, indexed=False)
+    index_fingerprint = db.StringProperty(default='', indexed=False)
     # TODO(ryok): index address components.
     _fields_to_index_properties = ['given_name', 'family_name', 'full_name']
     _fields_to_index_by_prefix_properties = ['given_name', 'family_name',
@@ -500,9 +563,20 @@ class Person(Base):
         note_photos = [Note.photo.get_value_for_datastore(n) for n in notes]
 
         entities_to_delete = filter(None, notes + [photo] + note_photos)
+        memcache_keys = []
+        for photo_key in filter(None, [photo] + note_photos):
+            entities_to_delete += PhotoRendition.get_keys_for_photo(photo_key)
+            memcache_keys += Photo.get_memcache_keys(photo_key)
+        deleted_records = notes[:]
         if delete_self:
             entities_to_delete.append(self)
+            deleted_records.append(self)
         db.delete(entities_to_delete)
+        # Stop serving the deleted photos from memcache.
+        memcache.delete_multi(memcache_keys)
+        # Leave a Tombstone for each record so mirrors learn of the deletion.
+        db.put([Tombstone.create_for_record(record)
+                for record in deleted_records])
 
     def update_from_note(self, note):
         """Updates any necessary fields on the Person to reflect a new Note."""
@@ -553,6 +627,19 @@ class Note(Base):
     """The datastore entity kind for storing a PFIF note record.  Never call
     Note() directly; use Note.create_clone() or Note.create_original()."""
 
+    CONTENT_FIELDS = [
+        'person_record_id', 'linked_person_record_id', 'author_name',
+        'author_email', 'author_phone', 'source_date', 'status',
+        'author_made_contact', 'email_of_found_person',
+        'phone_of_found_person', 'last_known_location', 'text', 'photo_url']
+
+    # Notes that agree on all these fields are considered duplicates.
+    MATCH_FIELDS = [
+        'person_record_id', 'author_name', 'author_email', 'author_phone',
+        'source_date', 'status', 'author_made_contact',
+        'email_of_found_person', 'phone_of_found_person',
+        'last_known_location', 'text', 'photo_url']
+
     # The entry_date should update every time a record is re-imported.
     entry_date = db.DateTimeProperty(required=True)
 
@@ -592,6 +679,41 @@ class Note(Base):
     # True if the note has been reviewed for spam content at /admin/review.
     reviewed = db.BooleanProperty(default=False)
 
+    # Time of the last change to this entity (e.g. hiding it), for api/changes.
+    last_modified = db.DateTimeProperty(auto_now=True)
+
+    # A hash of the MATCH_FIELDS, set when the Note is created, so that
+    # duplicates of a Note can be found with an equality query.
+    match_fingerprint = db.StringProperty(default='')
+
+    # The domain of the person_record_id, so that /admin/review can filter
+    # by source with an equality filter and still order by entry_date.
+    source_domain = db.StringProperty(default='')
+
+    @classmethod
+    def _create(cls, repo, record_id, **kwargs):
+        note = super(Note, cls)._create(repo, record_id, **kwargs)
+        note.match_fingerprint = note.get_match_fingerprint()
+        note.source_domain = note.get_source_domain()
+        return note
+
+    def get_source_domain(self):
+        """Returns the domain name of the Person this Note belongs to."""
+        return (self.person_record_id or '').split('/', 1)[0]
+
+    def get_match_fingerprint(self):
+        """Returns a short string that is the same for Notes that agree on
+        all the MATCH_FIELDS, ignoring surrounding whitespace and treating a
+        missing string as empty."""
+        parts = []
+        for name in self.MATCH_FIELDS:
+            value = getattr(self, name)
+            if isinstance(self.properties()[name],
+                          (db.StringProperty, db.TextProperty)):
+                value = (value or u'').strip().encode('utf-8')
+            parts.append('%s=%r' % (name, value))
+        return hashlib.sha1('\n'.join(parts)).hexdigest()
+
     def get_note_record_id(self):
         return self.record_id
     note_record_id = property(get_note_record_id)
@@ -632,6 +754,28 @@ class NoteWithBadWords(Note):
     # delete the notes with bad words, even when they are confirmed.
     confirmed_copy_id = db.StringProperty(default='')
 
+class Tombstone(db.Model):
+    """A marker left behind when a Person or Note is permanently deleted, so
+    that api/changes can report the deletion.  Key name: repo + ':' +
+    record_kind + ':' + record_id.  Tombstones are deleted by
+    tasks/delete_old after TTL."""
+    TTL = timedelta(days=30)
+
+    repo = db.StringProperty(required=True)
+    record_kind = db.StringProperty(required=True, choices=['Person', 'Note'])
+    record_id = db.StringProperty(required=True)
+    # Named like Person.last_modified so api/changes can query all the same.
+    last_modified = db.DateTimeProperty(auto_now=True)
+
+    @staticmethod
+    def create_for_record(record):
+        """Creates a Tombstone for a Person or Note entity."""
+        kind = record.kind()
+        return Tombstone(
+            key_name='%s:%s:%s' % (record.repo, kind, record.record_id),
+            repo=record.repo, record_kind=kind, record_id=record.record_id)
+
+
 class Photo(db.Model):
     """An uploaded image file.  Key name: repo + ':' + photo_id."""
 
@@ -640,6 +784,10 @@ class Photo(db.Model):
     repo = db.StringProperty(required=True)
     image_data = db.BlobProperty()  # sanitized, resized image in PNG format
     upload_date = db.DateTimeProperty(auto_now_add=True)
+    # Dimensions of image_data in pixels (None for photos stored before
+    # these properties were added).
+    width = db.IntegerProperty()
+    height = db.IntegerProperty()
 
     @staticmethod
     def create(repo, **kwargs):
@@ -651,6 +799,108 @@ class Photo(db.Model):
     def get(repo, id):
         return Photo.get_by_key_name('%s:%s' % (repo, id))
 
+    @staticmethod
+    def get_memcache_key(repo, id, size):
+        """Gets the memcache key for the data of one size ('full' or one of
+        PhotoRendition.SIZES) of a photo, as served by photo.Handler."""
+        return 'photo:%s:%s:%s' % (repo, id, size)
+
+    @staticmethod
+    def get_memcache_keys(photo_key):
+        """Gets the memcache keys for all the sizes of a Photo."""
+        repo, id = photo_key.name().split(':', 1)
+        return [Photo.get_memcache_key(repo, id, size)
+                for size in PhotoRendition.SIZES + ['full']]
+
+
+class PhotoRendition(db.Model):
+    """A smaller copy of an uploaded Photo, generated in the background after
+    the Photo is stored.  Key name: repo + ':' + photo_id + ':' + size."""
+    SIZES = ['thumb', 'medium']
+
+    repo = db.StringProperty(required=True)
+    image_data = db.BlobProperty()
+    content_type = db.StringProperty(default='image/jpeg')
+    width = db.IntegerProperty()
+    height = db.IntegerProperty()
+
+    @staticmethod
+    def create(repo, photo_id, size, **kwargs):
+        """Creates a PhotoRendition entity with the given field values."""
+        return PhotoRendition(key_name='%s:%s:%s' % (repo, photo_id, size),
+                              repo=repo, **kwargs)
+
+    @staticmethod
+    def get(repo, photo_id, size):
+        return PhotoRendition.get_by_key_name(
+            '%s:%s:%s' % (repo, photo_id, size))
+
+    @staticmethod
+    def get_keys_for_photo(photo_key):
+        """Gets the keys of all the possible renditions of a Photo."""
+        return [db.Key.from_path('PhotoRendition',
+                                 '%s:%s' % (photo_key.name(), size))
+                for size in PhotoRendition.SIZES]
+
+
+class EntityCache:
+    """A per-instance cache of the entities of one kind, by key name.  An
+    entity is kept for ttl_seconds, and the absence of an entity for
+    negative_ttl_seconds.  invalidate() increments a version number in
+    memcache, which makes every instance drop its cached entities within
+    VERSION_CHECK_SECONDS.  The cached entities are shared by all requests,
+    so callers must not modify them."""
+    VERSION_CHECK_SECONDS = 2
+
+    def __init__(self, model_class, ttl_seconds, negative_ttl_seconds):
+        self.model_class = model_class
+        self.ttl_seconds = ttl_seconds
+        self.negative_ttl_seconds = negative_ttl_seconds
+        self.version_key = model_class.kind() + '_cache_version'
+        self.entries = {}  # key name -> (entity or None, expiry time)
+        self.version = None  # the last version number seen in memcache
+        self.version_check_time = 0  # when we last looked at the version
+        self.lock = threading.RLock()  # guards all of the above
+
+    def flush(self):
+        with self.lock:
+            self.entries.clear()
+
+    def check_version(self):
+        """Flushes the cache if invalidate() has been called on any instance
+        since the last check, checking at most every VERSION_CHECK_SECONDS."""
+        now = time.time()
+        with self.lock:
+            if now < self.version_check_time + self.VERSION_CHECK_SECONDS:
+                return
+            self.version_check_time = now
+        version = memcache.get(self.version_key)
+        with self.lock:
+            if version != self.version:
+                self.entries.clear()
+                self.version = version
+
+    def get(self, key_name):
+        """Gets the entity with the given key name, or None if there is no
+        such entity, from the cache or else from the datastore."""
+        self.check_version()
+        now = time.time()
+        with self.lock:
+            entity, expiry = self.entries.get(key_name, (None, 0))
+            if now < expiry:
+                return entity
+        entity = self.model_class.get_by_key_name(key_name)
+        ttl = entity and self.ttl_seconds or self.negative_ttl_seconds
+        with self.lock:
+            self.entries[key_name] = (entity, now + ttl)
+        return entity
+
+    def invalidate(self):
+        """Drops the cached entities on all instances.  Call this after
+        storing or deleting an entity of this kind."""
+        self.flush()
+        memcache.incr(self.version_key, initial_value=0)
+
 
 class Authorization(db.Model):
     """Authorization keys.  Key name: repo + ':' + auth_key."""
@@ -718,6 +968,12 @@ class Authorization(db.Model):
         """Gets the Authorization entity for a given repository and key."""
         return cls.get_by_key_name(repo + ':' + key)
 
+    @classmethod
+    def get_cached(cls, repo, key):
+        """Like get(), but from authorization_cache, for checking the key
+        on each API request.  The result must not be modified."""
+        return authorization_cache.get(repo + ':' + key)
+
     @classmethod
     def create(cls, repo, key, **kwargs):
         """Creates an Authorization entity for a given repository and key."""
@@ -746,6 +1002,15 @@ class Secret(db.Model):
     """A place to store application-level secrets in the database."""
     secret = db.BlobProperty()
 
+# Changes made in admin/api_keys take effect on all instances at once, but an
+# unknown key is looked up again soon, in case it was just put in place by
+# other means.  Secrets rarely change, so they can be kept longer, but they
+# are usually put in place from the console, so a missing Secret is looked
+# up again every time.
+authorization_cache = EntityCache(Authorization, 60, 10)
+secret_cache = EntityCache(Secret, 600, 0)
+
+
 def encode_count_name(count_name):
     """Encode a name to printable ASCII characters so it can be safely
     used as an attribute name for the datastore."""
@@ -792,7 +1057,9 @@ class ApiActionLog(db.Model):
                       timestamp=None):
         import utils
         try:
-            ApiActionLog(repo=repo,
+            log_buffer.add(ApiActionLog(
+                         key_name=new_log_key_name(),
+                         repo=repo,
                          api_key=api_key,
                          action=action,
                          person_records=person_records,
@@ -803,7 +1070,7 @@ class ApiActionLog(db.Model):
                          ip_address=ip_address,
                          request_url=request_url,
                          version=version,
-                         timestamp=timestamp or utils.get_utcnow()).put()
+                         timestamp=timestamp or utils.get_utcnow()))
         except Exception:
             # swallow anything to prevent the main action from failing.
             pass
@@ -893,6 +1160,82 @@ class Counter(db.Expando):
         return counter
 
 
+class ReviewQueueCount(db.Model):
+    """One shard of the sizes of the /admin/review queues for a repository,
+    which are kept up to date as Notes are created, reviewed and flagged.
+    The shards are summed by api/stats, and replaced with exact counts each
+    time tasks/count/note finishes a scan.  Key name: repo + ':' + shard."""
+    NUM_SHARDS = 10
+
+    # The count names that api/stats reports for each queue.
+    QUEUE_NAMES = {
+        'hidden': 'hidden=TRUE',
+        'reviewed': 'hidden=FALSE,reviewed=TRUE',
+        'unreviewed': 'hidden=FALSE,reviewed=FALSE'
+    }
+
+    repo = db.StringProperty(required=True)
+    hidden = db.IntegerProperty(default=0)
+    reviewed = db.IntegerProperty(default=0)  # not hidden and reviewed
+    unreviewed = db.IntegerProperty(default=0)  # not hidden and not reviewed
+
+    @staticmethod
+    def get_queue(note):
+        """Gets the name of the queue that a Note is counted in, or None if
+        the Note is not counted because it has expired."""
+        if note.is_expired:
+            return None
+        if note.hidden:
+            return 'hidden'
+        return note.reviewed and 'reviewed' or 'unreviewed'
+
+    @classmethod
+    def update(cls, repo, old_queues=(), new_queues=()):
+        """Removes one Note from each queue named in old_queues and adds one
+        Note to each queue named in new_queues.  None entries are ignored."""
+        deltas = {}
+        for queue in old_queues:
+            deltas[queue] = deltas.get(queue, 0) - 1
+        for queue in new_queues:
+            deltas[queue] = deltas.get(queue, 0) + 1
+        deltas.pop(None, None)
+        if not any(deltas.values()):
+            return
+        key_name = '%s:%d' % (repo, random.randrange(cls.NUM_SHARDS))
+        def add_deltas():
+            shard = cls.get_by_key_name(key_name) or cls(
+                key_name=key_name, repo=repo)
+            for queue, delta in deltas.items():
+                setattr(shard, queue, getattr(shard, queue) + delta)
+            shard.put()
+        try:
+            db.run_in_transaction(add_deltas)
+        except db.TransactionFailedError:
+            # The next run of tasks/count/note will correct the counts.
+            logging.warn('Failed to update review queue counts: %r' % deltas)
+
+    @classmethod
+    def get_counts(cls, repo):
+        """Gets a dictionary of the queue sizes for a repository, keyed by the
+        names in QUEUE_NAMES.values(), or an empty dictionary if the queues
+        have not been counted yet."""
+        counts = {}
+        for shard in cls.all().filter('repo =', repo):
+            for queue, name in cls.QUEUE_NAMES.items():
+                counts[name] = counts.get(name, 0) + getattr(shard, queue)
+        return counts
+
+    @classmethod
+    def reset(cls, repo, counts):
+        """Replaces the queue sizes for a repository with the given counts,
+        a dictionary keyed by the names in QUEUE_NAMES.values()."""
+        db.delete(list(cls.all(keys_only=True).filter('repo =', repo)))
+        shard = cls(key_name='%s:0' % repo, repo=repo)
+        for queue, name in cls.QUEUE_NAMES.items():
+            setattr(shard, queue, counts.get(name, 0))
+        shard.put()
+
+
 class Subscription(db.Model):
     """Subscription to notifications when a note is added to a person record"""
     repo = db.StringProperty(required=True)
@@ -923,6 +1266,30 @@ class Subscription(db.Model):
         return query.fetch(limit)
 
 
+class PendingNotification(db.Model):
+    """A status update about a new note, waiting to be sent to a subscriber
+    as part of a digest.  These are stored only when the repository has
+    notification_digest_minutes set, and deleted once they are sent."""
+    repo = db.StringProperty(required=True)
+    person_record_id = db.StringProperty(required=True)  # the note's person
+    note_record_id = db.StringProperty(required=True)
+    email = db.StringProperty(required=True)
+    subscribed_person_record_id = db.StringProperty(required=True)
+    language = db.StringProperty(required=True)
+    repo_url = db.StringProperty(required=True)  # for links in the digest
+    timestamp = db.DateTimeProperty(required=True)
+
+    @staticmethod
+    def create(repo, person_record_id, note_record_id, email, **kwargs):
+        """Creates a new PendingNotification.  Queueing the same note for
+        the same subscriber twice yields only one entity."""
+        key_name = '%s:%s:%s:%s' % (
+            repo, person_record_id, note_record_id, email)
+        return PendingNotification(
+            key_name=key_name, repo=repo, person_record_id=person_record_id,
+            note_record_id=note_record_id, email=email, **kwargs)
+
+
 class UserActionLog(db.Expando):
     """Logs user actions."""
     time = db.DateTimeProperty(required=True)
@@ -944,6 +1311,7 @@ class UserActionLog(db.Expando):
         import utils
         kind = entity.kind()
         entry = cls(
+            key_name=new_log_key_name(),
             time=utils.get_utcnow(), repo=entity.repo, action=action,
             entity_kind=kind, entity_key_name=entity.key().name(),
             detail=detail, ip_address=ip_address)
@@ -954,7 +1322,7 @@ class UserActionLog(db.Expando):
                 if isinstance(value, db.Model):
                     value = value.key()
                 setattr(entry, kind + '_' + name, value)
-        entry.put()
+        log_buffer.add(entry)
 
 
 class UserAgentLog(db.Model):
@@ -968,6 +1336,72 @@ class UserAgentLog(db.Model):
     sample_rate = db.FloatProperty()
 
 
+def new_log_key_name():
+    """Returns a unique key name for a new log entry.  Log entries get their
+    keys before they are written, so that retrying a batch put can never store
+    the same entry twice."""
+    return uuid.uuid4().hex
+
+
+class LogBuffer(threading.local):
+    """Collects the ApiActionLog, UserActionLog, and UserAgentLog entities
+    written while handling a request, so that they are stored together in one
+    batch put at the end of the request instead of one put at a time on the
+    critical path.  Outside of a request (i.e. before start() is called, as in
+    tasks run from tools), entities are written immediately.  Each thread has
+    its own buffer, so concurrent requests don't mix their entities."""
+
+    # If a request buffers this many entities, they are sent off in an
+    # asynchronous batch right away instead of growing the buffer further.
+    MAX_BUFFERED = 100
+
+    def __init__(self):
+        self.active = False
+        self.entities = []
+        self.rpcs = []
+
+    def start(self):
+        """Begins buffering log entities for a new request."""
+        self.active = True
+        self.entities = []
+        self.rpcs = []
+
+    def add(self, entity):
+        """Buffers a log entity to be stored when the request is finished."""
+        if not self.active:
+            entity.put()
+            return
+        self.entities.append(entity)
+        if len(self.entities) >= self.MAX_BUFFERED:
+            self.send()
+
+    def send(self):
+        """Starts an asynchronous batch put of the buffered entities."""
+        if self.entities:
+            entities, self.entities = self.entities, []
+            self.rpcs.append((db.put_async(entities), entities))
+
+    def flush(self):
+        """Stores all buffered entities and stops buffering.  Log entries must
+        never cause the request to fail, so errors are logged, not raised."""
+        self.send()
+        for rpc, entities in self.rpcs:
+            try:
+                try:
+                    rpc.get_result()
+                except (db.Timeout, db.InternalError,
+                        datastore_errors.TransactionFailedError):
+                    # Safe to retry: the entities have fixed key names.
+                    db.put(entities)
+            except Exception, e:
+                logging.error('Dropped %d log entries: %s' % (len(entities), e))
+        self.active = False
+        self.entities = []
+        self.rpcs = []
+
+log_buffer = LogBuffer()
+
+
 class StaticSiteMapInfo(db.Model):
     """Holds static sitemaps file info."""
     static_sitemaps = db.StringListProperty()
@@ -990,3 +1424,94 @@ class UniqueId(db.Model):
         unique_id = UniqueId()
         unique_id.put()
         return unique_id.key().id()
+
+
+class ImportJob(db.Model):
+    """A large CSV upload that is being imported in the background by a chain
+    of tasks (see api.ImportWorker).  The uploaded file is kept in
+    ImportJobChunk entities.  key_name: repo + ':' + job_id"""
+    repo = db.StringProperty(required=True)
+    format = db.StringProperty(required=True, choices=['persons', 'notes'])
+    domain = db.StringProperty(required=True)  # the importer's write domain
+    believed_dead_permission = db.BooleanProperty(default=False)
+    chunk_count = db.IntegerProperty(default=0)
+    status = db.StringProperty(
+        default='queued', choices=['queued', 'running', 'done', 'failed'])
+    error = db.TextProperty(default='')
+
+    # The number of rows imported so far.  Each task resumes from here.
+    row_offset = db.IntegerProperty(default=0)
+    row_count = db.IntegerProperty()  # set once the file has been parsed
+    # Byte positions in the file of the end of the header row, and of the row
+    # at row_offset, so that tasks don't have to parse the rows before it.
+    header_end = db.IntegerProperty(default=0)
+    byte_offset = db.IntegerProperty(default=0)
+
+    persons_written = db.IntegerProperty(default=0)
+    persons_unchanged = db.IntegerProperty(default=0)
+    persons_total = db.IntegerProperty(default=0)
+    notes_written = db.IntegerProperty(default=0)
+    notes_unchanged = db.IntegerProperty(default=0)
+    notes_total = db.IntegerProperty(default=0)
+    skipped_count = db.IntegerProperty(default=0)
+    # JSON list of [error_message, record] pairs for the first skipped records
+    skipped_json = db.TextProperty(default='[]')
+
+    created = db.DateTimeProperty(auto_now_add=True)
+    updated = db.DateTimeProperty(auto_now=True)
+
+    # Entities are limited to 1 MB, so the file is split into chunks.
+    CHUNK_BYTES = 900*1000
+
+    @property
+    def job_id(self):
+        return self.key().name().split(':', 1)[1]
+
+    @staticmethod
+    def create(repo, content, **kwargs):
+        """Stores the content of an uploaded file and creates a new ImportJob
+        for it.  The content should be a byte string."""
+        job_id = str(UniqueId.create_id())
+        key_name = repo + ':' + job_id
+        chunk_count = 0
+        for start in range(0, len(content), ImportJob.CHUNK_BYTES):
+            ImportJobChunk(
+                key_name='%s:%d' % (key_name, chunk_count),
+                data=content[start:start + ImportJob.CHUNK_BYTES]).put()
+            chunk_count += 1
+        job = ImportJob(key_name=key_name, repo=repo,
+                        chunk_count=chunk_count, **kwargs)
+        job.put()
+        return job
+
+    @staticmethod
+    def get(repo, job_id):
+        """Gets the ImportJob with the given ID in a given repository."""
+        return ImportJob.get_by_key_name(repo + ':' + job_id)
+
+    def get_content(self, start=0, end=None):
+        """Reassembles the content of the uploaded file, or the part of it
+        from byte position 'start' to 'end', reading only the chunks needed."""
+        if end is None:
+            end = self.chunk_count*ImportJob.CHUNK_BYTES
+        first = start // ImportJob.CHUNK_BYTES
+        last = min((end - 1) // ImportJob.CHUNK_BYTES + 1, self.chunk_count)
+        if first >= last:
+            return ''
+        chunks = ImportJobChunk.get_by_key_name(
+            ['%s:%d' % (self.key().name(), i) for i in range(first, last)])
+        content = ''.join(chunk.data for chunk in chunks)
+        offset = first*ImportJob.CHUNK_BYTES
+        return content[start - offset:end - offset]
+
+    def delete_content(self):
+        """Deletes the uploaded file once it has been imported."""
+        db.delete([db.Key.from_path(
+            'ImportJobChunk', '%s:%d' % (self.key().name(), i))
+            for i in range(self.chunk_count)])
+
+
+class ImportJobChunk(db.Model):
+    """A piece of the file for an ImportJob.
+    key_name: repo + ':' + job_id + ':' + chunk_index"""
+    data = db.BlobProperty()
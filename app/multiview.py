@@ -97,6 +97,7 @@ class Handler(BaseHandler):
 
         if len(ids) > 1:
             notes = []
+            notes_by_person = []
             for person_id in ids:
                 person = Person.get(self.repo, person_id)
                 person_notes = []
@@ -112,14 +113,16 @@ class Handler(BaseHandler):
                         author_email=self.params.author_email,
                         source_date=get_utcnow())
                     person_notes.append(note)
-                # Notify person's subscribers of all new duplicates. We do not
-                # follow links since each Person record in the ids list gets its
-                # own note. However, 1) when > 2 records are marked as
-                # duplicates, subscribers will still receive multiple
-                # notifications, and 2) subscribers to already-linked Persons
-                # will not be notified of the new link.
-                subscribe.send_notifications(self, person, person_notes, False)
+                notes_by_person.append((person, person_notes))
                 notes += person_notes
             # Write all notes to store
             db.put(notes)
+            # Notify person's subscribers of all new duplicates. We do not
+            # follow links since each Person record in the ids list gets its
+            # own note. However, 1) when > 2 records are marked as
+            # duplicates, subscribers will still receive multiple
+            # notifications, and 2) subscribers to already-linked Persons
+            # will not be notified of the new link.
+            for person, person_notes in notes_by_person:
+                subscribe.send_notifications(self, person, person_notes, False)
         self.redirect('/view', id=self.params.id1)
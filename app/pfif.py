@@ -484,12 +484,8 @@ def rename_fields_to_latest(record):
                 record[new] = maybe_convert_other_to_description(record[old])
             del record[old]
 
-def parse_file(pfif_utf8_file, rename_fields=True):
-    """Reads a UTF-8-encoded PFIF file to give a list of person records and a
-    list of note records.  Each record is a plain dictionary of strings,
-    with PFIF 1.4 field names as keys if rename_fields is True; otherwise,
-    the field names are kept as is in the input XML file."""
-    handler = Handler(rename_fields)
+def make_parser(handler):
+    """Makes a SAX parser that sends PFIF events to the given Handler."""
     parser = xml.sax.make_parser()
     parser.setFeature(xml.sax.handler.feature_namespaces, True)
     # Below two are to avoid XML External Entity attacks:
@@ -497,12 +493,46 @@ def parse_file(pfif_utf8_file, rename_fields=True):
     parser.setFeature(xml.sax.handler.feature_external_pes, False)
     parser.setFeature(xml.sax.handler.feature_external_ges, False)
     parser.setContentHandler(handler)
-    parser.parse(pfif_utf8_file)
+    return parser
+
+def parse_file(pfif_utf8_file, rename_fields=True):
+    """Reads a UTF-8-encoded PFIF file to give a list of person records and a
+    list of note records.  Each record is a plain dictionary of strings,
+    with PFIF 1.4 field names as keys if rename_fields is True; otherwise,
+    the field names are kept as is in the input XML file."""
+    handler = Handler(rename_fields)
+    make_parser(handler).parse(pfif_utf8_file)
     if rename_fields:
         for record in handler.person_records + handler.note_records:
             rename_fields_to_latest(record)
     return handler.person_records, handler.note_records
 
+def generate_records(pfif_utf8_file, rename_fields=True, chunk_size=65536):
+    """Reads a UTF-8-encoded PFIF file a chunk at a time, yielding a
+    ('person', record) or ('note', record) pair for each record as soon as it
+    is complete, so that large files can be processed without holding all
+    the records in memory.  The records are as for parse_file."""
+    handler = Handler(rename_fields)
+    parser = make_parser(handler)
+    while True:
+        chunk = pfif_utf8_file.read(chunk_size)
+        if chunk:
+            parser.feed(chunk)
+        else:
+            parser.close()
+        # Notes in a <person> get its person_record_id when it ends, so
+        # wait until no <person> is open before taking the parsed records.
+        if not [tag for tag in handler.tags if check_pfif_tag(tag) == 'person']:
+            for type, records in [('person', handler.person_records),
+                                  ('note', handler.note_records)]:
+                for record in records:
+                    if rename_fields:
+                        rename_fields_to_latest(record)
+                    yield type, record
+                records[:] = []
+        if not chunk:
+            break
+
 def parse(pfif_text, rename_fields=True):
     """Takes the text of a PFIF document, as a Unicode string or UTF-8 string,
     and returns a list of person records and a list of note records.  Each
@@ -15,17 +15,46 @@
 
 """Handler for retrieving uploaded photos for display."""
 
+import hashlib
 import os
+import threading
+import time
 
 import model
 import utils
 
 from django.utils.translation import ugettext_lazy as _
 from google.appengine.api import images
+from google.appengine.api import memcache
+from google.appengine.ext import db
 from google.appengine.runtime.apiproxy_errors import RequestTooLargeError
 
 MAX_IMAGE_DIMENSION = 300
 
+# The largest dimension of each of the smaller renditions that are generated
+# for an uploaded photo.  The 'full' size is the Photo entity itself.
+RENDITION_DIMENSIONS = {'thumb': 80, 'medium': 160}
+RENDITION_SIZES = ['thumb', 'medium', 'full']
+
+# Renditions are JPEG, which is much smaller and faster to encode than PNG for
+# photographs.
+RENDITION_JPEG_QUALITY = 80
+
+# Photos never change once stored, but they are deleted when their record is
+# deleted, so clients, proxies, and memcache only keep them for an hour.
+# Clients can cheaply revalidate with the ETag after that.
+PHOTO_CACHE_SECONDS = 3600
+
+# Budget for the photo bytes cached in each instance's memory.
+MAX_CACHED_BYTES = 8*1024*1024
+
+# Deleting a photo can't reach the memory of other instances, so they only
+# keep photos for a short time.
+INSTANCE_CACHE_SECONDS = 60
+
+# memcache rejects values larger than this.
+MAX_MEMCACHE_BYTES = 1000*1000
+
 class PhotoError(Exception):
     message = _('There was a problem processing the image.  '
                 'Please try a different image.')
@@ -47,16 +76,10 @@ def create_photo(image, handler):
     if image == False:  # False means it wasn't valid (see validate_image)
         raise FormatUnrecognizedError()
 
-    if max(image.width, image.height) <= MAX_IMAGE_DIMENSION:
-        # No resize needed.  Keep the same size but add a transformation to
-        # force re-encoding.
-        image.resize(image.width, image.height)
-    elif image.width > image.height:
-        image.resize(MAX_IMAGE_DIMENSION,
-                     image.height * MAX_IMAGE_DIMENSION / image.width)
-    else:
-        image.resize(image.width * MAX_IMAGE_DIMENSION / image.height,
-                     MAX_IMAGE_DIMENSION)
+    # Resize even if the image is already small enough, to force re-encoding.
+    width, height = get_scaled_size(image.width, image.height,
+                                    MAX_IMAGE_DIMENSION)
+    image.resize(width, height)
 
     try:
         image_data = image.execute_transforms(output_encoding=images.PNG)
@@ -67,7 +90,8 @@ def create_photo(image, handler):
         # as e.g. IOError if the image is corrupt.
         raise PhotoError()
 
-    photo = model.Photo.create(handler.repo, image_data=image_data)
+    photo = model.Photo.create(handler.repo, image_data=image_data,
+                               width=width, height=height)
     photo_url = get_photo_url(photo, handler)
     return (photo, photo_url)
 
@@ -76,6 +100,127 @@ def get_photo_url(photo, handler):
     id = photo.key().name().split(':')[1]
     return handler.get_url('/photo', id=id)
 
+def add_renditions_task(photo, handler):
+    """Queues up a task to generate the smaller renditions of a Photo.  Call
+    this only after the Photo has been stored."""
+    id = photo.key().name().split(':')[1]
+    # The photo id is in the task name because one request can add tasks for
+    # two photos within the same millisecond.
+    handler.add_task_for_repo(
+        handler.repo, 'photo-renditions-%s' % id, 'tasks/photo_renditions',
+        id=id)
+
+def make_rendition(image_data, max_dimension):
+    """Returns (image_data, width, height) for a JPEG copy of an image, scaled
+    down so that neither dimension exceeds max_dimension."""
+    image = images.Image(image_data)
+    width, height = get_scaled_size(image.width, image.height, max_dimension)
+    image.resize(width, height)
+    rendition_data = image.execute_transforms(
+        output_encoding=images.JPEG, quality=RENDITION_JPEG_QUALITY)
+    return rendition_data, width, height
+
+
+def get_scaled_size(width, height, max_dimension):
+    """Returns the (width, height) of an image scaled down, preserving its
+    aspect ratio, so that neither dimension exceeds max_dimension."""
+    if max(width, height) <= max_dimension:
+        return width, height
+    elif width > height:
+        return max_dimension, max(1, height * max_dimension / width)
+    else:
+        return max(1, width * max_dimension / height), max_dimension
+
+
+class PhotoCache:
+    """A least-recently-used cache of served photo data, bounded by the total
+    number of bytes it holds.  Items expire after ttl_seconds.  Safe to use
+    from concurrent request threads."""
+
+    def __init__(self, max_bytes, ttl_seconds):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.total_bytes = 0
+        self.items = {}  # key -> (PhotoData, expiry time)
+        self.order = []  # keys, least recently used first
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.items:
+                data, expiry = self.items[key]
+                self.order.remove(key)
+                if time.time() >= expiry:
+                    self.total_bytes -= len(self.items.pop(key)[0].image_data)
+                    return None
+                self.order.append(key)
+                return data
+
+    def put(self, key, data):
+        if len(data.image_data) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.items:
+                self.order.remove(key)
+                self.total_bytes -= len(self.items.pop(key)[0].image_data)
+            while self.order and self.total_bytes + len(data.image_data) > \
+                    self.max_bytes:
+                oldest = self.order.pop(0)
+                self.total_bytes -= len(self.items.pop(oldest)[0].image_data)
+            self.items[key] = (data, time.time() + self.ttl_seconds)
+            self.order.append(key)
+            self.total_bytes += len(data.image_data)
+
+    def clear(self):
+        with self.lock:
+            self.total_bytes = 0
+            self.items = {}
+            self.order = []
+
+PHOTO_CACHE = PhotoCache(MAX_CACHED_BYTES, INSTANCE_CACHE_SECONDS)
+
+
+class PhotoData:
+    """The bytes and headers needed to serve one photo in one size."""
+
+    def __init__(self, image_data, upload_date, content_type='image/png'):
+        self.image_data = image_data
+        self.upload_date = upload_date
+        self.content_type = content_type
+        self.etag = '"%s"' % hashlib.sha1(image_data).hexdigest()
+
+
+def get_photo_data(repo, id, size):
+    """Gets the PhotoData for the given photo and size (one of
+    RENDITION_SIZES), looking in the instance cache, then memcache, then the
+    datastore.  Returns None if there is no such photo."""
+    key = model.Photo.get_memcache_key(repo, id, size)
+    data = PHOTO_CACHE.get(key)
+    if data:
+        return data
+
+    data = memcache.get(key)
+    if not data:
+        photo = model.Photo.get(repo, id)
+        if not photo:
+            return None
+        if size == 'full':
+            data = PhotoData(photo.image_data, photo.upload_date)
+        else:
+            rendition = model.PhotoRendition.get(repo, id, size)
+            if rendition:
+                rendition_data = rendition.image_data
+            else:
+                # The renditions task hasn't finished yet, or this photo was
+                # stored before renditions existed; make one on the fly.
+                rendition_data = make_rendition(
+                    photo.image_data, RENDITION_DIMENSIONS[size])[0]
+            data = PhotoData(rendition_data, photo.upload_date, 'image/jpeg')
+        if len(data.image_data) < MAX_MEMCACHE_BYTES:
+            memcache.set(key, data, PHOTO_CACHE_SECONDS)
+    PHOTO_CACHE.put(key, data)
+    return data
+
 
 class Handler(utils.BaseHandler):
     def get(self):
@@ -83,8 +228,38 @@ class Handler(utils.BaseHandler):
             id = int(self.params.id)
         except:
             return self.error(404, 'Photo id is unspecified or invalid.')
-        photo = model.Photo.get(self.repo, id)
-        if not photo:
+        size = self.params.size or 'full'
+        if size not in RENDITION_SIZES:
+            return self.error(400, 'Invalid size: %r' % size)
+        data = get_photo_data(self.repo, id, size)
+        if not data:
             return self.error(404, 'There is no photo for the specified id.')
-        self.response.headers['Content-Type'] = 'image/png'
-        self.response.out.write(photo.image_data)
+
+        self.response.headers['ETag'] = data.etag
+        self.response.headers['Cache-Control'] = \
+            'public, max-age=%d' % PHOTO_CACHE_SECONDS
+        if data.upload_date:
+            self.response.headers['Last-Modified'] = utils.format_http_date(
+                data.upload_date)
+        if utils.etag_matches(self.request, data.etag):
+            return self.response.set_status(304)
+        self.response.headers['Content-Type'] = data.content_type
+        self.response.out.write(data.image_data)
+
+
+class CreateRenditions(utils.BaseHandler):
+    """Generates and stores the smaller renditions of an uploaded Photo.
+    This runs as a task queued by add_renditions_task."""
+
+    def get(self):
+        photo = model.Photo.get(self.repo, self.params.id)
+        if not photo:
+            return  # the Photo was deleted before the task ran
+        renditions = []
+        for size in model.PhotoRendition.SIZES:
+            image_data, width, height = make_rendition(
+                photo.image_data, RENDITION_DIMENSIONS[size])
+            renditions.append(model.PhotoRendition.create(
+                self.repo, self.params.id, size, image_data=image_data,
+                width=width, height=height))
+        db.put(renditions)
@@ -27,9 +27,15 @@ resources is a matter of setting the active bundle."""
 
 import django_setup
 
+import collections
 import datetime
+import gzip
+import hashlib
 import logging
 import os
+import StringIO
+import threading
+import urllib
 import utils
 
 import django.template
@@ -122,22 +128,128 @@ from google.appengine.ext import webapp
 
 
 class RamCache:
-    def __init__(self):
-        self.cache = {}
+    """A size-bounded LRU cache of values with expiry times.  The cache holds
+    at most max_entries values and max_bytes bytes of content, evicting the
+    least recently used entries first.  Expired entries are not returned by
+    get(), but they stay in the cache (until evicted) so that get_stale() can
+    offer them for revalidation.  All methods are safe to call from
+    concurrent request threads."""
+
+    def __init__(self, max_entries=1000, max_bytes=16*1024*1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.cache = collections.OrderedDict()  # key -> (value, expiry, size)
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
 
     def clear(self):
-        self.cache.clear()
+        with self.lock:
+            self.cache.clear()
+            self.total_bytes = 0
+
+    def remove(self, key):
+        with self.lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        if key in self.cache:
+            value, expiry, size = self.cache.pop(key)
+            self.total_bytes -= size
 
     def put(self, key, value, ttl_seconds):
         if ttl_seconds > 0:
+            size = get_size(value)
+            if size > self.max_bytes:
+                return  # too big to cache at all
             expiry = utils.get_utcnow() + datetime.timedelta(0, ttl_seconds)
-            self.cache[key] = (value, expiry)
+            with self.lock:
+                self._remove(key)
+                self.cache[key] = (value, expiry, size)
+                self.total_bytes += size
+                while (len(self.cache) > self.max_entries or
+                       self.total_bytes > self.max_bytes):
+                    oldest, (value, expiry, size) = self.cache.popitem(False)
+                    self.total_bytes -= size
+                    self.evictions += 1
 
     def get(self, key):
-        if key in self.cache:
-            value, expiry = self.cache[key]
-            if utils.get_utcnow() < expiry:
-                return value
+        now = utils.get_utcnow()
+        with self.lock:
+            if key in self.cache:
+                entry = self.cache.pop(key)
+                self.cache[key] = entry  # mark as most recently used
+                value, expiry, size = entry
+                if now < expiry:
+                    self.hits += 1
+                    return value
+            self.misses += 1
+
+    def get_stale(self, key):
+        """Gets a value even if it has expired, or None if it isn't cached."""
+        with self.lock:
+            if key in self.cache:
+                return self.cache[key][0]
+
+    def stats(self):
+        """Returns a dictionary of the size and hit, miss, and eviction
+        counts of this cache."""
+        with self.lock:
+            return {'entries': len(self.cache), 'bytes': self.total_bytes,
+                    'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions}
+
+
+def get_size(value):
+    """Estimates the RAM occupied by a cached string or Resource, in bytes."""
+    content = getattr(value, 'content', value)
+    if isinstance(content, basestring):
+        return len(content)
+    return 0
+
+
+class Variant:
+    """The content of a Rendering encoded in a particular charset, with its
+    ETag.  A gzipped copy is made on first use and kept with it."""
+
+    def __init__(self, data):
+        self.data = data
+        self.etag = '"%s"' % hashlib.sha1(data).hexdigest()
+        self.gzipped = None
+
+    def get_gzipped(self):
+        if self.gzipped is None:
+            buffer = StringIO.StringIO()
+            file = gzip.GzipFile(fileobj=buffer, mode='wb', mtime=0)
+            file.write(self.data)
+            file.close()
+            self.gzipped = buffer.getvalue()
+        return self.gzipped
+
+
+class Rendering:
+    """The content of a plain Resource or a rendered template.  Encoded
+    variants of the content are computed on demand and cached along with it,
+    so that the hashing and compression are done once, not on every hit."""
+
+    def __init__(self, content):
+        self.content = content
+        self.variants = {}  # maps charsets to Variants
+
+    def get_variant(self, charset='utf-8'):
+        """Gets the content encoded in the given charset, as a Variant."""
+        if charset not in self.variants:
+            data = self.content
+            if isinstance(data, unicode):
+                data = data.encode(charset, 'replace')
+            self.variants[charset] = Variant(data)
+        return self.variants[charset]
+
+    def get_hash(self):
+        """Gets a short hash of the content, for use in hashed URLs."""
+        return self.get_variant().etag.strip('"')[:HASH_LENGTH]
 
 
 class ResourceBundle(db.Model):
@@ -207,37 +319,73 @@ class Resource(db.Model):
                     self.key().name())
         return self.template
 
+    def get_rendering(self):
+        """Wraps the content of this resource in a Rendering, which keeps its
+        ETag and gzipped copy for as long as this resource stays cached."""
+        if not hasattr(self, 'rendering'):
+            self.rendering = Rendering(self.content)
+        return self.rendering
+
+
+# Length of the content hash in hashed URLs (see get_hashed_url).
+HASH_LENGTH = 12
 
-LOCALIZED_CACHE = RamCache()  # contains Resource objects
-RENDERED_CACHE = RamCache()  # contains strings of rendered content
+LOCALIZED_CACHE = RamCache(2000, 32*1024*1024)  # contains Resource objects
+RENDERED_CACHE = RamCache(1000, 16*1024*1024)  # contains Rendering objects
 
 def clear_caches():
     LOCALIZED_CACHE.clear()
     RENDERED_CACHE.clear()
 
-active_bundle_name = '1'
+def get_cache_stats():
+    """Returns the hit, miss, and eviction counts of the resource caches."""
+    return {'localized': LOCALIZED_CACHE.stats(),
+            'rendered': RENDERED_CACHE.stats()}
+
+# The active bundle is chosen for each request, and requests on different
+# threads may use different bundles, so this is kept per thread.
+DEFAULT_BUNDLE_NAME = '1'
+request_context = threading.local()
 
 def set_active_bundle_name(name):
-    """Sets the currently active bundle.  Unfortunately, this is a global
-    setting because the Django template loader (django_setup.TemplateLoader)
-    is also a global setting, and so far we don't know a way to pass the bundle
-    name from get_rendered to the template loader."""
-    global active_bundle_name
-    active_bundle_name = name
+    """Sets the currently active bundle for this thread.  This has to be
+    thread-level state because the Django template loader
+    (django_setup.TemplateLoader) is a global setting, and so far we don't
+    know a way to pass the bundle name from get_rendered to the template
+    loader."""
+    request_context.bundle_name = name
+
+def get_active_bundle_name():
+    """Gets the bundle set by set_active_bundle_name on this thread."""
+    return getattr(request_context, 'bundle_name', DEFAULT_BUNDLE_NAME)
 
 def get_localized(name, lang, bundle_name=None):
     """Gets the localized (or if none, generic) variant of a Resource from the
-    cache, the datastore, or a file.  Returns None if no match is found."""
-    bundle_name = bundle_name or active_bundle_name
+    cache, the datastore, or a file.  Returns None if no match is found.
+    An expired cache entry is revalidated: if its content hasn't changed, the
+    cached Resource is kept along with its compiled template, and if the
+    datastore is unavailable, the expired Resource is served as is."""
+    bundle_name = bundle_name or get_active_bundle_name()
     cache_key = (bundle_name, name, lang)
     resource = LOCALIZED_CACHE.get(cache_key)
     if not resource:
-        if lang:
-            resource = Resource.get(name + ':' + lang, bundle_name)
-        if not resource:
-            resource = Resource.get(name, bundle_name)
+        stale = LOCALIZED_CACHE.get_stale(cache_key)
+        try:
+            if lang:
+                resource = Resource.get(name + ':' + lang, bundle_name)
+            if not resource:
+                resource = Resource.get(name, bundle_name)
+        except (db.Timeout, db.InternalError), e:
+            if not stale:
+                raise
+            logging.warning('Serving expired resource %r: %s' % (name, e))
+            return stale
         if resource:
-            LOCALIZED_CACHE.put(cache_key, resource, resource.cache_seconds)
+            cache_seconds = resource.cache_seconds
+            if (stale and stale.key().name() == resource.key().name() and
+                stale.content == resource.content):
+                resource = stale
+            LOCALIZED_CACHE.put(cache_key, resource, cache_seconds)
     return resource
 
 def get_rendered(name, lang, extra_key=None,
@@ -249,18 +397,39 @@ def get_rendered(name, lang, extra_key=None,
     template, this calls get_vars() to obtain a dictionary of template
     variables.  The cache is keyed on bundle_name, name, lang, and extra_key;
     use extra_key to capture dependencies on template variables)."""
-    bundle_name = bundle_name or active_bundle_name
+    rendering = get_rendering(
+        name, lang, extra_key, get_vars, cache_seconds, bundle_name)
+    return rendering and rendering.content
+
+def get_rendering(name, lang, extra_key=None,
+                  get_vars=lambda: {}, cache_seconds=1, bundle_name=None):
+    """Like get_rendered, but returns a Rendering instead of a string, so that
+    callers can use its cached ETag and gzipped variants."""
+    bundle_name = bundle_name or get_active_bundle_name()
     cache_key = (bundle_name, name, lang, extra_key)
-    content = RENDERED_CACHE.get(cache_key)
-    if content is None:
+    rendering = RENDERED_CACHE.get(cache_key)
+    if rendering is None:
         resource = get_localized(name, lang, bundle_name)
         if resource:  # a plain file is available
-            return resource.content  # already cached, no need to cache again
+            return resource.get_rendering()  # already cached with resource
         resource = get_localized(name + '.template', lang, bundle_name)
         if resource:  # a template is available
-            content = render_in_lang(resource.get_template(), lang, get_vars())
-            RENDERED_CACHE.put(cache_key, content, cache_seconds)
-    return content
+            rendering = Rendering(
+                render_in_lang(resource.get_template(), lang, get_vars()))
+            RENDERED_CACHE.put(cache_key, rendering, cache_seconds)
+    return rendering
+
+def get_hashed_url(base_url, name, lang, bundle_name=None):
+    """Gets a URL for a plain Resource that includes a hash of its content.
+    The content at such a URL never changes, so it is served with a far-future
+    expiry time (see main.Main).  Returns a plain URL if there is no such
+    Resource."""
+    url = base_url + '/' + name
+    resource = get_localized(name, lang, bundle_name)
+    if resource:
+        url += '?' + urllib.urlencode(
+            [('lang', lang), ('v', resource.get_rendering().get_hash())])
+    return url
 
 def render_in_lang(template, lang, vars):
     """Renders a template in a given language.  We use this to ensure that
@@ -272,3 +441,23 @@ def render_in_lang(template, lang, vars):
         return template.render(django.template.Context(vars))
     finally:
         django.utils.translation.activate(original_lang)
+
+def warm_up(langs, bundle_name=None):
+    """Loads and compiles every template in a bundle (including the template
+    files on disk) for each of the given languages, so that the first
+    requests served by a new instance don't have to.  Returns the number of
+    (template, language) pairs loaded."""
+    bundle_name = bundle_name or get_active_bundle_name()
+    names = set(Resource.list_files())
+    parent = db.Key.from_path('ResourceBundle', bundle_name)
+    query = Resource.all(keys_only=True).ancestor(parent)
+    names.update(key.name() for key in query)
+    count = 0
+    for name in sorted(set(name.split(':')[0] for name in names)):
+        if name.endswith('.template'):
+            for lang in langs:
+                resource = get_localized(name, lang, bundle_name)
+                if resource:
+                    resource.get_template()
+                    count += 1
+    return count
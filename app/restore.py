@@ -75,6 +75,8 @@ class Handler(utils.BaseHandler):
         # Move the expiry date into the future to cause the record to reappear.
         person.expiry_date = utils.get_utcnow() + RESTORED_RECORD_TTL
         person.put_expiry_flags()
+        # The restored notes may no longer agree with the cached status.
+        self.add_update_status_task(person.record_id)
 
         record_url = self.get_url('/view', person.repo, id=person.record_id)
         subject = _('[Person Finder] Record restoration notice for '
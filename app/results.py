@@ -19,9 +19,7 @@ import unicodedata
 from model import *
 from utils import *
 from text_query import TextQuery
-import external_search
 import indexing
-import jp_mobile_carriers
 
 MAX_RESULTS = 100
 # U+2010: HYPHEN
@@ -56,6 +54,7 @@ class Handler(BaseHandler):
         """Performs a search and adds view_url attributes to the results."""
         results = None
         if self.config.external_search_backends:
+            import external_search
             results = external_search.search(
                 self.repo, query, MAX_RESULTS,
                 self.config.external_search_backends)
@@ -152,14 +151,16 @@ class Handler(BaseHandler):
                                        create_url=create_url)
                 else:
                     # No matches; proceed to create a new record.
-                    logging.info(repr(self.params.__dict__))
-                    return self.redirect('/create', **self.params.__dict__)
+                    params = dict(self.params.items())
+                    logging.info(repr(params))
+                    return self.redirect('/create', **params)
 
         if self.params.role == 'seek':
             query = TextQuery(self.params.query)
             # If a query looks like a phone number, show the user a result
             # of looking up the number in the carriers-provided BBS system.
             if self.config.jp_mobile_carrier_redirect:
+                import jp_mobile_carriers
                 if jp_mobile_carriers.handle_phone_number(self, query.query):
                     return 
 
@@ -26,7 +26,6 @@ import sha
 import time
 
 from google.appengine.api import users
-from recaptcha.client import captcha
 
 from model import Secret
 from utils import *
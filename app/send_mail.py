@@ -38,5 +38,7 @@ class EmailSender(webapp.RequestHandler):
                           'failed with exception %s' % (to, subject, e))
 
 
+application = webapp.WSGIApplication([('.*', EmailSender)])
+
 if __name__ == '__main__':
-    run_wsgi_app(webapp.WSGIApplication([('.*', EmailSender)]))
+    run_wsgi_app(application)
@@ -17,20 +17,40 @@
 
 __author__ = 'jocatalano@google.com (Joe Catalano) and many other Googlers'
 
+import hashlib
 import logging
 
 from datetime import datetime, timedelta
+from google.appengine.api import memcache
 from google.appengine.api import urlfetch
 from model import *
 from time import *
 from utils import *
 
+# The StaticSiteMapInfo entity is created once and rarely changes, so it is
+# cached instead of being queried on every request.
+STATIC_SITEMAP_INFO_CACHE_SECONDS = 3600
+
+# A shard whose time range has passed is rendered once and then served from
+# memcache.  Records can still leave a closed shard (when they are modified
+# again or expire), so the rendered shard is refreshed once a day.
+CLOSED_SHARD_CACHE_SECONDS = 24*3600
+
 def _compute_max_shard_index(now, sitemap_epoch, shard_size_seconds):
     delta = now - sitemap_epoch
     delta_seconds = delta.days * 24 * 60 * 60 + delta.seconds
     return delta_seconds / shard_size_seconds
 
 def _get_static_sitemap_info(repo):
+    info = memcache.get('sitemap_info:' + repo)
+    if not info:
+        info = _load_static_sitemap_info(repo)
+        if info:
+            memcache.set('sitemap_info:' + repo, info,
+                         STATIC_SITEMAP_INFO_CACHE_SECONDS)
+    return info
+
+def _load_static_sitemap_info(repo):
     infos = StaticSiteMapInfo.all().fetch(2)
     if len(infos) > 1:
         logging.error("There should be at most 1 StaticSiteMapInfo record!")
@@ -41,7 +61,7 @@ def _get_static_sitemap_info(repo):
         # Set the sitemap generation time according to the time of the first
         # record with a timestamp.    This will make the other stuff work
         # correctly in case there is no static sitemap.
-        query = Person.all_in_repo(repo)
+        query = Person.all_in_repo(repo, projection=['last_modified'])
         query = query.filter('last_modified != ', None)
         first_updated_person = query.order('last_modified').get()
         if not first_updated_person:
@@ -80,28 +100,49 @@ class SiteMap(BaseHandler):
         else:
             shard_index = int(requested_shard_index)
             assert 0 <= shard_index < 50000    #TODO: nicer error (400 maybe)
-            persons = []
             time_lower = \
                 then + timedelta(seconds=shard_size_seconds * shard_index)
             time_upper = time_lower + timedelta(seconds=shard_size_seconds)
-            query = Person.all_in_repo(self.repo
-                         ).filter('last_modified >', time_lower
+            if time_upper > get_utcnow():
+                # The tail shard is still filling up, so render it live.
+                return self.write(self.render_shard(time_lower, time_upper))
+
+            cache_key = 'sitemap_shard:%s:%s:%s:%d' % (
+                self.env.netloc, self.repo, get_timestamp(then), shard_index)
+            content = memcache.get(cache_key)
+            if content is None:
+                content = self.render_shard(time_lower, time_upper)
+                memcache.set(cache_key, content, CLOSED_SHARD_CACHE_SECONDS)
+            etag = '"%s"' % hashlib.sha1(content.encode('utf-8')).hexdigest()
+            self.response.headers['ETag'] = etag
+            self.response.headers['Cache-Control'] = \
+                'public, max-age=%d' % CLOSED_SHARD_CACHE_SECONDS
+            if etag_matches(self.request, etag):
+                return self.response.set_status(304)
+            self.write(content)
+
+    def render_shard(self, time_lower, time_upper):
+        """Renders the sitemap of the Persons last modified in the given time
+        range.  Only the key and last_modified are fetched for each Person."""
+        persons = []
+        query = Person.all_in_repo(self.repo, projection=['last_modified']
+                     ).filter('last_modified >', time_lower
+                     ).filter('last_modified <=', time_upper
+                     ).order('last_modified')
+        fetched_persons = query.fetch(self._FETCH_LIMIT)
+        while fetched_persons:
+            persons.extend(fetched_persons)
+            last_value = fetched_persons[-1].last_modified
+            query = Person.all_in_repo(self.repo, projection=['last_modified']
+                         ).filter('last_modified >', last_value
                          ).filter('last_modified <=', time_upper
                          ).order('last_modified')
             fetched_persons = query.fetch(self._FETCH_LIMIT)
-            while fetched_persons:
-                persons.extend(fetched_persons)
-                last_value = fetched_persons[-1].last_modified
-                query = Person.all_in_repo(self.repo
-                             ).filter('last_modified >', last_value
-                             ).filter('last_modified <=', time_upper
-                             ).order('last_modified')
-                fetched_persons = query.fetch(self._FETCH_LIMIT)
-            urlinfos = [
-                {'person_record_id': p.record_id,
-                 'lastmod': format_sitemaps_datetime(p.last_modified)}
-                for p in persons]
-            self.render('sitemap.xml', urlinfos=urlinfos)
+        urlinfos = [
+            {'person_record_id': p.record_id,
+             'lastmod': format_sitemaps_datetime(p.last_modified)}
+            for p in persons]
+        return self.render_to_string('sitemap.xml', urlinfos=urlinfos)
 
 class SiteMapPing(BaseHandler):
     """Pings the index server with sitemap files that are new since last ping"""
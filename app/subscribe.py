@@ -64,53 +64,76 @@ def subscribe_to(handler, repo, person, email, lang):
     return subscription
 
 def send_notifications(handler, updated_person, notes, follow_links=True):
-    """Sends status updates about the person
+    """Queues a task to send status updates about the person
 
     Subscribers to the updated_person and to all person records marked as its
     duplicate will be notified. Each element of notes should belong to the
-    updated_person. If follow_links=False, only notify subscribers to the
-    updated_person, ignoring linked Person records.
+    updated_person and should already be stored. If follow_links=False, only
+    notify subscribers to the updated_person, ignoring linked Person records.
     """
+    note_ids = [note.record_id for note in notes
+                if note.person_record_id == updated_person.record_id]
+    if not note_ids:
+        return
+    # The task is unnamed, as several notifications can be queued at once.
+    # An import can notify about many notes at once, so the note IDs go in
+    # a POST payload, which isn't subject to the limit on URL length.
+    taskqueue.add(method='POST',
+                  url='/%s/%s' % (handler.repo, NotifySubscribers.ACTION),
+                  params={'id': updated_person.record_id,
+                          'note_id': note_ids,
+                          'follow_links': follow_links and 'yes' or '',
+                          'repo_url': get_repo_url(handler.request,
+                                                   handler.repo)})
+
+def get_subscribers(updated_person, follow_links=True):
+    """Returns a dictionary that maps each valid subscriber e-mail address to
+    a (person_subscribed_to, subscriber_language) pair."""
     linked_persons = []
     if follow_links:
         linked_persons = updated_person.get_all_linked_persons()
-    # Dictionary of
-    # (subscriber_email, [person_subscribed_to, subscriber_language]) pairs
     subscribers = {}
     # Subscribers to duplicates of updated_person
     for p in linked_persons:
         for sub in p.get_subscriptions():
-            subscribers[sub.email] = [p, sub.language]
+            subscribers[sub.email] = (p, sub.language)
     # Subscribers to updated_person
     for sub in updated_person.get_subscriptions():
-        subscribers[sub.email] = [updated_person, sub.language]
-    try:
-        for note in notes:
-            if note.person_record_id != updated_person.record_id:
-                continue
-            for email, (subscribed_person, language) in subscribers.items():
-                subscribed_person_url = \
-                    handler.get_url('/view', id=subscribed_person.record_id)
-                if is_email_valid(email):
-                    django.utils.translation.activate(language)
-                    subject = _(
-                            '[Person Finder] Status update for %(full_name)s'
-                            ) % {'full_name': updated_person.primary_full_name}
-                    body = handler.render_to_string(
-                        'person_status_update_email.txt', language,
-                        full_name=updated_person.primary_full_name,
-                        note=note,
-                        note_status_text=get_note_status_text(note),
-                        subscribed_person_url=subscribed_person_url,
-                        site_url=handler.get_url('/'),
-                        view_url=handler.get_url('/view',
-                                                 id=updated_person.record_id),
-                        unsubscribe_link=get_unsubscribe_link(handler,
-                                                              subscribed_person,
-                                                              email))
-                    handler.send_mail(email, subject, body)
-    finally:
-        django.utils.translation.activate(handler.env.lang)
+        subscribers[sub.email] = (updated_person, sub.language)
+    return dict((email, value) for email, value in subscribers.items()
+                if is_email_valid(email))
+
+# The maximum number of PendingNotification entities to store in one call.
+MAX_PENDING_PUT_BATCH = 500
+
+# Stand-ins for the parts of a status update that differ for each recipient,
+# so that the message is rendered only once for each note and language.
+SUBSCRIBED_PERSON_URL_PLACEHOLDER = '{{subscribed_person_url}}'
+UNSUBSCRIBE_LINK_PLACEHOLDER = '{{unsubscribe_link}}'
+
+def render_status_update(handler, updated_person, notes, language):
+    """Renders the subject and body of a status update about one or more
+    notes in the given language, with placeholders for the per-recipient
+    links.  Several notes are sent together as a digest."""
+    django.utils.translation.activate(language)
+    subject = _('[Person Finder] Status update for %(full_name)s'
+                ) % {'full_name': updated_person.primary_full_name}
+    if len(notes) == 1:
+        template_name = 'person_status_update_email.txt'
+    else:
+        template_name = 'person_status_digest_email.txt'
+    body = handler.render_to_string(
+        template_name, language,
+        full_name=updated_person.primary_full_name,
+        note=notes[0],
+        note_status_text=get_note_status_text(notes[0]),
+        notes=[Struct(note=note, status_text=get_note_status_text(note))
+               for note in notes],
+        subscribed_person_url=SUBSCRIBED_PERSON_URL_PLACEHOLDER,
+        site_url=handler.get_url('/'),
+        view_url=handler.get_url('/view', id=updated_person.record_id),
+        unsubscribe_link=UNSUBSCRIBE_LINK_PLACEHOLDER)
+    return subject, body
 
 def send_subscription_confirmation(handler, person, email):
     """Sends subscription confirmation when person subscribes to
@@ -189,3 +212,151 @@ class Handler(BaseHandler):
         html = ' <a href="%s">%s</a>' % (url, link_text)
         message_html = _('You have successfully subscribed.') + html
         return self.info(200, message_html=message_html)
+
+
+class NotificationTask(BaseHandler):
+    """Base class for the tasks that send status updates to subscribers."""
+    repo_url = None  # root URL of the site where the notes were posted
+
+    def get_url(self, action, repo=None, scheme=None, **params):
+        """Constructs URLs on the site where the notes were posted, rather
+        than on the host that the task queue sends this request to."""
+        query = urlencode(params, self.env.charset)
+        return (self.repo_url + '/' + action.lstrip('/') +
+                (query and '?' + query or ''))
+
+    def send_status_updates(self, updates):
+        """Sends status updates, given as Structs with the attributes repo_url,
+        email, language, subscribed_person, updated_person and notes.  Each
+        distinct message is rendered only once, and the links for each
+        recipient are filled in afterwards."""
+        renderings = {}
+        messages = []
+        try:
+            for update in updates:
+                self.repo_url = update.repo_url
+                key = (update.repo_url, update.language,
+                       update.updated_person.record_id,
+                       tuple(note.record_id for note in update.notes))
+                if key not in renderings:
+                    renderings[key] = render_status_update(
+                        self, update.updated_person, update.notes,
+                        update.language)
+                subject, body = renderings[key]
+                messages.append((update.email, subject, self.fill_in_links(
+                    body, update.subscribed_person, update.email)))
+        finally:
+            django.utils.translation.activate(self.env.lang)
+        self.send_mails(messages)
+
+    def fill_in_links(self, body, subscribed_person, email):
+        """Replaces the placeholders in a rendered status update with the
+        links for one recipient."""
+        subscribed_person_url = self.get_url(
+            '/view', id=subscribed_person.record_id)
+        unsubscribe_link = get_unsubscribe_link(self, subscribed_person, email)
+        return body.replace(
+            SUBSCRIBED_PERSON_URL_PLACEHOLDER, subscribed_person_url).replace(
+            UNSUBSCRIBE_LINK_PLACEHOLDER, unsubscribe_link)
+
+
+class NotifySubscribers(NotificationTask):
+    """Sends status updates about new notes to the subscribers of a person.
+    This runs as a task queued by send_notifications.  If the repository has
+    notification_digest_minutes set, the updates are stored to be sent later
+    as digests by FlushNotifications."""
+    ACTION = 'tasks/notify_subscribers'
+
+    def post(self):
+        # App Engine removes this header from requests made by users, so it
+        # keeps users from sending arbitrary notifications through this task.
+        if 'X-AppEngine-TaskName' not in self.request.headers:
+            return self.error(403, 'Only the task queue can run this task.')
+        person = model.Person.get(self.repo, self.params.id)
+        if not person:
+            return
+        notes = filter(None, [model.Note.get(self.repo, note_id)
+                              for note_id in self.request.get_all('note_id')])
+        subscribers = get_subscribers(person, self.params.follow_links)
+
+        if self.config.notification_digest_minutes:
+            now = get_utcnow()
+            pending = [model.PendingNotification.create(
+                           self.repo, person.record_id, note.record_id, email,
+                           subscribed_person_record_id=
+                               subscribed_person.record_id,
+                           language=language,
+                           repo_url=self.params.repo_url,
+                           timestamp=now)
+                       for note in notes
+                       for email, (subscribed_person, language)
+                       in subscribers.items()]
+            for i in range(0, len(pending), MAX_PENDING_PUT_BATCH):
+                db.put(pending[i:i + MAX_PENDING_PUT_BATCH])
+            return
+
+        self.send_status_updates([
+            Struct(repo_url=self.params.repo_url,
+                   email=email,
+                   language=language,
+                   subscribed_person=subscribed_person,
+                   updated_person=person,
+                   notes=[note])
+            for note in notes
+            for email, (subscribed_person, language) in subscribers.items()])
+
+
+class FlushNotifications(NotificationTask):
+    """Sends the pending status updates for each subscriber and person as a
+    single digest, once the first of them has waited for the repository's
+    notification_digest_minutes.  Making a request to this handler without
+    a specified repo will start tasks for all repositories."""
+    repo_required = False  # can run without a repo
+    ACTION = 'tasks/flush_notifications'
+
+    def get(self):
+        if not self.repo:
+            for repo in model.Repo.list():
+                self.add_task_for_repo(
+                    repo, 'flush-notifications', self.ACTION)
+            return
+
+        # With digests turned off, anything left pending is sent right away.
+        cutoff = get_utcnow() - timedelta(
+            minutes=self.config.notification_digest_minutes or 0)
+        groups = {}
+        query = model.PendingNotification.all().filter('repo =', self.repo)
+        for pending in query.run(batch_size=1000):
+            groups.setdefault((pending.person_record_id, pending.email),
+                              []).append(pending)
+        due_groups = [group for group in groups.values()
+                      if min(pending.timestamp for pending in group) <= cutoff]
+
+        persons = {}
+        notes = {}
+        def get_person(record_id):
+            if record_id not in persons:
+                persons[record_id] = model.Person.get(self.repo, record_id)
+            return persons[record_id]
+        def get_note(record_id):
+            if record_id not in notes:
+                notes[record_id] = model.Note.get(self.repo, record_id)
+            return notes[record_id]
+
+        updates = []
+        for group in due_groups:
+            group.sort(key=lambda pending: pending.timestamp)
+            first = group[0]
+            updated_person = get_person(first.person_record_id)
+            subscribed_person = get_person(first.subscribed_person_record_id)
+            group_notes = filter(None, [get_note(pending.note_record_id)
+                                        for pending in group])
+            if updated_person and subscribed_person and group_notes:
+                updates.append(Struct(repo_url=first.repo_url,
+                                      email=first.email,
+                                      language=first.language,
+                                      subscribed_person=subscribed_person,
+                                      updated_person=updated_person,
+                                      notes=group_notes))
+        self.send_status_updates(updates)
+        db.delete([pending for group in due_groups for pending in group])
@@ -26,6 +26,7 @@ from google.appengine.ext import db
 
 import config
 import delete
+import indexing
 import model
 import utils
 
@@ -112,6 +113,22 @@ class DeleteOld(ScanForExpired):
     def query(self):
         return model.Person.potentially_expired_records(self.repo)
 
+    def get(self):
+        if self.repo and not self.params.cursor:
+            self.delete_old_tombstones()
+        ScanForExpired.get(self)
+
+    def delete_old_tombstones(self):
+        """Deletes the Tombstones that api/changes no longer reports."""
+        query = db.Query(model.Tombstone, keys_only=True
+            ).filter('repo =', self.repo
+            ).filter('last_modified <',
+                     utils.get_utcnow() - model.Tombstone.TTL)
+        keys = query.fetch(FETCH_LIMIT)
+        while keys:
+            db.delete(keys)
+            keys = query.fetch(FETCH_LIMIT)
+
 class CleanUpInTestMode(utils.BaseHandler):
     """If the repository is in "test mode", this task deletes all entries older
     than DELETION_AGE_SECONDS (defined below), regardless of their actual
@@ -251,6 +268,7 @@ class CountBase(utils.BaseHandler):
                             break
                     # And put the updates at once.
                     counter.put()
+                self.finish_scan(counter)
             except runtime.DeadlineExceededError:
                 # Continue counting in another task.
                 self.add_task_for_repo(self.repo, self.SCAN_NAME, self.ACTION)
@@ -267,6 +285,10 @@ class CountBase(utils.BaseHandler):
         each entity that matches the query; it should call increment() on
         the counter object for whatever accumulators it wants to increment."""
 
+    def finish_scan(self, counter):
+        """Subclasses may implement this.  This will be called once when the
+        scan is complete, with the counter holding the final counts."""
+
 
 class CountPerson(CountBase):
     SCAN_NAME = 'person'
@@ -313,6 +335,20 @@ class CountNote(CountBase):
         if note.last_known_location:
             counter.increment('last_known_location')
 
+        # The exact sizes of the /admin/review queues; see finish_scan.
+        if note.hidden:
+            counter.increment('hidden=TRUE')
+        elif note.reviewed:
+            counter.increment('hidden=FALSE,reviewed=TRUE')
+        else:
+            counter.increment('hidden=FALSE,reviewed=FALSE')
+
+    def finish_scan(self, counter):
+        # Correct any drift in the queue sizes maintained as Notes change.
+        model.ReviewQueueCount.reset(self.repo, dict(
+            (name, counter.get(name))
+            for name in model.ReviewQueueCount.QUEUE_NAMES.values()))
+
 
 class AddReviewedProperty(CountBase):
     """Sets 'reviewed' to False on all notes that have no 'reviewed' property.
@@ -331,11 +367,67 @@ class AddReviewedProperty(CountBase):
             note.put()
 
 
+class AddMatchFingerprint(CountBase):
+    """Sets match_fingerprint on Notes that were stored before the property
+    existed, so that imports can find them when checking for duplicates."""
+    SCAN_NAME = 'match-fingerprint'
+    ACTION = 'tasks/count/match_fingerprint'
+
+    def make_query(self):
+        return model.Note.all(filter_expired=False).filter('repo =', self.repo)
+
+    def update_counter(self, counter, note):
+        fingerprint = note.get_match_fingerprint()
+        if note.match_fingerprint == fingerprint:
+            counter.increment('unchanged')
+        else:
+            note.match_fingerprint = fingerprint
+            note.put()
+            counter.increment('updated')
+
+
+class AddNoteLastModified(CountBase):
+    """Sets last_modified on Notes that were stored before the property
+    existed, so that api/changes lists them."""
+    SCAN_NAME = 'note-last-modified'
+    ACTION = 'tasks/count/note_last_modified'
+
+    def make_query(self):
+        return model.Note.all(filter_expired=False).filter('repo =', self.repo)
+
+    def update_counter(self, counter, note):
+        if note.last_modified:
+            counter.increment('unchanged')
+        else:
+            note.put()  # sets last_modified
+            counter.increment('updated')
+
+
+class AddSourceDomain(CountBase):
+    """Sets source_domain on Notes that were stored before the property
+    existed, so that they appear when /admin/review filters by source."""
+    SCAN_NAME = 'source-domain'
+    ACTION = 'tasks/count/source_domain'
+
+    def make_query(self):
+        return model.Note.all(filter_expired=False).filter('repo =', self.repo)
+
+    def update_counter(self, counter, note):
+        source_domain = note.get_source_domain()
+        if note.source_domain == source_domain:
+            counter.increment('unchanged')
+        else:
+            note.source_domain = source_domain
+            note.put()
+            counter.increment('updated')
+
+
 class UpdateDeadStatus(CountBase):
     """This task looks for Person records with the status 'believed_dead',
     checks for the last non-hidden Note, and updates the status if necessary.
     This is designed specifically to address bogus 'believed_dead' notes that
-    are flagged as spam.  (This is a cleanup task, not a counting task.)"""
+    are flagged as spam.  (This is a cleanup task, not a counting task.)
+    It is no longer run from cron; see UpdatePersonStatus."""
     SCAN_NAME = 'update-dead-status'
     ACTION = 'tasks/count/update_dead_status'
 
@@ -349,7 +441,8 @@ class UpdateDeadStatus(CountBase):
 
 class UpdateStatus(CountBase):
     """This task scans Person records, looks for the last non-hidden Note, and
-    updates latest_status.  (This is a cleanup task, not a counting task.)"""
+    updates latest_status.  (This is a cleanup task, not a counting task.)
+    It is no longer run from cron; see UpdatePersonStatus."""
     SCAN_NAME = 'update-status'
     ACTION = 'tasks/count/update_status'
 
@@ -360,6 +453,18 @@ class UpdateStatus(CountBase):
         person.update_latest_status()
 
 
+class UpdatePersonStatus(utils.BaseHandler):
+    """Recomputes latest_status on a single Person.  This task is queued
+    whenever a Note is hidden, revealed, or restored, so that the status of
+    only the affected Person is repaired."""
+    ACTION = 'tasks/update_person_status'
+
+    def get(self):
+        person = model.Person.get(self.repo, self.params.id)
+        if person:
+            person.update_latest_status()
+
+
 class Reindex(CountBase):
     """A handler for re-indexing Persons."""
     SCAN_NAME = 'reindex'
@@ -369,5 +474,11 @@ class Reindex(CountBase):
         return model.Person.all().filter('repo =', self.repo)
 
     def update_counter(self, counter, person):
-        person.update_index(['old', 'new'])
-        person.put()
+        # Only rewrite records whose index would actually change, so that a
+        # reindex pass doesn't touch last_modified on every Person.
+        if indexing.is_index_current(person):
+            counter.increment('unchanged')
+        else:
+            person.update_index(['old', 'new'])
+            person.put()
+            counter.increment('reindexed')
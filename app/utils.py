@@ -18,9 +18,11 @@ __author__ = 'kpy@google.com (Ka-Ping Yee) and many other Googlers'
 from django_setup import ugettext as _  # always keep this first
 
 import base64
+import bisect
 import calendar
 import cgi
 from datetime import datetime, timedelta
+import email.utils
 import httplib
 import logging
 import os
@@ -36,14 +38,12 @@ import urllib
 import urlparse
 
 import django.utils.html
-from google.appengine.api import images
 from google.appengine.api import mail
 from google.appengine.api import taskqueue
 from google.appengine.api import users
 from google.appengine.ext import webapp
 import google.appengine.ext.webapp.template
 import google.appengine.ext.webapp.util
-from recaptcha.client import captcha
 
 import const
 import config
@@ -99,6 +99,12 @@ def format_sitemaps_datetime(dt):
         dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second)
     return integer_dt.isoformat() + '+00:00'
 
+def format_http_date(dt):
+    """Formats a UTC datetime for use in an HTTP header such as
+    Last-Modified."""
+    return email.utils.formatdate(calendar.timegm(dt.utctimetuple()),
+                                  usegmt=True)
+
 def encode(string, encoding='utf-8'):
     """If unicode, encode to encoding; if 8-bit string, leave unchanged."""
     if isinstance(string, unicode):
@@ -248,6 +254,7 @@ def validate_image(bytestring):
     try:
         image = None
         if bytestring:
+            from google.appengine.api import images  # loaded only when needed
             image = images.Image(bytestring)
             image.width
         return image
@@ -363,7 +370,7 @@ def filter_sensitive_fields(records):
 
 def get_secret(name):
     """Gets a secret from the datastore by name, or returns None if missing."""
-    secret = model.Secret.get_by_key_name(name)
+    secret = model.secret_cache.get(name)
     if secret:
         return secret.secret
 
@@ -392,6 +399,35 @@ def get_utcnow_timestamp():
     set_utcnow_for_test)."""
     return get_timestamp(get_utcnow())
 
+def etag_matches(request, etag):
+    """Returns True if the request's If-None-Match header matches the given
+    ETag, which means the client already has a current copy."""
+    header = request.headers.get('If-None-Match', '')
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag or tag == '*':
+            return True
+    return False
+
+def write_variant(request, response, variant, max_age=None):
+    """Writes a resources.Variant with its ETag, or just a 304 response if
+    the client already has it.  The gzipped copy is sent to clients that
+    accept it.  If max_age is given, the response may be cached publicly for
+    that many seconds."""
+    response.headers['ETag'] = variant.etag
+    response.headers['Vary'] = 'Accept-Encoding'
+    if max_age:
+        response.headers['Cache-Control'] = 'public, max-age=%d' % max_age
+    if etag_matches(request, variant.etag):
+        response.set_status(304)
+    elif 'gzip' in request.accept_encoding:
+        response.headers['Content-Encoding'] = 'gzip'
+        response.out.write(variant.get_gzipped())
+    else:
+        response.out.write(variant.data)
+
 def log_api_action(handler, action, num_person_records=0, num_note_records=0,
                    people_skipped=0, notes_skipped=0):
     """Log an API action."""
@@ -485,20 +521,13 @@ def is_ip_address_in_one_of_networks(ip, networks):
     """
     if networks is None:
         return False
-    for network in networks:
-        if is_ip_address_in_network(ip, network):
-            return True
-    return False
+    return ip in get_ip_network_matcher(networks)
 
 def is_ip_address_in_network(ip, network):
     """e.g., is_ip_address_in_network('127.0.0.1', '127.0.0.0/24')
     => True
     """
-    ipaddr = ip_address_str_to_int(ip)
-    netaddr, bits = network.split('/')
-    netmask = ip_address_str_to_int(netaddr)
-    ipaddr_masked = ipaddr & (0xffffffff << (32 - int(bits)))
-    return ipaddr_masked == netmask
+    return ip in get_ip_network_matcher([network])
 
 def ip_address_str_to_int(ip):
     """e.g., ip_address_str_to_int('127.0.0.1') => 0x7f000001
@@ -506,6 +535,103 @@ def ip_address_str_to_int(ip):
     # '>L' means big-endian unsigned long.
     return struct.unpack('>L', socket.inet_aton(ip))[0]
 
+IPV6_GROUP_RE = re.compile('^[0-9a-fA-F]{1,4}$')
+
+def parse_ip_address(ip):
+    """Parses an IPv4 or IPv6 address into an (IP version, integer) pair, e.g.
+    parse_ip_address('127.0.0.1') => (4, 0x7f000001).  IPv4-mapped IPv6
+    addresses such as '::ffff:127.0.0.1' are treated as IPv4 addresses.
+    Raises ValueError if the address is not valid."""
+    try:
+        if ':' not in (ip or ''):
+            return 4, ip_address_str_to_int(ip)
+        halves = ip.split('%')[0].split('::')  # drop any zone index
+        if len(halves) > 2:
+            raise ValueError('Invalid IP address: %r' % ip)
+        parts = [half and half.split(':') or [] for half in halves]
+        if parts[-1] and '.' in parts[-1][-1]:
+            # An embedded IPv4 address makes up the last two groups.
+            value = ip_address_str_to_int(parts[-1][-1])
+            parts[-1][-1:] = ['%x' % (value >> 16), '%x' % (value & 0xffff)]
+        groups = parts[0]
+        if len(parts) == 2:
+            groups += ['0']*(8 - len(parts[0]) - len(parts[1])) + parts[1]
+        if len(groups) != 8:
+            raise ValueError('Invalid IP address: %r' % ip)
+        value = 0
+        for group in groups:
+            if not IPV6_GROUP_RE.match(group):
+                raise ValueError('Invalid IP address: %r' % ip)
+            value = (value << 16) | int(group, 16)
+        if value >> 32 == 0xffff:
+            return 4, value & 0xffffffff
+        return 6, value
+    except (socket.error, TypeError):
+        raise ValueError('Invalid IP address: %r' % ip)
+
+IP_ADDRESS_BITS = {4: 32, 6: 128}
+
+
+class IpNetworkMatcher:
+    """A list of networks such as ['127.0.0.0/24', '2001:db8::/32'] compiled
+    into sorted, non-overlapping address ranges, so that checking an address
+    is a binary search.  Use the 'in' operator to check an address."""
+
+    def __init__(self, networks):
+        ranges = {4: [], 6: []}
+        for network in networks:
+            try:
+                address, bits = network.split('/')
+                version, start = parse_ip_address(address)
+                host_bits = IP_ADDRESS_BITS[version] - int(bits)
+                if not 0 <= host_bits <= IP_ADDRESS_BITS[version]:
+                    raise ValueError('Invalid prefix length')
+            except ValueError, e:
+                logging.warning('Ignoring network %r: %s' % (network, e))
+                continue
+            host_mask = (1 << host_bits) - 1
+            if start & host_mask:
+                # Like '192.168.0.1/24'; no address can match this.
+                continue
+            ranges[version].append((start, start | host_mask))
+
+        # Merge overlapping and adjacent ranges.
+        self.starts, self.ends = {}, {}
+        for version in ranges:
+            starts, ends = [], []
+            for start, end in sorted(ranges[version]):
+                if ends and start <= ends[-1] + 1:
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+            self.starts[version], self.ends[version] = starts, ends
+        self.empty = not (self.starts[4] or self.starts[6])
+
+    def __contains__(self, ip):
+        if self.empty:
+            return False
+        try:
+            version, value = parse_ip_address(ip)
+        except ValueError:
+            return False
+        index = bisect.bisect_right(self.starts[version], value) - 1
+        return index >= 0 and value <= self.ends[version][index]
+
+# Compiled IpNetworkMatchers, keyed on tuples of network strings.
+ip_network_matchers = {}
+
+def get_ip_network_matcher(networks):
+    """Gets an IpNetworkMatcher for a list of networks, reusing the one
+    compiled earlier for the same list if there is one."""
+    key = tuple(networks)
+    matcher = ip_network_matchers.get(key)
+    if matcher is None:
+        if len(ip_network_matchers) >= 100:
+            ip_network_matchers.clear()
+        matcher = ip_network_matchers[key] = IpNetworkMatcher(key)
+    return matcher
+
 # ==== Struct ==================================================================
 
 class Struct:
@@ -517,6 +643,34 @@ class Struct:
         return self.__dict__.get(name, default)
 
 
+class Params(Struct):
+    """The validated query parameters of a request.  Parameters that are
+    present in the request are validated up front (see BaseHandler), but the
+    default values of absent parameters are only computed when they're first
+    read, so a request doesn't pay for the many parameters it doesn't use."""
+    def __init__(self, validators):
+        self._validators = validators  # maps parameter names to validators
+
+    def __getattr__(self, name):
+        # Python calls this only for attributes that haven't been set yet.
+        validator = self.__dict__['_validators'].get(name)
+        if validator is None:
+            raise AttributeError(name)
+        value = validator('')
+        setattr(self, name, value)  # memoize the default value
+        return value
+
+    def get(self, name, default=None):
+        if name in self.__dict__ or name not in self._validators:
+            return self.__dict__.get(name, default)
+        return getattr(self, name)
+
+    def items(self):
+        """Returns (name, value) pairs for the parameters read so far."""
+        return [(name, value) for name, value in self.__dict__.items()
+                if name != '_validators']
+
+
 # ==== Key management ======================================================
 
 def generate_random_key(length):
@@ -530,11 +684,12 @@ def generate_random_key(length):
 
 def get_secret_key(name='reveal', length=20):
     """Gets the secret key for authorizing reveal operations etc."""
-    secret = model.Secret.get_by_key_name(name)
+    secret = model.secret_cache.get(name)
     if not secret:
         secret = model.Secret(key_name=name,
                               secret=generate_random_key(length))
         secret.put()
+        model.secret_cache.invalidate()
     return secret.secret
 
 
@@ -604,6 +759,7 @@ class BaseHandler(webapp.RequestHandler):
         'error': strip,
         'expiry_option': validate_expiry,
         'family_name': strip,
+        'follow_links': validate_yes,
         'full_read_permission': validate_checkbox_as_bool,
         'given_name': strip,
         'home_city': strip,
@@ -640,6 +796,7 @@ class BaseHandler(webapp.RequestHandler):
         'query_type': strip,
         'read_permission': validate_checkbox_as_bool,
         'referrer': strip,
+        'repo_url': strip,
         'resource_bundle': validate_resource_name,
         'resource_bundle_default': validate_resource_name,
         'resource_bundle_original': validate_resource_name,
@@ -650,6 +807,7 @@ class BaseHandler(webapp.RequestHandler):
         'search_permission': validate_checkbox_as_bool,
         'sex': validate_sex,
         'signature': strip,
+        'size': strip_and_lower,
         'skip': validate_int,
         'small': validate_yes,
         'source': strip,
@@ -697,6 +855,22 @@ class BaseHandler(webapp.RequestHandler):
         Since this is intended for use by a dynamic page handler, caching is
         off by default; if cache_seconds is positive, then get_vars() will be
         called only when cached content is unavailable."""
+        rendering = self.get_rendering(
+            name, language_override, cache_seconds, get_vars, **vars)
+        return rendering and rendering.content
+
+    def render_with_etag(self, name, cache_seconds, max_age=None, **vars):
+        """Renders a template whose content depends only on the request URL,
+        caching the result for cache_seconds and sending it with an ETag so
+        that the client can revalidate its copy (see write_variant)."""
+        rendering = self.get_rendering(name, None, cache_seconds, **vars)
+        write_variant(self.request, self.response,
+                      rendering.get_variant(self.env.charset), max_age)
+
+    def get_rendering(self, name, language_override=None, cache_seconds=0,
+                      get_vars=lambda: {}, **vars):
+        """Renders a template to a resources.Rendering.  The arguments are the
+        same as for render_to_string."""
         # TODO(kpy): Make the contents of extra_key overridable by callers?
         lang = language_override or self.env.lang
         extra_key = (self.env.repo, self.env.charset, self.request.query_string)
@@ -706,7 +880,7 @@ class BaseHandler(webapp.RequestHandler):
             vars['params'] = self.params  # pass along the query parameters
             vars.update(get_vars())
             return vars
-        return resources.get_rendered(
+        return resources.get_rendering(
             name, lang, extra_key, get_all_vars, cache_seconds)
 
     def error(self, code, message='', message_html=''):
@@ -770,10 +944,23 @@ class BaseHandler(webapp.RequestHandler):
         path = '/%s/%s' % (repo, action)
         taskqueue.add(name=task_name, method='GET', url=path, params=kwargs)
 
+    def add_update_status_task(self, person_record_id):
+        """Queues up a task to recompute latest_status on a single Person,
+        e.g. after one of its Notes has been hidden or revealed."""
+        # Unlike add_task_for_repo, don't name the task: one request can add
+        # tasks for several Persons within the same millisecond.
+        taskqueue.add(method='GET',
+                      url='/%s/tasks/update_person_status' % self.repo,
+                      params={'id': person_record_id})
+
+    def get_mail_sender(self):
+        """Gets a sender address that's allowed for this app."""
+        return 'Do not reply <do-not-reply@%s.%s>' % (
+            get_app_name(), EMAIL_DOMAIN)
+
     def send_mail(self, to, subject, body):
         """Sends e-mail using a sender address that's allowed for this app."""
-        app_id = get_app_name()
-        sender = 'Do not reply <do-not-reply@%s.%s>' % (app_id, EMAIL_DOMAIN)
+        sender = self.get_mail_sender()
         logging.info('Add mail task: recipient %r, subject %r' % (to, subject))
         taskqueue.add(queue_name='send-mail', url='/global/admin/send_mail',
                       params={'sender': sender,
@@ -781,6 +968,23 @@ class BaseHandler(webapp.RequestHandler):
                               'subject': subject,
                               'body': body})
 
+    def send_mails(self, messages):
+        """Sends many e-mail messages, given as (to, subject, body) tuples,
+        adding the tasks to the send-mail queue in as few calls as possible."""
+        sender = self.get_mail_sender()
+        tasks = []
+        for to, subject, body in messages:
+            logging.info('Add mail task: recipient %r, subject %r' %
+                         (to, subject))
+            tasks.append(taskqueue.Task(url='/global/admin/send_mail',
+                                        params={'sender': sender,
+                                                'to': to,
+                                                'subject': subject,
+                                                'body': body}))
+        queue = taskqueue.Queue('send-mail')
+        for i in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+            queue.add(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+
     def get_captcha_html(self, error_code=None, use_ssl=False):
         """Generates the necessary HTML to display a CAPTCHA validation box."""
 
@@ -789,6 +993,7 @@ class BaseHandler(webapp.RequestHandler):
         # reCAPTCHA falls back to 'en' if this parameter isn't recognized.
         lang = self.env.lang.split('-')[0]
 
+        from recaptcha.client import captcha  # loaded only when needed
         return captcha.get_display_html(
             public_key=config.get('captcha_public_key'),
             use_ssl=use_ssl, error=error_code, lang=lang,
@@ -813,6 +1018,7 @@ class BaseHandler(webapp.RequestHandler):
         challenge = self.request.get('recaptcha_challenge_field')
         response = self.request.get('recaptcha_response_field')
         remote_ip = os.environ['REMOTE_ADDR']
+        from recaptcha.client import captcha  # loaded only when needed
         return captcha.submit(
             challenge, response, config.get('captcha_private_key'), remote_ip)
 
@@ -836,7 +1042,7 @@ class BaseHandler(webapp.RequestHandler):
 
     def __init__(self, request, response, env):
         webapp.RequestHandler.__init__(self, request, response)
-        self.params = Struct()
+        self.params = Params(self.auto_params)
         self.env = env
         self.repo = env.repo
         self.config = env.config
@@ -846,14 +1052,18 @@ class BaseHandler(webapp.RequestHandler):
         self.response.headers['Content-Type'] = (
             'text/html; charset=%s' % self.charset)
 
-        # Validate query parameters.
-        for name, validator in self.auto_params.items():
-            try:
-                value = self.request.get(name, '')
-                setattr(self.params, name, validator(value))
-            except Exception, e:
-                setattr(self.params, name, validator(None))
-                return self.error(400, 'Invalid parameter %s: %s' % (name, e))
+        # Validate the query parameters present in the request.  The others
+        # get their default values when they're first read (see Params).
+        for name in self.request.arguments():
+            validator = self.auto_params.get(name)
+            if validator:
+                try:
+                    value = self.request.get(name, '')
+                    setattr(self.params, name, validator(value))
+                except Exception, e:
+                    setattr(self.params, name, validator(None))
+                    return self.error(
+                        400, 'Invalid parameter %s: %s' % (name, e))
 
         # Ensure referrer is in whitelist, if it exists
         if self.params.referrer and (not self.params.referrer in
@@ -864,11 +1074,13 @@ class BaseHandler(webapp.RequestHandler):
         sample_rate = float(
             self.config and self.config.user_agent_sample_rate or 0)
         if random.random() < sample_rate:
-            model.UserAgentLog(
+            model.log_buffer.add(model.UserAgentLog(
+                key_name=model.new_log_key_name(),
                 repo=self.repo, sample_rate=sample_rate,
-                user_agent=self.request.headers.get('User-Agent'), lang=lang,
+                user_agent=self.request.headers.get('User-Agent'),
+                lang=self.env.lang,
                 accept_charset=self.request.headers.get('Accept-Charset', ''),
-                ip_address=self.request.remote_addr).put()
+                ip_address=self.request.remote_addr))
 
         # Check for SSL (unless running on localhost for development).
         if self.https_required and self.env.domain != 'localhost':
@@ -880,10 +1092,11 @@ class BaseHandler(webapp.RequestHandler):
         if self.params.key:
             if self.repo:
                 # check for domain specific one.
-                self.auth = model.Authorization.get(self.repo, self.params.key)
+                self.auth = model.Authorization.get_cached(
+                    self.repo, self.params.key)
             if not self.auth:
                 # perhaps this is a global key ('*' for consistency with config).
-                self.auth = model.Authorization.get('*', self.params.key)
+                self.auth = model.Authorization.get_cached('*', self.params.key)
         if self.auth and not self.auth.is_valid:
             self.auth = None
 
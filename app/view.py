@@ -16,9 +16,9 @@
 from google.appengine.api import datastore_errors
 
 from model import *
-from photo import create_photo, PhotoError
+from photo import add_renditions_task, create_photo, PhotoError
 from utils import *
-from detect_spam import SpamDetector
+from detect_spam import get_spam_detector
 import extend
 import reveal
 import subscribe
@@ -195,8 +195,9 @@ class Handler(BaseHandler):
             except PhotoError, e:
                 return self.error(400, e.message)
             photo.put()
+            add_renditions_task(photo, self)
 
-        spam_detector = SpamDetector(self.config.bad_words)
+        spam_detector = get_spam_detector(self.config.bad_words)
         spam_score = spam_detector.estimate_spam_score(self.params.text)
 
         if (spam_score > 0):
@@ -245,6 +246,8 @@ class Handler(BaseHandler):
                 photo_url=photo_url)
             # Write the new regular Note to the datastore
             db.put(note)
+            ReviewQueueCount.update(
+                self.repo, new_queues=[ReviewQueueCount.get_queue(note)])
             UserActionLog.put_new('add', note, copy_properties=False)
 
         # Specially log 'believed_dead'.
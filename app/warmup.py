@@ -0,0 +1,88 @@
+#!/usr/bin/python2.7
+# Copyright 2014 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Handler for App Engine warmup requests, which are sent to a new instance
+before it starts receiving user traffic."""
+
+import django_setup  # always keep this first
+
+import logging
+import time
+
+import django.utils.translation
+from google.appengine.ext import webapp
+from google.appengine.ext.webapp.util import run_wsgi_app
+
+import config
+import main
+import model
+import resources
+
+
+def get_configured_langs():
+    """Returns the languages offered in the language menu of any repo."""
+    langs = set([django_setup.LANGUAGE_CODE])
+    for repo in model.Repo.list():
+        langs.update(config.get_for_repo(repo, 'language_menu_options') or [])
+    return sorted(langs)
+
+
+def preload_config(repos):
+    """Loads the settings for all the given repos into the config cache, with
+    all the datastore queries running in parallel."""
+    config_dicts = config.load_dicts('*', *repos)
+    for repo, config_dict in config_dicts.items():
+        config.cache.add(repo, config_dict, config.cache.expiry_time)
+    return len(config_dicts)
+
+
+def preload_handler_modules():
+    """Imports the modules for all the handlers, which main.py otherwise
+    imports only when the first request for each one arrives."""
+    module_names = set(target.split('.')[0]
+                       for target in main.HANDLER_CLASSES.values())
+    for module_name in module_names:
+        __import__(module_name)
+    return len(module_names)
+
+
+def preload_translations(langs):
+    """Loads the translation catalogs for the given languages.  Django keeps
+    each catalog for the life of the instance once it has been activated."""
+    for lang in langs:
+        django.utils.translation.activate(lang)
+    django.utils.translation.deactivate()
+
+
+class Handler(webapp.RequestHandler):
+    def get(self):
+        start_time = time.time()
+        config_count = preload_config(model.Repo.list())
+        module_count = preload_handler_modules()
+        langs = get_configured_langs()
+        preload_translations(langs)
+        bundle_name = config.get('default_resource_bundle', '1')
+        template_count = resources.warm_up(langs, bundle_name)
+        logging.info(
+            'Warmed up in %.3f s: %d settings dicts, %d handler modules, '
+            '%d templates for languages %s; cache stats: %r' % (
+                time.time() - start_time, config_count, module_count,
+                template_count, ', '.join(langs), resources.get_cache_stats()))
+
+
+application = webapp.WSGIApplication([('.*', Handler)])
+
+if __name__ == '__main__':
+    run_wsgi_app(application)
@@ -786,9 +786,10 @@ class PersonNoteTests(TestsBase):
             # button not found, assume task completed
             pass
         # taskqueue takes a second to actually queue up multiple requests,
-        # so we pause here to allow that to happen.
+        # and notifications pass through the notify_subscribers task before
+        # reaching the send-mail queue, so we pause here to allow that.
         count = 0
-        while len(self.mail_server.messages) < message_count and count < 10:
+        while len(self.mail_server.messages) < message_count and count < 50:
             count += 1
             time.sleep(.1)
 
@@ -6044,7 +6045,8 @@ class ConfigTests(TestsBase):
             seek_query_form_custom_htmls='{"no": "query form message"}',
             footer_custom_htmls='{"no": "footer message"}',
             bad_words = 'bad, word',
-            force_https = 'false'
+            force_https = 'false',
+            notification_digest_minutes = '10'
         )
         self.assertEquals(self.s.status, 200)
         cfg = config.Configuration('xyz')
@@ -6065,6 +6067,7 @@ class ConfigTests(TestsBase):
         assert not cfg.read_auth_key_required
         assert cfg.bad_words == 'bad, word'
         assert not cfg.force_https
+        assert cfg.notification_digest_minutes == 10
 
         old_updated_date = cfg.updated_date
         self.advance_utcnow(seconds=1)
@@ -6093,7 +6096,8 @@ class ConfigTests(TestsBase):
             seek_query_form_custom_htmls='{"nl": "query form message"}',
             footer_custom_htmls='{"no": "footer message"}',
             bad_words = 'foo, bar',
-            force_https = 'true'
+            force_https = 'true',
+            notification_digest_minutes = '0'
         )
 
         cfg = config.Configuration('xyz')
@@ -6114,6 +6118,7 @@ class ConfigTests(TestsBase):
         assert cfg.read_auth_key_required
         assert cfg.bad_words == 'foo, bar'
         assert cfg.force_https
+        assert cfg.notification_digest_minutes == 0
         # Changing configs other than 'deactivated' or 'test_mode' does not
         # renew 'updated_date'.
         assert cfg.updated_date == old_updated_date
@@ -22,12 +22,26 @@ import logging
 import sys
 import unittest
 
+from google.appengine import runtime
+from google.appengine.ext import db
+
 import api
+import importer
 import model
+import simplejson
 import test_handler
+import utils
 
 class APITests(unittest.TestCase):
 
+    def tearDown(self):
+        utils.set_utcnow_for_test(None)
+        db.delete(model.Person.all())
+        db.delete(model.Note.all())
+        db.delete(model.Tombstone.all())
+        db.delete(model.ImportJob.all())
+        db.delete(model.ImportJobChunk.all())
+
     def test_sms_render_person(self):
         handler = test_handler.initialize_handler(
             api.HandleSMS, 'api/handle_sms')
@@ -58,3 +72,174 @@ class APITests(unittest.TestCase):
             home_state='California',
             entry_date=datetime.datetime(2010, 1, 1))
         assert handler.render_person(person) == 'John Smith / From: California'
+
+    def test_import_job(self):
+        """Verify that an interrupted import job resumes after the last batch
+        it finished, without writing any of the earlier rows again."""
+        rows = ['person_record_id,source_date,text']
+        for i in range(250):
+            rows.append('person.1,2010-01-01T00:00:00Z,Note %d' % i)
+        job = model.ImportJob.create(
+            'haiti', '\n'.join(rows), format='notes', domain='test.google.com')
+
+        def run_worker():
+            handler = test_handler.initialize_handler(
+                api.ImportWorker, api.ImportWorker.ACTION,
+                params={'id': job.job_id})
+            handler.get()
+
+        # Interrupt the job during its second batch.
+        original_import_records = importer.import_records
+        first_texts = []
+        def import_records(repo, domain, converter, records, **kwargs):
+            first_texts.append(records[0]['text'])
+            if len(first_texts) == 2:
+                raise db.Timeout()
+            return original_import_records(
+                repo, domain, converter, records, **kwargs)
+        importer.import_records = import_records
+        try:
+            try:
+                run_worker()
+                assert False, 'expected the batch to fail'
+            except db.Timeout:
+                pass
+            job = model.ImportJob.get('haiti', job.job_id)
+            assert job.row_offset == 100
+            assert model.Note.all().count() == 100
+
+            run_worker()
+        finally:
+            importer.import_records = original_import_records
+
+        # The job resumed at row 100 and imported every row exactly once.
+        assert first_texts == ['Note 0', 'Note 100', 'Note 100', 'Note 200']
+        job = model.ImportJob.get('haiti', job.job_id)
+        assert job.status == 'done'
+        assert (job.row_offset, job.row_count) == (250, 250)
+        assert (job.notes_written, job.notes_total) == (250, 250)
+        assert model.Note.all().count() == 250
+        assert model.Note.get('haiti', 'test.google.com/import.%s.42' %
+                              job.job_id).text == 'Note 42'
+        assert model.ImportJobChunk.all().count() == 0
+
+    def test_import_job_retried_without_progress(self):
+        """Verify that a task interrupted before it finishes a batch fails, so
+        that the task queue retries it, and that later tasks start parsing
+        from the recorded position."""
+        rows = ['time_zone_offset', '2', 'person_record_id,source_date,text']
+        for i in range(150):
+            rows.append('person.1,2010-01-01 12:00,Note %d' % i)
+        job = model.ImportJob.create(
+            'haiti', '\n'.join(rows), format='notes', domain='test.google.com')
+
+        def run_worker():
+            handler = test_handler.initialize_handler(
+                api.ImportWorker, api.ImportWorker.ACTION,
+                params={'id': job.job_id})
+            handler.get()
+
+        original_import_records = importer.import_records
+        calls = []
+        def import_records(repo, domain, converter, records, **kwargs):
+            calls.append(records[0]['text'])
+            if len(calls) in [1, 3]:
+                raise runtime.DeadlineExceededError()
+            return original_import_records(
+                repo, domain, converter, records, **kwargs)
+        importer.import_records = import_records
+        try:
+            self.assertRaises(runtime.DeadlineExceededError, run_worker)
+            job = model.ImportJob.get('haiti', job.job_id)
+            assert (job.row_offset, job.row_count) == (0, 150)
+            assert job.byte_offset == job.header_end == len(
+                '\n'.join(rows[:3])) + 1
+
+            # The retried task makes progress, then is interrupted again,
+            # which queues a task for the remaining rows.
+            original_add_import_task = api.add_import_task
+            queued = []
+            api.add_import_task = queued.append
+            try:
+                run_worker()
+            finally:
+                api.add_import_task = original_add_import_task
+            job = model.ImportJob.get('haiti', job.job_id)
+            assert len(queued) == 1
+            assert job.row_offset == 100
+            assert job.byte_offset == len('\n'.join(rows[:103])) + 1
+
+            run_worker()
+        finally:
+            importer.import_records = original_import_records
+
+        assert calls == ['Note 0', 'Note 0', 'Note 100', 'Note 100']
+        job = model.ImportJob.get('haiti', job.job_id)
+        assert job.status == 'done'
+        assert (job.notes_written, job.notes_total) == (150, 150)
+        note = model.Note.get(
+            'haiti', 'test.google.com/import.%s.120' % job.job_id)
+        assert note.text == 'Note 120'
+        # The time zone offset from the preamble still applies.
+        assert note.source_date == datetime.datetime(2010, 1, 1, 10, 0)
+
+    def test_changes(self):
+        """Verify that api/changes pages through every change to Persons and
+        Notes, including hidden Notes and deleted records."""
+        person = model.Person.create_original(
+            'haiti', full_name='John Smith',
+            entry_date=datetime.datetime(2010, 1, 1))
+        doomed = model.Person.create_original(
+            'haiti', full_name='Jane Doe',
+            entry_date=datetime.datetime(2010, 1, 1))
+        notes = [model.Note.create_original(
+            'haiti', person_record_id=person.record_id, text='Note %d' % i,
+            entry_date=datetime.datetime(2010, 1, 1)) for i in range(3)]
+        doomed_note = model.Note.create_original(
+            'haiti', person_record_id=doomed.record_id, text='Doomed',
+            entry_date=datetime.datetime(2010, 1, 1))
+        notes[1].hidden = True
+        db.put([person, doomed, doomed_note] + notes)
+        doomed.delete_related_entities(delete_self=True)
+
+        # Look from after the safety lag, so all the changes are visible.
+        utils.set_utcnow_for_test(
+            datetime.datetime.now() + datetime.timedelta(hours=1))
+        changes = []
+        cursor = ''
+        while True:
+            handler = test_handler.initialize_handler(
+                api.Changes, 'api/changes',
+                params={'max_results': '2', 'cursor': cursor})
+            handler.get()
+            result = simplejson.loads(handler.response.out.getvalue())
+            assert len(result['changes']) <= 2
+            changes += result['changes']
+            cursor = result['cursor']
+            if not result['more']:
+                break
+
+        changes_by_id = dict((c['record_id'], c) for c in changes)
+        assert len(changes) == len(changes_by_id) == 6
+        assert changes_by_id[person.record_id]['type'] == 'person'
+        assert changes_by_id[person.record_id]['record']['full_name'] == \
+            'John Smith'
+        assert changes_by_id[notes[0].record_id]['record']['text'] == 'Note 0'
+        assert changes_by_id[notes[1].record_id]['hidden']
+        assert 'record' not in changes_by_id[notes[1].record_id]
+        assert changes_by_id[doomed.record_id] == {
+            'type': 'person', 'record_id': doomed.record_id, 'deleted': True}
+        assert changes_by_id[doomed_note.record_id] == {
+            'type': 'note', 'record_id': doomed_note.record_id,
+            'deleted': True}
+
+        # A later request with the last cursor finds only new changes.
+        notes[2].text = 'Edited'
+        notes[2].put()
+        handler = test_handler.initialize_handler(
+            api.Changes, 'api/changes', params={'cursor': cursor})
+        handler.get()
+        result = simplejson.loads(handler.response.out.getvalue())
+        assert [c['record_id'] for c in result['changes']] == [
+            notes[2].record_id]
+        assert result['changes'][0]['record']['text'] == 'Edited'
@@ -0,0 +1,74 @@
+# Copyright 2014 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for tools/batch_loader.py."""
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from batch_loader import BatchLoader
+
+
+class BatchLoaderTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.checkpoint_path = os.path.join(self.temp_dir, 'checkpoint')
+        self.lock = threading.Lock()
+        self.loaded = []
+        self.failures = {}  # number of times to fail, keyed by first record
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def load_batch(self, batch):
+        with self.lock:
+            if self.failures.get(batch[0]):
+                self.failures[batch[0]] -= 1
+                raise IOError('failed to load batch %d' % batch[0])
+            self.loaded.extend(batch)
+
+    def make_loader(self, **kwargs):
+        return BatchLoader(self.load_batch, batch_size=3, threads=2,
+                           checkpoint_path=self.checkpoint_path,
+                           backoff_seconds=0, **kwargs)
+
+    def test_run(self):
+        assert self.make_loader().run(iter(range(20))) == 20
+        assert sorted(self.loaded) == range(20)
+        assert not os.path.exists(self.checkpoint_path)
+
+    def test_retry(self):
+        self.failures[9] = 2
+        assert self.make_loader(max_attempts=3).run(iter(range(20))) == 20
+        assert sorted(self.loaded) == range(20)
+
+    def test_resume(self):
+        # Batches are loaded 2 at a time, so the batch starting at 12 fails
+        # after the first 12 records are stored.
+        self.failures[12] = 1
+        loader = self.make_loader(max_attempts=1)
+        self.assertRaises(IOError, loader.run, iter(range(20)))
+        assert open(self.checkpoint_path).read() == '12\n'
+
+        self.loaded = []
+        assert self.make_loader().run(iter(range(20))) == 20
+        assert sorted(self.loaded) == range(12, 20)
+        assert not os.path.exists(self.checkpoint_path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+#!/usr/bin/python2.7
+# encoding: utf-8
+# Copyright 2014 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Stress tests for serving requests on concurrent threads."""
+
+import sys
+import threading
+import unittest
+
+from google.appengine.ext import db
+from google.appengine.ext import webapp
+import webob
+
+import main
+import model
+import resources
+from resources import Resource, ResourceBundle
+
+
+def setup_request(path, cookie=''):
+    """Constructs a webapp.Request object for a given request path."""
+    return webapp.Request(
+        webob.Request.blank(path, headers={'Cookie': cookie}).environ)
+
+def run_threads(target, args_list):
+    """Runs target(*args) on a separate thread for each item in args_list,
+    and re-raises the first exception raised on any of the threads."""
+    errors = []
+    def run(args):
+        try:
+            target(*args)
+        except:
+            errors.append(sys.exc_info())
+    threads = [threading.Thread(target=run, args=(args,))
+               for args in args_list]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+
+class ConcurrencyTests(unittest.TestCase):
+    def setUp(self):
+        resources.clear_caches()
+        self.keys = []
+        for bundle_name, label in [('1', 'one'), ('2', 'two')]:
+            bundle = ResourceBundle(key_name=bundle_name)
+            self.keys.append(Resource(
+                parent=bundle, key_name='echo.html.template', content=
+                label + ' {{env.lang}} {% load i18n %}'
+                '{% get_current_language as lang %}{{lang}}').put())
+
+    def tearDown(self):
+        resources.clear_caches()
+        db.delete(self.keys)
+
+    def test_requests_use_their_own_bundle_and_language(self):
+        def serve(lang, bundle_name, label):
+            for i in range(20):
+                request = setup_request('/global/echo.html?lang=' + lang,
+                                        'resource_bundle=' + bundle_name)
+                response = webapp.Response()
+                main.Main(request, response).get()
+                assert response.body == '%s %s %s' % (label, lang, lang), (
+                    response.body)
+                assert response.headers['Content-Language'] == lang
+        run_threads(serve, [(lang, bundle_name, label)
+                            for lang in ['en', 'fr', 'es', 'ja']
+                            for bundle_name, label in [('1', 'one'),
+                                                       ('2', 'two')]])
+
+    def test_active_bundle_name_is_per_thread(self):
+        def check(bundle_name):
+            for i in range(100):
+                resources.set_active_bundle_name(bundle_name)
+                assert resources.get_active_bundle_name() == bundle_name
+        run_threads(check, [(str(n),) for n in range(8)])
+
+    def test_ram_cache(self):
+        cache = resources.RamCache(max_entries=50, max_bytes=500)
+        def hammer(n):
+            for i in range(2000):
+                key = (n*7 + i) % 100
+                cache.put(key, 'x'*(key % 20), 10)
+                value = cache.get(key)
+                assert value is None or value == 'x'*(key % 20)
+        run_threads(hammer, [(n,) for n in range(8)])
+        stats = cache.stats()
+        assert stats['entries'] <= 50
+        assert stats['bytes'] <= 500
+        assert stats['bytes'] == sum(
+            size for value, expiry, size in cache.cache.values())
+
+    def test_log_buffers_are_per_thread(self):
+        def buffer(n):
+            model.log_buffer.start()
+            for i in range(n):
+                model.log_buffer.add(n)
+            assert model.log_buffer.entities == [n]*n
+            model.log_buffer.entities = []  # don't try to store the ints
+            model.log_buffer.flush()
+        run_threads(buffer, [(n,) for n in range(1, 9)])
+
+
+if __name__ == '__main__':
+    unittest.main()
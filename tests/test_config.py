@@ -0,0 +1,84 @@
+#!/usr/bin/python2.7
+# Copyright 2014 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for config.py."""
+
+import unittest
+
+from google.appengine.ext import db
+
+import config
+
+
+class ConfigTests(unittest.TestCase):
+    def tearDown(self):
+        db.delete([db.Key.from_path('ConfigEntry', repo + ':' + name)
+                   for repo in ['*', 'haiti']
+                   for name in ['foo', 'bar']])
+
+    def test_load_dicts(self):
+        config.set(foo='global_foo', bar=1)
+        config.set_for_repo('haiti', foo='haiti_foo')
+        dicts = config.load_dicts('*', 'haiti', '_empty')
+        assert dicts['*']['foo'] == 'global_foo'
+        assert dicts['*']['bar'] == 1
+        assert dicts['haiti']['foo'] == 'haiti_foo'
+        assert 'bar' not in dicts['haiti']
+        assert dicts['_empty'] == {}
+
+    def test_configuration(self):
+        config.set(foo='global_foo', bar='global_bar')
+        config.set_for_repo('haiti', foo='haiti_foo')
+        cfg = config.Configuration('haiti')
+        assert cfg.foo == 'haiti_foo'
+        assert cfg.bar == 'global_bar'
+        assert cfg.baz is None
+        assert 'foo' in cfg.keys()
+        assert 'bar' not in cfg.keys()
+
+        # The settings don't change for the lifetime of the snapshot...
+        config.set_for_repo('haiti', foo='new_foo')
+        assert cfg.foo == 'haiti_foo'
+        # ...but a new snapshot sees the change.
+        assert config.Configuration('haiti').foo == 'new_foo'
+
+    def test_request_settings(self):
+        config.set(foo='global_foo')
+        config.request_settings.start()
+        try:
+            assert config.get('foo') == 'global_foo'
+            assert config.Configuration('*').foo == 'global_foo'
+
+            # Later reads come from the snapshot, without touching the cache.
+            config.cache.is_enabled = None
+            try:
+                db.put(config.ConfigEntry(key_name='*:foo', value='"new_foo"'))
+                assert config.get('foo') == 'global_foo'
+                assert config.get('bar', 'default') == 'default'
+            finally:
+                del config.cache.is_enabled
+
+            # A change made with set() is seen by the rest of the request.
+            config.set(foo='set_foo')
+            assert config.get('foo') == 'set_foo'
+        finally:
+            config.request_settings.stop()
+
+        db.put(config.ConfigEntry(key_name='*:foo', value='"new_foo"'))
+        assert config.get('foo') == 'new_foo'
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,7 +7,7 @@
 __author__ = 'shaomei@google.com (Shaomei Wu)'
 
 from google.appengine.ext import db
-from detect_spam import SpamDetector
+from detect_spam import SpamDetector, BadWordMatcher, get_spam_detector
 import unittest
 
 
@@ -16,6 +16,11 @@ class SpamDetectorTests(unittest.TestCase):
         d = SpamDetector('foo, BAR')
         assert set(['foo', 'bar']) == d.bad_words_set
 
+    def test_detectors_are_independent(self):
+        SpamDetector('foo')
+        assert SpamDetector('bar').bad_words_set == set(['bar'])
+        assert SpamDetector('').bad_words_set == set()
+
     def test_estimate_spam_score(self):
         d = SpamDetector('foo, BAR')
         assert d.estimate_spam_score('a sentence with foo, bar') == 0.4
@@ -25,5 +30,38 @@ class SpamDetectorTests(unittest.TestCase):
         assert d.estimate_spam_score('  ,') == None
         assert d.estimate_spam_score('') == None 
 
+    def test_phrases(self):
+        d = SpamDetector('free  money, BAR')
+        assert d.bad_words_set == set(['free money', 'bar'])
+        assert d.estimate_spam_score('Get FREE\nmoney now') == 0.25
+        assert d.estimate_spam_score('free of money') == 0
+
+    def test_word_boundaries(self):
+        d = SpamDetector('ham, he')
+        assert d.estimate_spam_score('hamster') == 0
+        assert d.estimate_spam_score('the shed') == 0
+        assert d.estimate_spam_score('ham-radio') == 0
+        assert d.estimate_spam_score('(ham) and he, ok.') == 0.5
+        # CJK text has no spaces between words.
+        d = SpamDetector(u'\u5730\u9707')
+        assert d.estimate_spam_score(u'\u6771\u5317\u5730\u9707 x') == 1
+
+    def test_matcher(self):
+        matcher = BadWordMatcher(['he', 'she', 'his', 'hers', ''])
+        assert matcher.find('ushers') == set()
+        assert matcher.find('she is hers') == set(['she', 'hers'])
+        assert matcher.find('his he') == set(['his', 'he'])
+        assert BadWordMatcher([]).find('anything') == set()
+
+    def test_estimate_spam_scores(self):
+        d = SpamDetector('foo')
+        assert d.estimate_spam_scores(['foo bar', '', 'x', 'foo bar']) == [
+            0.5, None, 0, 0.5]
+
+    def test_get_spam_detector(self):
+        d = get_spam_detector('foo, bar')
+        assert get_spam_detector('foo, bar') is d
+        assert get_spam_detector('foo') is not d
+
 if __name__ == '__main__':
     unittest.main()
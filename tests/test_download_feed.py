@@ -0,0 +1,168 @@
+# Copyright 2014 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for tools/download_feed.py, using a stub feed server."""
+
+import BaseHTTPServer
+import csv
+import os
+import shutil
+import SocketServer
+import StringIO
+import tempfile
+import threading
+import unittest
+import urlparse
+
+import download_feed
+import pfif
+
+PFIF = pfif.PFIF_VERSIONS[pfif.PFIF_DEFAULT_VERSION]
+
+
+class StubFeedServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A Person feed that supports min_entry_date, skip, and max_results, and
+    fails the requests with a min_entry_date at or after fail_after."""
+    daemon_threads = True
+
+    def __init__(self, persons):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ('127.0.0.1', 0), StubFeedHandler)
+        self.persons = sorted(
+            persons, key=lambda p: (p['entry_date'], p['person_record_id']))
+        self.fail_after = None
+        self.requests = []  # (client_address, query params) for each request
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/haiti/feeds/person' % self.server_port
+
+
+class StubFeedHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep connections open
+
+    def do_GET(self):
+        query = urlparse.urlparse(self.path).query
+        params = dict(urlparse.parse_qsl(query))
+        self.server.requests.append((self.client_address, params))
+        min_entry_date = params.get('min_entry_date', '')
+        if self.server.fail_after and min_entry_date >= self.server.fail_after:
+            self.send_response(500)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        skip = int(params.get('skip', 0))
+        max_results = int(params.get('max_results', 10))
+        persons = [p for p in self.server.persons
+                   if p['entry_date'] >= min_entry_date]
+        output = StringIO.StringIO()
+        PFIF.write_file(output, persons[skip:skip + max_results])
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(output.getvalue())))
+        self.end_headers()
+        self.wfile.write(output.getvalue())
+
+    def log_message(self, *args):
+        pass
+
+
+class DownloadFeedTests(unittest.TestCase):
+    def setUp(self):
+        # Records 0 to 59 are entered 2 at a time, 3 hours apart.
+        self.persons = [
+            {'person_record_id': 'test.google.com/person.%d' % i,
+             'entry_date': '2010-01-%02dT%02d:00:00Z' % (
+                 1 + i//16, i//2 % 8 * 3),
+             'source_date': '2010-01-01T00:00:00Z',
+             'full_name': 'Person %d' % i} for i in range(60)]
+        self.server = StubFeedServer(self.persons)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.checkpoint_dir = tempfile.mkdtemp()
+        download_feed.quiet_mode = True
+        # Use small pages, so that each segment takes several requests.
+        self.original_page_size = download_feed.PAGE_SIZE
+        download_feed.PAGE_SIZE = 5
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.checkpoint_dir, ignore_errors=True)
+        download_feed.PAGE_SIZE = self.original_page_size
+        download_feed.MAX_ATTEMPTS = 5
+
+    def download(self, **kwargs):
+        """Downloads all the Person records to CSV and returns the rows."""
+        output = StringIO.StringIO()
+        writer = download_feed.PersonCsvWriter(
+            output, fields=['person_record_id', 'entry_date'])
+        download_feed.download_since(
+            'person', download_feed.PersonParser(), writer, self.server.url,
+            '2010-01-01T00:00:00Z', max_entry_date='2010-01-05T00:00:00Z',
+            checkpoint_dir=self.checkpoint_dir, **kwargs)
+        return list(csv.DictReader(StringIO.StringIO(output.getvalue())))
+
+    def test_split_date_range(self):
+        assert download_feed.split_date_range(
+            '2010-01-01T00:00:00Z', '2010-01-04T00:00:00Z', 3) == [
+            ('2010-01-01T00:00:00Z', '2010-01-02T00:00:00Z'),
+            ('2010-01-02T00:00:00Z', '2010-01-03T00:00:00Z'),
+            ('2010-01-03T00:00:00Z', None)]
+        # A segment is never shorter than a second.
+        assert download_feed.split_date_range(
+            '2010-01-01T00:00:00Z', '2010-01-01T00:00:02Z', 10) == [
+            ('2010-01-01T00:00:00Z', '2010-01-01T00:00:01Z'),
+            ('2010-01-01T00:00:01Z', None)]
+
+    def test_download_since(self):
+        rows = self.download(segments=7, threads=3)
+        # Every record is written once, in order of entry_date.
+        assert [row['person_record_id'] for row in rows] == [
+            p['person_record_id'] for p in self.server.persons]
+        # Each thread reuses its connection for all its requests.
+        clients = set(client for client, params in self.server.requests)
+        assert len(clients) <= 3 < len(self.server.requests)
+        # The checkpoints are removed when the download is complete.
+        assert not os.path.exists(self.checkpoint_dir)
+
+    def test_keep_other_files(self):
+        other_path = os.path.join(self.checkpoint_dir, 'other.txt')
+        open(other_path, 'w').write('keep me')
+        self.download(segments=3, threads=2)
+        # Only the checkpoint files are removed from an existing directory.
+        assert os.listdir(self.checkpoint_dir) == ['other.txt']
+
+    def test_resume(self):
+        download_feed.MAX_ATTEMPTS = 1
+        self.server.fail_after = '2010-01-03T00:00:00Z'
+        self.assertRaises(RuntimeError, self.download, segments=4, threads=1)
+        finished = [name for name in os.listdir(self.checkpoint_dir)
+                    if name.startswith('segment-') and name.endswith('.json')]
+        assert sorted(finished) == ['segment-0000.json', 'segment-0001.json']
+
+        # The second attempt only fetches the remaining segments.
+        self.server.fail_after = None
+        self.server.requests = []
+        rows = self.download(segments=4, threads=2)
+        assert [row['person_record_id'] for row in rows] == [
+            p['person_record_id'] for p in self.server.persons]
+        assert min(params['min_entry_date']
+                   for client, params in self.server.requests
+                   ) == '2010-01-03T00:00:00Z'
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -20,6 +20,7 @@ import unittest
 from google.appengine.ext import db
 from pytest import raises
 
+import config
 import model
 import importer
 
@@ -30,6 +31,7 @@ class ImporterTests(unittest.TestCase):
     def tearDown(self):
         db.delete(model.Person.all())
         db.delete(model.Note.all())
+        config.set_for_repo('haiti', bad_words='')
 
     def test_strip(self):
         assert importer.strip('') == ''
@@ -152,7 +154,7 @@ class ImporterTests(unittest.TestCase):
                             'family_name': family_name,
                             'person_record_id': record_id,
                             'source_date': source_date})
-        written, skipped, total = importer.import_records(
+        written, skipped, total, unchanged = importer.import_records(
             'haiti', 'test_domain', importer.create_person, records, False,
             True, None)
 
@@ -212,7 +214,7 @@ class ImporterTests(unittest.TestCase):
             records.append({'person_record_id': person_id,
                             'note_record_id': note_id,
                             'source_date': source_date})
-        written, skipped, total = importer.import_records(
+        written, skipped, total, unchanged = importer.import_records(
             'haiti', 'test_domain', importer.create_note, records, False,
             True, None)
 
@@ -268,7 +270,7 @@ class ImporterTests(unittest.TestCase):
                             'status': status})
  
         # Disallow import notes with status 'believed_dead'.        
-        written, skipped, total = importer.import_records(
+        written, skipped, total, unchanged = importer.import_records(
             'haiti', 'test_domain', importer.create_note, records, False,
             False, None)
 
@@ -304,12 +306,14 @@ class ImporterTests(unittest.TestCase):
 
         # Allow import notes with status 'believed_dead'.
         model.Note.all().get().delete()
-        written, skipped, total = importer.import_records(
+        written, skipped, total, unchanged = importer.import_records(
             'haiti', 'test_domain', importer.create_note, records, False,
             True, None)
 
-        assert written == 20
+        # Only the notes that are not already stored need to be written.
+        assert written == 4
         assert len(skipped) == 0
+        assert unchanged == 16
         assert model.Note.all().count() == 20
 
         for note in model.Note.all():
@@ -331,7 +335,7 @@ class ImporterTests(unittest.TestCase):
                             'source_date': source_date})
 
         # Import reviewed notes.
-        written, skipped, total = importer.import_records(
+        written, skipped, total, unchanged = importer.import_records(
             'haiti', 'test_domain', importer.create_note, records, True,
             True, None)
 
@@ -342,6 +346,99 @@ class ImporterTests(unittest.TestCase):
         for note in model.Note.all():
             assert note.reviewed == True
 
+    def test_import_spam_note_records(self):
+        """Notes with bad words stay unreviewed even if the import marks the
+        other notes as reviewed."""
+        config.set_for_repo('haiti', bad_words='buy now')
+        records = []
+        for i, text in enumerate(['Buy  now!', 'Seen at the shelter']):
+            records.append({'person_record_id': 'test_domain/person_%d' % i,
+                            'note_record_id': 'test_domain/record_%d' % i,
+                            'source_date': '2010-01-01T01:23:45Z',
+                            'text': text})
+
+        written, skipped, total, unchanged = importer.import_records(
+            'haiti', 'test_domain', importer.create_note, records, True,
+            True, None)
+
+        assert written == 2
+        assert not model.Note.get('haiti', 'test_domain/record_0').reviewed
+        assert model.Note.get('haiti', 'test_domain/record_1').reviewed
+
+    def test_import_unchanged_person_records(self):
+        records = [{'given_name': 'given_name_%d' % i,
+                    'family_name': 'family_name_%d' % i,
+                    'person_record_id': 'test_domain/person_%d' % i,
+                    'source_date': '2010-01-01T01:23:45Z'}
+                   for i in range(3)]
+        written, skipped, total, unchanged = importer.import_records(
+            'haiti', 'test_domain', importer.create_person, records)
+        assert (written, skipped, total, unchanged) == (3, [], 3, 0)
+        person = model.Person.get('haiti', 'test_domain/person_0')
+        assert person.content_fingerprint == \
+            person.get_content_fingerprint()
+        entry_date = person.entry_date
+
+        # Importing the same records again writes nothing.
+        written, skipped, total, unchanged = importer.import_records(
+            'haiti', 'test_domain', importer.create_person, records)
+        assert (written, skipped, total, unchanged) == (0, [], 3, 3)
+        person = model.Person.get('haiti', 'test_domain/person_0')
+        assert person.entry_date == entry_date
+
+        # Only the changed record is written.
+        records[1]['given_name'] = 'new_given_name'
+        records[1]['source_date'] = '2010-01-02T01:23:45Z'
+        written, skipped, total, unchanged = importer.import_records(
+            'haiti', 'test_domain', importer.create_person, records)
+        assert (written, skipped, total, unchanged) == (1, [], 3, 2)
+        person = model.Person.get('haiti', 'test_domain/person_1')
+        assert person.given_name == 'new_given_name'
+
+    def test_import_stale_records(self):
+        records = [{'given_name': 'given_name',
+                    'family_name': 'family_name',
+                    'person_record_id': 'test_domain/person_0',
+                    'source_date': '2010-01-02T01:23:45Z'}]
+        importer.import_records(
+            'haiti', 'test_domain', importer.create_person, records)
+
+        # A record older than the stored one is rejected.
+        old_records = [dict(records[0], given_name='old_given_name',
+                            source_date='2010-01-01T01:23:45Z')]
+        written, skipped, total, unchanged = importer.import_records(
+            'haiti', 'test_domain', importer.create_person, old_records)
+        assert (written, total, unchanged) == (0, 1, 0)
+        assert skipped == [(
+            'Not updated: the existing record has a newer source_date',
+            old_records[0])]
+        person = model.Person.get('haiti', 'test_domain/person_0')
+        assert person.given_name == 'given_name'
+
+    def test_import_duplicate_note_records(self):
+        records = [{'person_record_id': 'test_domain/person_0',
+                    'note_record_id': 'test_domain/record_%d' % i,
+                    'source_date': '2010-01-01T01:23:45Z',
+                    'text': 'Seen at the shelter'}
+                   for i in range(3)]
+        records[1]['text'] = ' Seen at the shelter\n'  # same after stripping
+        records[2]['text'] = 'Seen at the hospital'
+        written, skipped, total, unchanged = importer.import_records(
+            'haiti', 'test_domain', importer.create_note, records,
+            believed_dead_permission=True, omit_duplicate_notes=True)
+        assert (written, total) == (2, 3)
+        assert skipped == [
+            ('This is a duplicate of an existing note', records[1])]
+
+        # A stored note with the same content is also a duplicate.
+        record = dict(records[2], note_record_id='test_domain/record_3')
+        written, skipped, total, unchanged = importer.import_records(
+            'haiti', 'test_domain', importer.create_note, [record],
+            believed_dead_permission=True, omit_duplicate_notes=True)
+        assert (written, total) == (0, 1)
+        assert skipped == [('This is a duplicate of an existing note', record)]
+        assert model.Note.all().count() == 2
+
     def test_import_notes_disabled_note_records(self):
         '''Check that notes will be rejected from API import when 
         notes_disabled is set to be True by the record author.'''
@@ -363,7 +460,7 @@ class ImporterTests(unittest.TestCase):
                             'source_date': source_date,
                             'author_name': author_name,
                             'author_email': author_email})
-        written, skipped, total = importer.import_records(
+        written, skipped, total, unchanged = importer.import_records(
             'haiti', 'test_domain', importer.create_person, records, False,
             True, None)
 
@@ -391,7 +488,7 @@ class ImporterTests(unittest.TestCase):
             records.append({'person_record_id': person_id,
                             'note_record_id': note_id,
                             'source_date': source_date})
-        written, skipped, total = importer.import_records(
+        written, skipped, total, unchanged = importer.import_records(
             'haiti', 'test_domain', importer.create_note, records, False,
             True, None)
 
@@ -236,6 +236,64 @@ class IndexingTests(unittest.TestCase):
         assert self.get_matches(u'\u4f59\u5609\u5e73') == \
             [(u'\u5609\u5e73', u'\u4f59')]
 
+    def test_index_fingerprint(self):
+        person = create_person(given_name='Bryan', family_name='abc')
+        assert not indexing.is_index_current(person)
+        indexing.update_index_properties(person)
+        assert person.index_version == indexing.INDEX_VERSION
+        assert person.index_fingerprint
+        assert indexing.is_index_current(person)
+
+        # The fingerprint doesn't depend on the order of the tokens.
+        assert person.index_fingerprint == indexing.get_index_fingerprint(
+            reversed(sorted(person.names_prefixes)))
+
+        # Changing an indexed field makes the stored index stale.
+        person.family_name = 'abd'
+        assert not indexing.is_index_current(person)
+
+        # A record indexed by an older tokenizer is also stale.
+        indexing.update_index_properties(person)
+        person.index_version = indexing.INDEX_VERSION - 1
+        assert not indexing.is_index_current(person)
+
+    def test_search_old_index_version(self):
+        old = create_person(given_name='Bryan', family_name='abc')
+        indexing.update_index_properties(old)
+        # Simulate a record indexed by an older tokenizer that produced an
+        # extra token the current tokenizer no longer does.
+        old.names_prefixes.append('BRYANABC')
+        old.index_version = 0
+        db.put(old)
+        self.add_persons(create_person(given_name='Bryan', family_name='efg'))
+
+        # Tokens from both versions match records that haven't been migrated.
+        assert self.get_matches('bryanabc') == [('Bryan', 'abc')]
+        assert set(self.get_matches('bryan')) == \
+            set([('Bryan', 'abc'), ('Bryan', 'efg')])
+
+    def test_search_unmigrated_record(self):
+        old = create_person(given_name='Bryan', family_name='abc')
+        indexing.update_index_properties(old)
+        # Simulate a record indexed by an older tokenizer that didn't produce
+        # the tokens for the family name.
+        old.names_prefixes = [token for token in old.names_prefixes
+                              if token not in ['A', 'AB', 'ABC']]
+        db.put(old)
+        original_index_version = indexing.INDEX_VERSION
+        indexing.INDEX_VERSION += 1
+        try:
+            self.add_persons(
+                create_person(given_name='Bryan', family_name='efg'))
+
+            # The record is found by a token only the current tokenizer makes.
+            assert self.get_matches('abc') == [('Bryan', 'abc')]
+            assert self.get_matches('bryan ab') == [('Bryan', 'abc')]
+            assert set(self.get_matches('bryan')) == \
+                set([('Bryan', 'abc'), ('Bryan', 'efg')])
+        finally:
+            indexing.INDEX_VERSION = original_index_version
+
     def test_no_query_terms(self):
         # Regression test (this used to throw an exception).
         assert indexing.search('test', TextQuery(''), 100) == []
@@ -16,19 +16,27 @@
 
 """Tests for the Main handler."""
 
+import gzip
+import StringIO
 import unittest
 from google.appengine.ext import webapp
 import webob
 
 import config
 import django.utils
+import import_profile
 import main
+import resources
 import test_handler
 
 def setup_request(path):
     """Constructs a webapp.Request object for a given request path."""
     return webapp.Request(webob.Request.blank(path).environ)
 
+# Generous enough to pass on a slow machine, but catches heavy new imports.
+MAX_MAIN_IMPORT_SECONDS = 3
+
+
 class MainTests(unittest.TestCase):
     def test_get_repo_and_action(self):
         def check(path, repo, action):
@@ -82,6 +90,84 @@ class MainTests(unittest.TestCase):
         assert handler.env.lang == 'fr'  # first language in the options list
         assert django.utils.translation.get_language() == 'fr'
 
+    def test_env_fragment_cache(self):
+        """Verify that the request-independent parts of the env are reused
+        until the settings change."""
+        config.set_for_repo(
+            'haiti', repo_titles={'en': 'Haiti', 'fr': u'Ha\xefti'})
+        env = main.setup_env(setup_request('/haiti/start?lang=en'))
+        assert env.repo_title == 'Haiti'
+        misses = main.ENV_FRAGMENT_CACHE.misses
+        env2 = main.setup_env(setup_request('/haiti/view?lang=en&ui=default'))
+        assert main.ENV_FRAGMENT_CACHE.misses == misses
+        assert env2.status_options is env.status_options
+
+        # Request-dependent parts are still computed for each request.
+        assert env2.action == 'view'
+        assert env2.language_options[0]['url'] != (
+            env.language_options[0]['url'])
+
+        # A different language or a change in the settings needs a new one.
+        env = main.setup_env(setup_request('/haiti/start?lang=fr'))
+        assert env.repo_title == u'Ha\xefti'
+        config.set_for_repo('haiti', repo_titles={'en': 'Haiti Earthquake'})
+        env = main.setup_env(setup_request('/haiti/start?lang=en'))
+        assert env.repo_title == 'Haiti Earthquake'
+        assert main.ENV_FRAGMENT_CACHE.misses == misses + 2
+
+    def test_static_resource_etag(self):
+        """Verify that static resources are sent with an ETag and that a
+        matching If-None-Match header gets a 304 with no body."""
+        request = setup_request('/global/forms.js')
+        response = webapp.Response()
+        main.Main(request, response).get()
+        etag = response.headers['ETag']
+        assert response.status_int == 200
+        assert response.body == open('resources/forms.js').read()
+        assert 'max-age' not in response.headers.get('Cache-Control', '')
+
+        request = setup_request('/global/forms.js')
+        request.headers['If-None-Match'] = etag
+        response = webapp.Response()
+        main.Main(request, response).get()
+        assert response.status_int == 304
+        assert response.body == ''
+
+    def test_static_resource_gzip(self):
+        """Verify that the gzipped variant is sent if the client accepts it."""
+        request = setup_request('/global/forms.js')
+        request.headers['Accept-Encoding'] = 'gzip'
+        response = webapp.Response()
+        main.Main(request, response).get()
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert response.headers['Vary'] == 'Accept-Encoding'
+        body = gzip.GzipFile(fileobj=StringIO.StringIO(response.body)).read()
+        assert body == open('resources/forms.js').read()
+
+    def test_hashed_url(self):
+        """Verify that resources requested by hashed URLs are cacheable."""
+        url = resources.get_hashed_url('/global', 'forms.js', 'en')
+        assert url.startswith('/global/forms.js?lang=en&v=')
+        response = webapp.Response()
+        main.Main(setup_request(url), response).get()
+        assert response.headers['Cache-Control'] == (
+            'public, max-age=%d' % main.HASHED_URL_MAX_AGE_SECONDS)
+
+        # A stale hash shouldn't be cached for long.
+        response = webapp.Response()
+        main.Main(setup_request('/global/forms.js?v=123'), response).get()
+        assert 'max-age' not in response.headers.get('Cache-Control', '')
+
+    def test_cold_import_time(self):
+        """Verify that a new instance can import main.py quickly, without
+        loading the modules that only a few handlers need."""
+        seconds, modules = import_profile.profile_import(['main'])
+        assert seconds < MAX_MAIN_IMPORT_SECONDS
+        module_names = [name for seconds, name in modules]
+        for name in ['external_search', 'jp_mobile_carriers',
+                     'recaptcha.client', 'xml.dom.minidom']:
+            assert name not in module_names
+
 
 if __name__ == '__main__':
     unittest.main()
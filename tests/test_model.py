@@ -360,6 +360,87 @@ class ModelTests(unittest.TestCase):
         counter.increment(u'arbitrary \xef characters \u5e73 here')
         counter.put()  # without encode_count_name, this threw an exception
 
+    def test_log_buffer(self):
+        buffer = model.LogBuffer()
+        db.delete(model.UserActionLog.all())
+
+        # Outside of a request, entries are written immediately.
+        buffer.add(model.UserActionLog(
+            key_name=model.new_log_key_name(), time=get_utcnow(),
+            repo='haiti', action='add', entity_kind='Person',
+            entity_key_name=self.p1.key().name()))
+        assert model.UserActionLog.all().count() == 1
+
+        # During a request, entries are held until the buffer is flushed.
+        buffer.start()
+        for i in range(3):
+            buffer.add(model.UserActionLog(
+                key_name=model.new_log_key_name(), time=get_utcnow(),
+                repo='haiti', action='hide', entity_kind='Note',
+                entity_key_name=self.n1_1.key().name()))
+        assert model.UserActionLog.all().count() == 1
+        buffer.flush()
+        assert model.UserActionLog.all().count() == 4
+
+        # A full buffer is sent off without waiting for the end of the request.
+        buffer.MAX_BUFFERED = 2
+        buffer.start()
+        for i in range(3):
+            buffer.add(model.UserActionLog(
+                key_name=model.new_log_key_name(), time=get_utcnow(),
+                repo='haiti', action='unhide', entity_kind='Note',
+                entity_key_name=self.n1_1.key().name()))
+        assert len(buffer.entities) == 1
+        assert len(buffer.rpcs) == 1
+        buffer.flush()
+        assert model.UserActionLog.all().count() == 7
+        assert not buffer.active
+
+        db.delete(model.UserActionLog.all())
+
+    def test_entity_cache(self):
+        # Two caches with the same version number stand for two instances.
+        cache = model.EntityCache(model.Authorization, 60, 10)
+        other_cache = model.EntityCache(model.Authorization, 60, 10)
+        cache.VERSION_CHECK_SECONDS = other_cache.VERSION_CHECK_SECONDS = 0
+
+        # The absence of a key is cached too.
+        assert cache.get('*:abc') is None
+        auth = model.Authorization.create('*', 'abc', read_permission=True)
+        auth.put()
+        assert cache.get('*:abc') is None
+        assert other_cache.get('*:abc').read_permission
+
+        # A revoked key stays valid until the caches are invalidated.
+        auth.is_valid = False
+        auth.put()
+        assert other_cache.get('*:abc').is_valid
+        cache.invalidate()
+        assert cache.get('*:abc').is_valid is False
+        assert other_cache.get('*:abc').is_valid is False
+        auth.delete()
+
+    def test_review_queue_count(self):
+        # Nothing is reported until the queues have been counted.
+        assert model.ReviewQueueCount.get_counts('haiti') == {}
+        model.ReviewQueueCount.reset('haiti', {'hidden=TRUE': 2})
+
+        note = self.n1_1
+        assert model.ReviewQueueCount.get_queue(note) == 'unreviewed'
+        model.ReviewQueueCount.update('haiti', new_queues=['unreviewed'])
+        note.reviewed = note.hidden = True
+        assert model.ReviewQueueCount.get_queue(note) == 'hidden'
+        model.ReviewQueueCount.update('haiti', ['unreviewed'], ['hidden'])
+        note.is_expired = True
+        assert model.ReviewQueueCount.get_queue(note) is None
+        model.ReviewQueueCount.update('haiti', ['hidden'], [None])
+
+        counts = model.ReviewQueueCount.get_counts('haiti')
+        assert counts == {'hidden=TRUE': 2,
+                          'hidden=FALSE,reviewed=TRUE': 0,
+                          'hidden=FALSE,reviewed=FALSE': 0}
+        db.delete(model.ReviewQueueCount.all())
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -905,6 +905,21 @@ class PfifTests(unittest.TestCase):
             assert note_records == test_case.note_records, (test_name +
                 ':\n' + pprint_diff(test_case.note_records, note_records))
 
+    def test_generate_records(self):
+        """Tests that reading an XML file in small chunks for each test case
+        gives the same records as parsing the whole file."""
+        for test_name, test_case in TEST_CASES:
+            if not test_case.do_parse_test:
+                continue
+            records = list(pfif.generate_records(
+                StringIO.StringIO(test_case.xml), chunk_size=10))
+            person_records = [r for type, r in records if type == 'person']
+            note_records = [r for type, r in records if type == 'note']
+            assert person_records == test_case.person_records, (test_name +
+                ':\n' + pprint_diff(test_case.person_records, person_records))
+            assert note_records == test_case.note_records, (test_name +
+                ':\n' + pprint_diff(test_case.note_records, note_records))
+
     def test_write_file(self):
         """Tests writing of XML files for each test case."""
         for test_name, test_case in TEST_CASES:
@@ -19,9 +19,13 @@ __author__ = 'kpy@google.com (Ka-Ping Yee)'
 import os
 import unittest
 
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
 import model
 import photo
 import test_handler
+import utils
 
 class PhotoTests(unittest.TestCase):
     def test_get_photo_url(self):
@@ -36,6 +40,109 @@ class PhotoTests(unittest.TestCase):
             'http://example.appspot.com/haiti/photo?id=%s' % id,
             photo.get_photo_url(entity, ph))
 
+    def test_get_scaled_size(self):
+        assert photo.get_scaled_size(200, 100, 300) == (200, 100)
+        assert photo.get_scaled_size(600, 300, 300) == (300, 150)
+        assert photo.get_scaled_size(300, 600, 300) == (150, 300)
+        assert photo.get_scaled_size(3000, 1, 300) == (300, 1)
+
+    def test_photo_cache(self):
+        cache = photo.PhotoCache(10, 60)
+        cache.put('a', photo.PhotoData('1234', None))
+        cache.put('b', photo.PhotoData('5678', None))
+        assert cache.get('a').image_data == '1234'
+        # 'b' is now the least recently used, so it gets evicted.
+        cache.put('c', photo.PhotoData('90', None))
+        assert cache.get('b') is None
+        assert cache.get('a').image_data == '1234'
+        assert cache.get('c').image_data == '90'
+        assert cache.total_bytes == 6
+        # Items larger than the whole budget are not cached.
+        cache.put('d', photo.PhotoData('x' * 11, None))
+        assert cache.get('d') is None
+        assert cache.total_bytes == 6
+        # Expired items are dropped.
+        cache.ttl_seconds = -1
+        cache.put('a', photo.PhotoData('1234', None))
+        assert cache.get('a') is None
+        assert cache.total_bytes == 2
+
+    def test_get(self):
+        entity = model.Photo.create('haiti', image_data='xyz')
+        entity.put()
+        id = entity.key().name().split(':')[1]
+        photo.PHOTO_CACHE.clear()
+
+        ph = test_handler.initialize_handler(
+            photo.Handler, 'photo', params={'id': id})
+        ph.get()
+        assert ph.response.body == 'xyz'
+        etag = ph.response.headers['ETag']
+        assert etag
+        assert 'max-age' in ph.response.headers['Cache-Control']
+
+        # Once cached, the photo is served without touching the datastore.
+        entity.delete()
+        ph = test_handler.initialize_handler(
+            photo.Handler, 'photo', params={'id': id})
+        ph.get()
+        assert ph.response.body == 'xyz'
+
+        # A client with a current copy gets a 304 with no body.
+        ph = test_handler.initialize_handler(
+            photo.Handler, 'photo', params={'id': id},
+            environ={'HTTP_IF_NONE_MATCH': etag})
+        ph.get()
+        assert ph.response.status_int == 304
+        assert ph.response.body == ''
+
+        photo.PHOTO_CACHE.clear()
+
+    def test_delete_clears_memcache(self):
+        entity = model.Photo.create('haiti', image_data='xyz')
+        entity.put()
+        id = entity.key().name().split(':')[1]
+        person = model.Person.create_original(
+            'haiti', full_name='_full_name', photo=entity,
+            entry_date=utils.get_utcnow())
+        person.put()
+        photo.PHOTO_CACHE.clear()
+        assert photo.get_photo_data('haiti', id, 'full').image_data == 'xyz'
+        key = model.Photo.get_memcache_key('haiti', id, 'full')
+        assert memcache.get(key)
+
+        person.delete_related_entities(delete_self=True)
+        photo.PHOTO_CACHE.clear()
+        assert memcache.get(key) is None
+        assert photo.get_photo_data('haiti', id, 'full') is None
+        db.delete(model.Tombstone.all())
+
+    def test_get_photo_rendition_url(self):
+        entity = model.Photo.create('haiti', image_data='xyz')
+        entity.put()
+        url = 'http://example.appspot.com/haiti/photo?id=123'
+        person = model.Person.create_original(
+            'haiti', full_name='_full_name', photo=entity, photo_url=url,
+            entry_date=utils.get_utcnow())
+        assert person.get_photo_rendition_url('full') == url
+        assert person.photo_thumbnail_url == url + '&size=thumb'
+        assert person.photo_medium_url_no_scheme == \
+            '//example.appspot.com/haiti/photo?id=123&size=medium'
+
+        # Photos hosted elsewhere have no smaller renditions.
+        url = 'http://example.com/photo.jpg'
+        person = model.Person.create_original(
+            'haiti', full_name='_full_name', photo_url=url,
+            entry_date=utils.get_utcnow())
+        assert person.photo_thumbnail_url == url
+        entity.delete()
+
+    def test_rendition_keys(self):
+        entity = model.Photo.create('haiti', image_data='xyz')
+        keys = model.PhotoRendition.get_keys_for_photo(entity.key())
+        assert [key.name() for key in keys] == [
+            entity.key().name() + ':thumb', entity.key().name() + ':medium']
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -16,6 +16,8 @@
 
 """Tests for resources.py."""
 
+import gzip
+import StringIO
 import unittest
 
 import django.template
@@ -59,6 +61,52 @@ class RamCacheTests(unittest.TestCase):
         cache.clear()
         assert cache.get('a') is None
 
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = resources.RamCache(max_entries=2)
+        cache.put('a', 'x', 10)
+        cache.put('b', 'y', 10)
+        assert cache.get('a') == 'x'  # 'b' is now the least recently used
+        cache.put('c', 'z', 10)
+        assert cache.get('a') == 'x'
+        assert cache.get('b') is None
+        assert cache.get('c') == 'z'
+        assert cache.stats()['evictions'] == 1
+
+    def test_byte_budget(self):
+        cache = resources.RamCache(max_bytes=10)
+        cache.put('a', '12345', 10)
+        cache.put('b', '12345', 10)
+        assert cache.stats()['bytes'] == 10
+        cache.put('c', '123', 10)
+        assert cache.get('a') is None
+        assert cache.get('b') == '12345'
+        assert cache.stats()['bytes'] == 8
+
+        # A value larger than the whole budget is not cached.
+        cache.put('d', '12345678901', 10)
+        assert cache.get('d') is None
+        assert cache.get('b') == '12345'
+
+    def test_get_stale(self):
+        cache = resources.RamCache()
+        assert cache.get_stale('a') is None
+        cache.put('a', 'b', 10)
+        utils.set_utcnow_for_test(11)
+        assert cache.get('a') is None
+        assert cache.get_stale('a') == 'b'
+
+    def test_stats(self):
+        cache = resources.RamCache()
+        cache.put('a', 'b', 10)
+        cache.get('a')
+        cache.get('a')
+        cache.get('x')
+        stats = cache.stats()
+        assert stats['entries'] == 1
+        assert stats['hits'] == 2
+        assert stats['misses'] == 1
+        assert stats['evictions'] == 0
+
 
 class ResourcesTests(unittest.TestCase):
     def setUp(self):
@@ -249,59 +297,119 @@ class ResourcesTests(unittest.TestCase):
         # Expire the pages but not the base templates.
         utils.set_utcnow_for_test(31)
 
-        # Should fetch and recompile the pages but not the base templates.
+        # Should fetch the pages, but the pages haven't changed, so the
+        # previously compiled templates should be reused.
         self.fetched, self.compiled, self.rendered = [], [], []
         assert get_rendered('page.html', 'es') == u'\xa1hola! default'
         assert self.fetched == ['page.html:es', 'page.html',
                                 'page.html.template:es', 'page.html.template']
-        assert self.compiled == ['page.html.template']
+        assert self.compiled == []
         assert self.rendered == ['page.html.template']
 
-        # Should fetch and recompile the pages but not the base templates.
         self.fetched, self.compiled, self.rendered = [], [], []
         assert get_rendered('page.html', 'fr') == u'hi! fran\xe7ais'
         assert self.fetched == ['page.html:fr', 'page.html',
                                 'page.html.template:fr']
-        assert self.compiled == ['page.html.template:fr']
+        assert self.compiled == []
         assert self.rendered == ['page.html.template:fr']
 
-        # Should fetch and recompile the pages but not the base templates.
         self.fetched, self.compiled, self.rendered = [], [], []
         assert get_rendered('page.html', 'en') == u'hi! default'
         assert self.fetched == ['page.html:en', 'page.html',
                                 'page.html.template:en', 'page.html.template']
-        assert self.compiled == ['page.html.template']
+        assert self.compiled == []
         assert self.rendered == ['page.html.template']
 
         # Expire the base templates and page.html.template:fr
         # (page.html.template:en and page.html.template:es remain cached).
         utils.set_utcnow_for_test(52)
 
-        # Should fetch and recompile the base template but not the page.
+        # Should fetch the base template but not the page.
         self.fetched, self.compiled, self.rendered = [], [], []
         assert get_rendered('page.html', 'es') == u'\xa1hola! default'
         assert self.fetched == ['page.html:es', 'page.html',
                                 'base.html.template:es']
-        assert self.compiled == ['base.html.template:es']
+        assert self.compiled == []
         assert self.rendered == ['page.html.template']
 
-        # Should fetch and recompile both the fr page and the base template.
+        # Should fetch both the fr page and the base template.
         self.fetched, self.compiled, self.rendered = [], [], []
         assert get_rendered('page.html', 'fr') == u'hi! fran\xe7ais'
         assert self.fetched == ['page.html:fr', 'page.html',
                                 'page.html.template:fr',
                                 'base.html.template:fr', 'base.html.template']
-        assert self.compiled == ['page.html.template:fr', 'base.html.template']
+        assert self.compiled == []
         assert self.rendered == ['page.html.template:fr']
 
-        # Should fetch and recompile the base template but not the page.
+        # Should fetch the base template but not the page.
         self.fetched, self.compiled, self.rendered = [], [], []
         assert get_rendered('page.html', 'en') == u'hi! default'
         assert self.fetched == ['page.html:en', 'page.html',
                                 'base.html.template:en', 'base.html.template']
-        assert self.compiled == ['base.html.template']
+        assert self.compiled == []
         assert self.rendered == ['page.html.template']
 
         # Ensure binary data is preserved.
         assert get_rendered('data', 'en') == '\xff\xfe\xfd\xfc'
 
+    def test_get_localized_revalidates_expired_resources(self):
+        get_localized = resources.get_localized
+        template = get_localized('page.html.template', 'en').get_template()
+
+        # An expired resource that hasn't changed keeps its compiled template.
+        utils.set_utcnow_for_test(31)
+        self.fetched, self.compiled = [], []
+        resource = get_localized('page.html.template', 'en')
+        assert self.fetched == ['page.html.template:en', 'page.html.template']
+        assert resource.get_template() is template
+        assert self.compiled == []
+
+        # A resource that has changed is recompiled.
+        self.put_resource('1', 'page.html.template', 30, 'changed')
+        utils.set_utcnow_for_test(62)
+        self.compiled = []
+        resource = get_localized('page.html.template', 'en')
+        assert resource.content == 'changed'
+        assert resource.get_template() is not template
+        assert self.compiled == ['page.html.template']
+
+    def test_warm_up(self):
+        self.compiled = []
+        assert resources.warm_up(['es', 'fr'])
+        assert 'page.html.template' in self.compiled
+        assert 'page.html.template:fr' in self.compiled
+        assert 'base.html.template:es' in self.compiled
+
+        # Rendering should now use the templates compiled during warmup.
+        self.fetched, self.compiled = [], []
+        assert resources.get_rendered('page.html', 'es') == u'\xa1hola! default'
+        assert self.compiled == []
+
+    def test_get_rendering(self):
+        rendering = resources.get_rendering('page.html', 'fr')
+        assert rendering.content == u'hi! fran\xe7ais'
+        variant = rendering.get_variant('utf-8')
+        assert variant.data == 'hi! fran\xc3\xa7ais'
+        assert variant.etag.startswith('"') and variant.etag.endswith('"')
+        assert rendering.get_variant('utf-8') is variant  # computed once
+        assert rendering.get_variant('latin-1').data == 'hi! fran\xe7ais'
+
+        # The Rendering and its variants should be cached.
+        assert resources.get_rendering('page.html', 'fr') is rendering
+        gzipped = variant.get_gzipped()
+        assert gzip.GzipFile(fileobj=StringIO.StringIO(gzipped)).read() == (
+            variant.data)
+        assert variant.get_gzipped() is gzipped
+
+        # Plain files keep their Rendering on the cached Resource.
+        rendering = resources.get_rendering('static.html', 'fr')
+        assert rendering.content == 'bonjour'
+        assert resources.get_rendering('static.html', 'fr') is rendering
+
+    def test_get_hashed_url(self):
+        url = resources.get_hashed_url('/global', 'static.html', 'fr')
+        hash = resources.get_rendering('static.html', 'fr').get_hash()
+        assert url == '/global/static.html?lang=fr&v=' + hash
+        assert len(hash) == resources.HASH_LENGTH
+        assert resources.get_hashed_url('/global', 'xyz', 'fr') == (
+            '/global/xyz')
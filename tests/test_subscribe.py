@@ -14,12 +14,29 @@
 
 """Tests for subscribe.py."""
 
+import datetime
 import unittest
+
+from google.appengine.ext import db
+
+import config
+import model
 import subscribe
+import test_handler
+from utils import set_utcnow_for_test
 
 class SubscribeTests(unittest.TestCase):
     '''Test Subscribe.'''
 
+    def setUp(self):
+        self.to_delete = []
+
+    def tearDown(self):
+        db.delete(self.to_delete)
+        db.delete(model.PendingNotification.all())
+        config.set_for_repo('haiti', notification_digest_minutes=0)
+        set_utcnow_for_test(None)
+
     def test_is_email_valid(self):
         # These email addresses are correct
         email = 'test@example.com'
@@ -43,5 +60,108 @@ class SubscribeTests(unittest.TestCase):
         email = ''
         assert subscribe.is_email_valid(email) == None
 
+    def test_notify_subscribers(self):
+        """Verify that each status update is rendered once per language and
+        that the per-recipient links are filled in."""
+        set_utcnow_for_test(datetime.datetime(2010, 1, 1))
+        person = model.Person.create_original(
+            'haiti', given_name='John', family_name='Smith',
+            full_name='John Smith', entry_date=datetime.datetime(2010, 1, 1))
+        note = model.Note.create_original(
+            'haiti', person_record_id=person.record_id, text='Found him',
+            entry_date=datetime.datetime(2010, 1, 1))
+        subscriptions = [
+            model.Subscription.create(
+                'haiti', person.record_id, 'a@example.com', 'en'),
+            model.Subscription.create(
+                'haiti', person.record_id, 'b@example.com', 'en'),
+            model.Subscription.create(
+                'haiti', person.record_id, 'c@example.com', 'fr'),
+            model.Subscription.create(
+                'haiti', person.record_id, 'invalid', 'fr')]
+        self.to_delete = [person, note] + subscriptions
+        db.put(self.to_delete)
+
+        handler = test_handler.initialize_handler(
+            subscribe.NotifySubscribers, subscribe.NotifySubscribers.ACTION,
+            environ={'HTTP_X_APPENGINE_TASKNAME': 'task-1'},
+            params={'id': person.record_id,
+                    'note_id': note.record_id,
+                    'repo_url': 'http://example.com/haiti'})
+        rendered_languages = []
+        def render_to_string(name, language_override=None, **vars):
+            rendered_languages.append(language_override)
+            return '%s %s' % (vars['subscribed_person_url'],
+                              vars['unsubscribe_link'])
+        sent = []
+        handler.render_to_string = render_to_string
+        handler.send_mails = sent.extend
+        handler.post()
+
+        assert sorted(rendered_languages) == ['en', 'fr']
+        assert sorted(to for to, subject, body in sent) == [
+            'a@example.com', 'b@example.com', 'c@example.com']
+        for to, subject, body in sent:
+            url, link = body.split(' ')
+            assert url == 'http://example.com/haiti/view?id=' + (
+                person.record_id.replace('/', '%2F'))
+            assert link.startswith('http://example.com/haiti/unsubscribe?')
+            assert to.replace('@', '%40') in link
+
+    def test_notify_subscribers_requires_task_queue(self):
+        """Verify that users can't send notifications through the task."""
+        handler = test_handler.initialize_handler(
+            subscribe.NotifySubscribers, subscribe.NotifySubscribers.ACTION,
+            params={'id': 'test.google.com/person.1'})
+        handler.post()
+        assert handler.response.status_int == 403
+    def test_notification_digest(self):
+        """Verify that with notification_digest_minutes set, status updates
+        are held and then sent together in one message."""
+        config.set_for_repo('haiti', notification_digest_minutes=10)
+        set_utcnow_for_test(datetime.datetime(2010, 1, 1))
+        person = model.Person.create_original(
+            'haiti', given_name='John', family_name='Smith',
+            full_name='John Smith', entry_date=datetime.datetime(2010, 1, 1))
+        notes = [model.Note.create_original(
+                     'haiti', person_record_id=person.record_id, text=text,
+                     entry_date=datetime.datetime(2010, 1, 1))
+                 for text in ['first', 'second']]
+        subscription = model.Subscription.create(
+            'haiti', person.record_id, 'a@example.com', 'en')
+        self.to_delete = [person, subscription] + notes
+        db.put(self.to_delete)
+
+        def run_task(handler_class, **params):
+            handler = test_handler.initialize_handler(
+                handler_class, handler_class.ACTION,
+                environ={'HTTP_X_APPENGINE_TASKNAME': 'task-1'},
+                params=params)
+            handler.render_to_string = \
+                lambda name, language_override=None, **vars: name
+            sent = []
+            handler.send_mails = sent.extend
+            if handler_class is subscribe.NotifySubscribers:
+                handler.post()
+            else:
+                handler.get()
+            return sent
+
+        for note in notes:
+            assert run_task(subscribe.NotifySubscribers,
+                            id=person.record_id, note_id=note.record_id,
+                            repo_url='http://example.com/haiti') == []
+        assert model.PendingNotification.all().count() == 2
+
+        # Nothing is sent until the digest window has passed.
+        set_utcnow_for_test(datetime.datetime(2010, 1, 1, 0, 5))
+        assert run_task(subscribe.FlushNotifications) == []
+        set_utcnow_for_test(datetime.datetime(2010, 1, 1, 0, 11))
+        sent = run_task(subscribe.FlushNotifications)
+        assert [(to, body) for to, subject, body in sent] == [
+            ('a@example.com', 'person_status_digest_email.txt')]
+        assert model.PendingNotification.all().count() == 0
+
+
 if __name__ == '__main__':
     unittest.main()
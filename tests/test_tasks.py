@@ -26,6 +26,7 @@ import unittest
 import webob
 
 from google.appengine import runtime
+from google.appengine.api import datastore
 from google.appengine.api import users
 from google.appengine.ext import db
 from google.appengine.api import quota
@@ -34,6 +35,7 @@ from google.appengine.ext import webapp
 
 import config
 import delete
+import indexing
 import model
 import tasks
 import test_handler
@@ -377,6 +379,120 @@ class TasksTests(unittest.TestCase):
         self.mox.UnsetStubs()
         self.mox.VerifyAll()
 
+    def test_update_person_status(self):
+        update = test_handler.initialize_handler(
+            tasks.UpdatePersonStatus, tasks.UpdatePersonStatus.ACTION,
+            params={'id': self.p1.record_id})
+        update.get()
+        assert db.get(self.key_p1).latest_status == 'believed_missing'
+
+        # Hiding the only note should clear the status.
+        self.n1_1.hidden = True
+        db.put(self.n1_1)
+        update.get()
+        assert not db.get(self.key_p1).latest_status
+        # The other Person should be untouched.
+        assert db.get(self.key_p2).latest_status == ''
+
+    def test_reindex(self):
+        # Neither Person has been indexed yet, so both get rewritten.
+        reindex = self.initialize_handler(tasks.Reindex)
+        reindex.get()
+        p1 = db.get(self.key_p1)
+        assert p1.index_version == indexing.INDEX_VERSION
+        assert 'JOHN' in p1.names_prefixes
+        assert indexing.is_index_current(db.get(self.key_p2))
+        last_modified = p1.last_modified
+
+        # Change one Person so that only its index is out of date.
+        p2 = db.get(self.key_p2)
+        p2.given_name = 'Tzvi'
+        p2.put()
+
+        reindex = self.initialize_handler(tasks.Reindex)
+        reindex.get()
+        # The unchanged Person should not have been written again.
+        assert db.get(self.key_p1).last_modified == last_modified
+        p2 = db.get(self.key_p2)
+        assert 'TZVI' in p2.names_prefixes
+        assert 'TZVIKA' not in p2.names_prefixes
+        counts = model.Counter.get_all_counts('haiti', 'reindex')
+        assert counts.get('unchanged') == 1
+        assert counts.get('reindexed') == 1
+
+    def test_add_match_fingerprint(self):
+        # The Note already has a fingerprint from Note.create_original.
+        assert self.n1_1.match_fingerprint
+        self.n1_1.match_fingerprint = ''
+        db.put(self.n1_1)
+
+        add = self.initialize_handler(tasks.AddMatchFingerprint)
+        add.get()
+        note = db.get(self.n1_1.key())
+        assert note.match_fingerprint == note.get_match_fingerprint()
+        counts = model.Counter.get_all_counts('haiti', 'match-fingerprint')
+        assert counts.get('updated') == 1
+
+    def test_add_source_domain(self):
+        assert self.n1_1.source_domain == 'haiti.personfinder.google.org'
+        self.n1_1.source_domain = ''
+        db.put(self.n1_1)
+
+        add = self.initialize_handler(tasks.AddSourceDomain)
+        add.get()
+        note = db.get(self.n1_1.key())
+        assert note.source_domain == 'haiti.personfinder.google.org'
+        counts = model.Counter.get_all_counts('haiti', 'source-domain')
+        assert counts.get('updated') == 1
+
+    def test_add_note_last_modified(self):
+        # Simulate a Note stored before Note.last_modified existed.
+        entity = datastore.Get(self.n1_1.key())
+        del entity['last_modified']
+        datastore.Put(entity)
+        assert db.get(self.n1_1.key()).last_modified is None
+
+        add = self.initialize_handler(tasks.AddNoteLastModified)
+        add.get()
+        assert db.get(self.n1_1.key()).last_modified
+        counts = model.Counter.get_all_counts('haiti', 'note-last-modified')
+        assert counts.get('updated') == 1
+
+    def test_delete_old_tombstones(self):
+        tombstone = model.Tombstone.create_for_record(self.n1_1)
+        tombstone.put()
+        self.to_delete.append(tombstone)
+
+        delete_old = self.initialize_handler(tasks.DeleteOld)
+        delete_old.delete_old_tombstones()
+        assert db.get(tombstone.key())
+
+        set_utcnow_for_test(tombstone.last_modified + model.Tombstone.TTL +
+                            datetime.timedelta(days=1))
+        delete_old.delete_old_tombstones()
+        assert db.get(tombstone.key()) is None
+
+    def test_count_note_review_queues(self):
+        n1_2 = model.Note.create_original(
+            'haiti', person_record_id=self.p1.record_id, hidden=True,
+            entry_date=get_utcnow(), source_date=datetime.datetime(2010, 1, 3))
+        db.put(n1_2)
+        self.to_delete.append(n1_2)
+
+        count = self.initialize_handler(tasks.CountNote)
+        count.get()
+        counts = model.Counter.get_all_counts('haiti', 'note')
+        assert counts.get('hidden=FALSE,reviewed=FALSE') == 1
+        assert counts.get('hidden=FALSE,reviewed=TRUE') is None
+        assert counts.get('hidden=TRUE') == 1
+
+        # The scan corrects the queue sizes that api/stats reports.
+        counts = model.ReviewQueueCount.get_counts('haiti')
+        assert counts == {'hidden=TRUE': 1,
+                          'hidden=FALSE,reviewed=TRUE': 0,
+                          'hidden=FALSE,reviewed=FALSE': 1}
+        self.to_delete.extend(model.ReviewQueueCount.all())
+
     def ignore_call_to_send_delete_notice(self):
         """Replaces delete.send_delete_notice() with empty implementation."""
         self.mox.StubOutWithMock(delete, 'send_delete_notice')
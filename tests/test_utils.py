@@ -200,6 +200,69 @@ class UtilsTests(unittest.TestCase):
         assert not utils.is_ip_address_in_network('192.168.1.1', '192.168.0.1/24')
         assert not utils.is_ip_address_in_network('192.200.1.1', '192.168.0.1/24')
 
+    def test_ip_network_matcher(self):
+        matcher = utils.IpNetworkMatcher(['192.168.0.0/24', '10.0.0.0/8'])
+        assert '192.168.0.1' in matcher
+        assert '10.1.2.3' in matcher
+        assert '192.168.1.1' not in matcher
+        assert '11.0.0.1' not in matcher
+        assert '192.168.0.1' not in utils.IpNetworkMatcher([])
+
+        # Overlapping and adjacent ranges are merged.
+        matcher = utils.IpNetworkMatcher(
+            ['10.0.0.0/8', '10.1.0.0/16', '11.0.0.0/8', '192.168.0.0/24'])
+        assert matcher.starts[4] == [0x0a000000, 0xc0a80000]
+        assert matcher.ends[4] == [0x0bffffff, 0xc0a800ff]
+        assert '11.255.255.255' in matcher
+        assert '12.0.0.0' not in matcher
+
+        # Invalid networks and addresses never match.
+        matcher = utils.IpNetworkMatcher(['10.0.0.0', '10.0.0.0/40', 'x/8'])
+        assert '10.0.0.1' not in matcher
+        assert 'garbage' not in utils.IpNetworkMatcher(['10.0.0.0/8'])
+        assert None not in utils.IpNetworkMatcher(['10.0.0.0/8'])
+
+    def test_ip_network_matcher_ipv6(self):
+        matcher = utils.IpNetworkMatcher(['2001:db8::/32', '10.0.0.0/8'])
+        assert '2001:db8::1' in matcher
+        assert '2001:DB8:ffff::' in matcher
+        assert '2001:db9::' not in matcher
+        assert '::1' not in matcher
+        assert '::ffff:10.1.2.3' in matcher  # IPv4-mapped address
+
+    def test_parse_ip_address(self):
+        assert utils.parse_ip_address('127.0.0.1') == (4, 0x7f000001)
+        assert utils.parse_ip_address('::') == (6, 0)
+        assert utils.parse_ip_address('::1') == (6, 1)
+        assert utils.parse_ip_address('2001:db8::2:1') == (
+            6, 0x20010db8000000000000000000020001)
+        assert utils.parse_ip_address('::ffff:1.2.3.4') == (4, 0x01020304)
+        for ip in ['', 'x', '1::2::3', '1:2:3:4:5:6:7:8:9', '12345::']:
+            self.assertRaises(ValueError, utils.parse_ip_address, ip)
+
+    def test_get_ip_network_matcher(self):
+        matcher = utils.get_ip_network_matcher(['10.0.0.0/8'])
+        assert utils.get_ip_network_matcher(['10.0.0.0/8']) is matcher
+        assert utils.get_ip_network_matcher(['10.0.0.0/16']) is not matcher
+
+
+class ParamsTests(unittest.TestCase):
+    def test_params(self):
+        calls = []
+        def validate(string):
+            calls.append(string)
+            return 'default'
+        params = utils.Params({'a': validate, 'b': utils.strip})
+        params.b = 'x'
+        assert calls == []
+        assert params.a == 'default'
+        assert params.get('a') == 'default'
+        assert calls == ['']  # the default value is computed only once
+        assert params.get('b') == 'x'
+        assert params.get('c', 3) == 3
+        self.assertRaises(AttributeError, getattr, params, 'c')
+        assert sorted(params.items()) == [('a', 'default'), ('b', 'x')]
+
 
 class HandlerTests(unittest.TestCase):
     """Tests for the base handler implementation."""
@@ -211,11 +274,11 @@ class HandlerTests(unittest.TestCase):
             repo_titles={'en': 'Haiti Earthquake'},
             language_menu_options=['en', 'ht', 'fr', 'es'],
             referrer_whitelist=[])
-        self.original_get_rendered = resources.get_rendered
+        self.original_get_rendering = resources.get_rendering
 
     def tearDown(self):
         db.delete(config.ConfigEntry.all())
-        resources.get_rendered = self.original_get_rendered
+        resources.get_rendering = self.original_get_rendering
 
     def handler_for_url(self, url):
         request = webapp.Request(webapp.Request.blank(url).environ)
@@ -236,6 +299,20 @@ class HandlerTests(unittest.TestCase):
         assert handler.params.author_made_contact == 'yes'
         assert handler.params.role == 'provide'
 
+    def test_absent_parameters_get_defaults(self):
+        _, _, handler = self.handler_for_url('/haiti/start?given_name=John')
+        assert handler.params.given_name == 'John'
+        assert 'family_name' not in handler.params.__dict__  # not computed
+        assert handler.params.family_name == ''
+        assert handler.params.get('role') == 'seek'
+        assert handler.params.version.version == pfif.PFIF_DEFAULT_VERSION
+
+    def test_invalid_parameter(self):
+        _, response, handler = self.handler_for_url(
+            '/haiti/start?version=9.9')
+        assert response.status_int == 400
+        assert 'Invalid parameter version' in response.body
+
     def test_whitelisted_referrer(self):
         config.set_for_repo('haiti', referrer_whitelist=['a.org'])
         _, _, handler = self.handler_for_url(
@@ -267,7 +344,7 @@ class HandlerTests(unittest.TestCase):
 
     def test_error_message(self):
         """Regression test for an XSS vulnerability."""
-        resources.get_rendered = lambda: 1/0  # force error template to fail
+        resources.get_rendering = lambda: 1/0  # force error template to fail
 
         request, response, handler = self.handler_for_url('/?lang=<script>&')
         assert 'Invalid language tag' in response.body
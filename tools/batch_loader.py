@@ -0,0 +1,105 @@
+#!/usr/bin/python2.7
+# Copyright 2014 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Loads a stream of records in batches on a pool of threads, for the
+command-line tools that write to the datastore over remote_api."""
+
+import itertools
+import logging
+import multiprocessing.pool
+import os
+import time
+
+
+class BatchLoader:
+    """Calls load_batch on batches of records from a stream, several batches
+    at a time.  A batch that raises an exception is retried, waiting longer
+    after each attempt.  After each round of batches, the number of records
+    loaded so far is saved in the checkpoint file, so that running the same
+    load again starts after those records."""
+
+    def __init__(self, load_batch, batch_size=100, threads=4,
+                 checkpoint_path=None, max_attempts=5, backoff_seconds=1):
+        self.load_batch = load_batch
+        self.batch_size = batch_size
+        self.threads = threads
+        self.checkpoint_path = checkpoint_path
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+
+    def read_checkpoint(self):
+        """Gets the number of records loaded by an earlier, unfinished run."""
+        if self.checkpoint_path and os.path.exists(self.checkpoint_path):
+            return int(open(self.checkpoint_path).read())
+        return 0
+
+    def write_checkpoint(self, count):
+        if self.checkpoint_path:
+            # Write a new file and rename it, so a checkpoint is never partial.
+            file = open(self.checkpoint_path + '.new', 'w')
+            file.write('%d\n' % count)
+            file.close()
+            os.rename(self.checkpoint_path + '.new', self.checkpoint_path)
+
+    def load_with_retry(self, batch):
+        for attempt in range(self.max_attempts):
+            try:
+                return self.load_batch(batch)
+            except Exception, e:
+                if attempt + 1 == self.max_attempts:
+                    raise
+                delay = self.backoff_seconds * 2**attempt
+                logging.warn('Retrying batch in %d s: %s', delay, e)
+                time.sleep(delay)
+
+    def get_batches(self, records, count):
+        """Takes up to 'count' batches from an iterator of records."""
+        batches = []
+        for i in range(count):
+            batch = list(itertools.islice(records, self.batch_size))
+            if not batch:
+                break
+            batches.append(batch)
+        return batches
+
+    def run(self, records):
+        """Loads all the records from an iterable, skipping the ones loaded
+        by an earlier run.  Returns the total number of records loaded."""
+        done = self.read_checkpoint()
+        if done:
+            logging.info('Resuming after %d records', done)
+        records = itertools.islice(records, done, None)
+        start_time = time.time()
+        loaded = 0
+        pool = multiprocessing.pool.ThreadPool(self.threads)
+        try:
+            while True:
+                # Read only as many batches as the threads can work on, so
+                # that the records are never all in memory at once.
+                batches = self.get_batches(records, self.threads)
+                if not batches:
+                    break
+                pool.map(self.load_with_retry, batches)
+                count = sum(len(batch) for batch in batches)
+                loaded += count
+                done += count
+                self.write_checkpoint(done)
+                logging.info('Loaded %d records (%.1f records/s)', done,
+                             loaded/max(time.time() - start_time, 1e-6))
+        finally:
+            pool.terminate()
+        if self.checkpoint_path and os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+        return done
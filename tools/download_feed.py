@@ -18,10 +18,16 @@
 __author__ = 'kpy@google.com (Ka-Ping Yee)'
 
 import csv
+import datetime
+import httplib
+import multiprocessing.pool
 import optparse
 import os
 import re
+import StringIO
 import sys
+import tempfile
+import threading
 import time
 
 # This script is in a tools directory below the root project directory.
@@ -32,11 +38,21 @@ APP_DIR = os.path.join(PROJECT_DIR, 'app')
 sys.path.append(APP_DIR)
 
 import pfif
+import simplejson
 import urllib
 import urlparse
 
 PFIF = pfif.PFIF_VERSIONS[pfif.PFIF_DEFAULT_VERSION]
 
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+PAGE_SIZE = 200  # number of records to request at a time
+MAX_ATTEMPTS = 5  # number of times to try each request
+TIMEOUT_SECONDS = 60
+CONNECTION_CLASSES = {
+    'http': httplib.HTTPConnection,
+    'https': httplib.HTTPSConnection
+}
+
 quiet_mode = False
 
 
@@ -138,23 +154,87 @@ def download_file(type, parser, writer, url, key=None):
     log('Fetched %d %s record%s (%.1f rec/s).\n' %
         (len(records), type, ['s', ''][len(records) == 1], speed))
 
-def download_since(type, parser, writer, url, min_entry_date, key=None):
-    """Fetches and writes batches of records repeatedly until all records
-    with an entry_date >= min_entry_date are retrieved."""
-    start_time = time.time()
+def split_date_range(min_entry_date, max_entry_date, count):
+    """Splits the entry_dates from min_entry_date to max_entry_date into at
+    most 'count' segments of equal length.  Returns a list of (start, end)
+    pairs of date strings.  The end of the last segment is None, so that it
+    also covers any records entered after max_entry_date."""
+    min_date = datetime.datetime.strptime(min_entry_date, DATE_FORMAT)
+    max_date = datetime.datetime.strptime(max_entry_date, DATE_FORMAT)
+    seconds = max(int((max_date - min_date).total_seconds()), 1)
+    count = max(1, min(count, seconds))
+    starts = [(min_date + datetime.timedelta(seconds=seconds*i//count)
+              ).strftime(DATE_FORMAT) for i in range(count)]
+    return zip(starts, starts[1:] + [None])
+
+class FeedFetcher:
+    """Fetches batches of records from a feed on an HTTP server.  Each thread
+    keeps its own connection open, so that successive requests from the same
+    thread reuse it."""
+
+    def __init__(self, parser, url):
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+        if scheme not in CONNECTION_CLASSES:
+            raise ValueError('Not an HTTP or HTTPS URL: %r' % url)
+        self.parser = parser
+        self.connection_class = CONNECTION_CLASSES[scheme]
+        self.netloc = netloc
+        self.path = path
+        self.query = query
+        self.local = threading.local()
+
+    def get_connection(self):
+        if not getattr(self.local, 'connection', None):
+            self.local.connection = self.connection_class(
+                self.netloc, timeout=TIMEOUT_SECONDS)
+        return self.local.connection
+
+    def close(self):
+        """Closes the connection for the current thread, if any."""
+        if getattr(self.local, 'connection', None):
+            self.local.connection.close()
+            self.local.connection = None
+
+    def fetch(self, **params):
+        """Fetches and parses one batch of records."""
+        query = urllib.urlencode(dict((k, v) for k, v in params.items() if v))
+        path = self.path + '?' + '&'.join(filter(None, [self.query, query]))
+        for attempt in range(MAX_ATTEMPTS):
+            try:
+                connection = self.get_connection()
+                connection.request('GET', path)
+                response = connection.getresponse()
+                content = response.read()
+                if response.status != 200:
+                    raise RuntimeError('HTTP status %d' % response.status)
+                return self.parser.parse_file(StringIO.StringIO(content))
+            except Exception, e:
+                # Start over with a fresh connection, after a short wait.
+                self.close()
+                time.sleep(attempt)
+        raise RuntimeError('Failed to fetch %r after %d attempts: %s' %
+                           (path, MAX_ATTEMPTS, e))
+
+def download_segment(type, fetcher, start, end, path, key=None):
+    """Fetches all the records with start <= entry_date < end (no upper limit
+    if end is None) into a checkpoint file, one JSON record per line.  The
+    file is only put at 'path' once it is complete; if it is already there,
+    the segment is not fetched again.  Returns the number of records."""
+    if os.path.exists(path):
+        return len(open(path).readlines())
+    file = open(path + '.partial', 'w')
     total = skip = 0
+    min_entry_date = start
     last_min_entry_date = None
     while True:
-        log('%s records with entry_date >= %s: ' %
-            (type.capitalize(), min_entry_date))
-        records = fetch_records(parser, url, key=key, max_results=200,
+        records = fetcher.fetch(key=key, max_results=PAGE_SIZE,
                                 min_entry_date=min_entry_date, skip=skip)
-        if not records:
+        in_segment = [r for r in records if not end or r['entry_date'] < end]
+        for record in in_segment:
+            file.write(simplejson.dumps(record) + '\n')
+        total += len(in_segment)
+        if not records or len(in_segment) < len(records):
             break
-        writer.write(records)
-        total += len(records)
-        speed = total/float(time.time() - start_time)
-        log('%d (total %d, %.1f rec/s).\n' % (len(records), total, speed))
         min_entry_date = max(r['entry_date'] for r in records)
         next_skip = len([r for r in records if r['entry_date'] == min_entry_date])
         if min_entry_date == last_min_entry_date:
@@ -162,6 +242,85 @@ def download_since(type, parser, writer, url, min_entry_date, key=None):
         else:
           last_min_entry_date = min_entry_date
           skip = next_skip
+    file.close()
+    os.rename(path + '.partial', path)
+    log('%s records with %s <= entry_date < %s: %d.\n' %
+        (type.capitalize(), start, end or 'now', total))
+    return total
+
+def read_segment(path):
+    """Yields the records in a checkpoint file written by download_segment."""
+    for line in open(path):
+        yield simplejson.loads(line)
+
+def get_segments(checkpoint_dir, url, type, min_entry_date, max_entry_date,
+                 count):
+    """Gets the list of (start, end) segments for a download.  The list is
+    saved in the checkpoint directory, so that a resumed download uses the
+    same segments and the checkpoint files for them remain valid."""
+    manifest_path = os.path.join(checkpoint_dir, 'segments.json')
+    if os.path.exists(manifest_path):
+        manifest = simplejson.load(open(manifest_path))
+        if (manifest['url'], manifest['type']) != (url, type):
+            raise RuntimeError('%s contains checkpoints for another download; '
+                               'remove it or specify --checkpoint_dir' %
+                               checkpoint_dir)
+        return [tuple(segment) for segment in manifest['segments']]
+    segments = split_date_range(min_entry_date, max_entry_date, count)
+    simplejson.dump({'url': url, 'type': type, 'segments': segments},
+                    open(manifest_path, 'w'))
+    return segments
+
+def remove_checkpoints(checkpoint_dir, paths):
+    """Removes the files that a download created in checkpoint_dir, and
+    then the directory itself if nothing else is in it."""
+    for path in [os.path.join(checkpoint_dir, 'segments.json')] + paths:
+        for name in [path, path + '.partial']:
+            if os.path.exists(name):
+                os.remove(name)
+    if not os.listdir(checkpoint_dir):
+        os.rmdir(checkpoint_dir)
+
+def download_since(type, parser, writer, url, min_entry_date, key=None,
+                   max_entry_date=None, segments=1, threads=1,
+                   checkpoint_dir=None):
+    """Fetches and writes all the records with an entry_date >= min_entry_date.
+    The range up to max_entry_date (default: now) is split into segments that
+    a pool of threads fetches in parallel, each into a checkpoint file in
+    checkpoint_dir.  Segments are written out in order as they complete.  If
+    the download fails, running it again with the same checkpoint_dir skips
+    the segments that were already fetched."""
+    max_entry_date = max_entry_date or \
+        datetime.datetime.utcnow().strftime(DATE_FORMAT)
+    if not checkpoint_dir:
+        checkpoint_dir = tempfile.mkdtemp()
+    elif not os.path.isdir(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+    segments = get_segments(checkpoint_dir, url, type, min_entry_date,
+                            max_entry_date, segments)
+    paths = [os.path.join(checkpoint_dir, 'segment-%04d.json' % i)
+             for i in range(len(segments))]
+    fetcher = FeedFetcher(parser, url)
+
+    def download(index):
+        start, end = segments[index]
+        return index, download_segment(
+            type, fetcher, start, end, paths[index], key)
+
+    start_time = time.time()
+    total = 0
+    pool = multiprocessing.pool.ThreadPool(threads)
+    try:
+        # imap yields the results in order, as soon as each one is ready.
+        for index, count in pool.imap(download, range(len(segments))):
+            writer.write(read_segment(paths[index]))
+            total += count
+            speed = total/float(time.time() - start_time)
+            log('Wrote segment %d of %d: %d (total %d, %.1f rec/s).\n' %
+                (index + 1, len(segments), count, total, speed))
+    finally:
+        pool.terminate()
+    remove_checkpoints(checkpoint_dir, paths)
     log('Done.\n')
 
 def main(*args):
@@ -171,7 +330,11 @@ Downloads the records in a PFIF Person or Note feed into an XML or CSV file.
 By default, fetches the specified <feed_url> once and saves only the Person
 records in it.  Specify --notes to get the Note records.  If you specify the
 --min_entry_date option, this will make multiple fetches as necessary to
-retrieve all the records with an entry_date >= min_entry_date.  Examples:
+retrieve all the records with an entry_date >= min_entry_date.  To go faster,
+the range of entry_dates is split into --segments that are fetched by
+--threads in parallel.  Each segment is saved in --checkpoint_dir as soon as
+it is complete, so an interrupted download can be resumed by running the same
+command again.  Examples:
 
   # Make one request for recent Person records in the 'test-nokey' repository
   # and print the XML to stdout.  (This gets the last 200 entered records.)
@@ -209,6 +372,16 @@ look like https://www.google.org/personfinder/<repo>/feeds/person?key=<key>.
                            'download all records with entry_date >= this date '
                            '(UTC, in yyyy-mm-dd or yyyy-mm-ddThh:mm:ss format)')
     parser.add_option('-k', '--key', help='for Person Finder only: API key')
+    parser.add_option('-s', '--segments', type='int', default=16,
+                      help='with --min_entry_date: number of entry_date '
+                           'ranges to split the download into (default: 16)')
+    parser.add_option('-t', '--threads', type='int', default=4,
+                      help='with --min_entry_date: number of segments to '
+                           'fetch at the same time (default: 4)')
+    parser.add_option('-c', '--checkpoint_dir',
+                      help='with --min_entry_date: directory for the finished '
+                           'segments (default: the --out filename with '
+                           '".segments" appended, or a temporary directory)')
     options, args = parser.parse_args(list(args))
 
     # Get the feed URL.
@@ -265,8 +438,12 @@ look like https://www.google.org/personfinder/<repo>/feeds/person?key=<key>.
     writer = writers[format][type](file, fields=fields)
 
     if min_entry_date:
+        checkpoint_dir = options.checkpoint_dir or (
+            options.out and options.out + '.segments')
         download_since(type, parser, writer, feed_url, min_entry_date,
-                       options.key)
+                       options.key, segments=options.segments,
+                       threads=options.threads,
+                       checkpoint_dir=checkpoint_dir)
     else:
         download_file(type, parser, writer, feed_url, options.key)
     writer.close()
@@ -13,39 +13,76 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""Unix command-line utility: import CSV files into the datastore."""
+"""Unix command-line utility: import CSV files into the datastore.
+
+The person rows are imported in batches on several threads at once.  If the
+import is interrupted, running the same command again resumes where it left
+off.
+"""
 
 import remote_api
 
 import csv
 import importer
-import sys
+import optparse
+import threading
+
+from batch_loader import BatchLoader
 
 SHOW_ERRORS = 5
 
-def import_from_file(host, repo, kind, converter, filename):
+def import_from_file(host, repo, source_domain, kind, converter, filename,
+                     batch_size=importer.MAX_PUT_BATCH, threads=4):
     print '%s: importing %s records from %s' % (host, kind, filename)
-    written, skipped, total = importer.import_records(
-        repo, source_domain, converter,
-        importer.utf8_decoder(csv.DictReader(open(filename))))
-    for error, record in skipped[:SHOW_ERRORS]:
+    lock = threading.Lock()
+    counts = {'written': 0, 'skipped': 0, 'total': 0, 'unchanged': 0}
+    errors = []
+
+    def import_batch(records):
+        written, skipped, total, unchanged = importer.import_records(
+            repo, source_domain, converter, records)
+        with lock:
+            counts['written'] += written
+            counts['skipped'] += len(skipped)
+            counts['total'] += total
+            counts['unchanged'] += unchanged
+            errors.extend(skipped[:SHOW_ERRORS - len(errors)])
+
+    loader = BatchLoader(import_batch, batch_size, threads,
+                         checkpoint_path=filename + '.checkpoint')
+    loader.run(importer.utf8_decoder(csv.DictReader(open(filename))))
+    for error, record in errors:
         print '    - %s: %r' % (error, record)
-    if len(skipped) > SHOW_ERRORS:
+    if counts['skipped'] > len(errors):
         print '    (more errors not shown)'
 
-    print 'wrote %d of %d (skipped %d with errors)' % (
-        written, total, len(skipped))
+    print 'wrote %d of %d (skipped %d with errors, %d unchanged)' % (
+        counts['written'], counts['total'], counts['skipped'],
+        counts['unchanged'])
 
 if __name__ == '__main__':
-    if len(sys.argv) < 6:
-        raise SystemExit(
-            'Usage: %s host repo source_domain person.csv note.csv'
-            % sys.argv[0])
-    host, repo, source_domain, person_file, note_file = sys.argv[1:]
+    parser = optparse.OptionParser(
+        usage='%prog [options] host repo source_domain person.csv note.csv')
+    parser.add_option('--batch_size', type='int',
+                      default=importer.MAX_PUT_BATCH,
+                      help='number of rows to import at a time')
+    parser.add_option('--threads', type='int', default=4,
+                      help='number of batches of persons to import at the '
+                           'same time (notes are imported one batch at a '
+                           'time)')
+    options, args = parser.parse_args()
+    if len(args) != 5:
+        parser.error('Wrong number of arguments')
+    host, repo, source_domain, person_file, note_file = args
     host = remote_api.connect(host)
     if person_file:
         import_from_file(
-            host, repo, 'Person', importer.create_person, person_file)
+            host, repo, source_domain, 'Person', importer.create_person,
+            person_file, options.batch_size, options.threads)
     if note_file:
+        # Importing a Note reads, updates, and writes its Person outside of a
+        # transaction, so two batches with Notes on the same Person must not
+        # run at the same time.  Note files are imported on one thread.
         import_from_file(
-            host, repo, 'Note', importer.create_note, note_file)
+            host, repo, source_domain, 'Note', importer.create_note,
+            note_file, options.batch_size, 1)
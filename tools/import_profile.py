@@ -0,0 +1,112 @@
+#!/usr/bin/python2.7
+# Copyright 2014 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures how long a new instance takes to import main.py and the module
+for each handler, to find the modules that slow down cold starts.
+
+Usage:
+    From the personfinder root directory:
+    tools/import_profile [options] [action ...]
+
+With no actions given, every action in main.HANDLER_CLASSES is profiled.
+Each measurement runs in a fresh Python process, so nothing is preloaded.
+"""
+
+import __builtin__
+import optparse
+import subprocess
+import sys
+import time
+
+import simplejson
+
+
+def profile_import(module_names):
+    """Imports the given modules in a fresh Python process.  Returns the total
+    time taken in seconds and a list of (seconds, module_name) pairs, one for
+    each module loaded along the way, sorted with the slowest first.  The time
+    for each module excludes the time spent importing other modules."""
+    output = subprocess.check_output(
+        [sys.executable, __file__, '--child'] + list(module_names))
+    result = simplejson.loads(output)
+    return result['seconds'], sorted(
+        [(seconds, name) for seconds, name in result['modules']], reverse=True)
+
+
+def run_child(module_names):
+    """Imports the given modules, timing each import, and prints the results
+    as JSON for profile_import to read."""
+    timings = []
+    nested_times = [0]  # time spent in nested imports at each level
+    original_import = __builtin__.__import__
+
+    def timed_import(name, *args, **kwargs):
+        already_loaded = name in sys.modules
+        nested_times.append(0)
+        start = time.time()
+        try:
+            return original_import(name, *args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            nested_time = nested_times.pop()
+            nested_times[-1] += elapsed
+            if not already_loaded and name in sys.modules:
+                timings.append((elapsed - nested_time, name))
+
+    __builtin__.__import__ = timed_import
+    start = time.time()
+    try:
+        for module_name in module_names:
+            __import__(module_name)
+    finally:
+        __builtin__.__import__ = original_import
+    print simplejson.dumps(
+        {'seconds': time.time() - start, 'modules': timings})
+
+
+def get_handler_module(action):
+    """Gets the name of the module that contains the handler for an action."""
+    import main
+    return main.HANDLER_CLASSES[action].split('.')[0]
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] [action ...]')
+    parser.add_option('--top', type='int', default=0,
+                      help='list the N slowest modules for each measurement')
+    options, actions = parser.parse_args()
+    if not actions:
+        import main
+        actions = sorted(main.HANDLER_CLASSES)
+
+    base_seconds, base_modules = profile_import(['main'])
+    print '%-32s %7.3f s' % ('(main)', base_seconds)
+    for seconds, name in base_modules[:options.top]:
+        print '    %-28s %7.3f s' % (name, seconds)
+
+    for action in actions:
+        module_name = get_handler_module(action)
+        seconds, modules = profile_import(['main', module_name])
+        print '%-32s %7.3f s  (+%.3f s for %s)' % (
+            action or '(root)', seconds, seconds - base_seconds, module_name)
+        for seconds, name in modules[:options.top]:
+            print '    %-28s %7.3f s' % (name, seconds)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--child']:
+        run_child(sys.argv[2:])
+    else:
+        main()
@@ -21,8 +21,11 @@ for instructions.
 
 Once that's done, with the server running, do
 
-$ tools/site_export_importer.py path/to/export_file.zip
+$ tools/site_export_importer.py --repo=haiti path/to/export_file.zip
 
+Records are read from the file as it is parsed and stored in batches on
+several threads at once.  If the import is interrupted, running the same
+command again resumes after the last records that were stored.
 """
 
 # import this first to ensure to add necessary paths to find other project
@@ -34,10 +37,10 @@ import logging
 import optparse
 import pfif
 import sys
-import StringIO
 import zipfile
 
 # personfinder modules
+from batch_loader import BatchLoader
 from model import *
 import importer
 
@@ -49,19 +52,8 @@ def open_file_inside_zip(zip_path):
         raise IOError('zip archive had %d entries (expected 1)' % entry_count)
     zip_entry = export_zip.infolist()[0]
     logging.info('Reading from zip entry: %s', zip_entry.filename)
-    return StringIO.StringIO(export_zip.read(zip_entry.filename))
-
-
-def next_n(a_list, batch_size):
-    """Generator that yields the next batch_size items from a_list."""
-    batch = []
-    for item in a_list:
-        batch.append(item)
-        if len(batch) == batch_size:
-            yield batch
-            batch = []
-    if batch:
-        yield batch
+    # Decompress as the file is read, rather than all at once.
+    return export_zip.open(zip_entry)
 
 
 def maybe_add_required_keys(a_dict, required_keys, dummy_value=u'?'):
@@ -74,30 +66,24 @@ def maybe_add_required_keys(a_dict, required_keys, dummy_value=u'?'):
     return a_dict
 
 
-def create_person(person_dict):
-    # TODO(kpy): Pass a subdomain argument to importer.create_person.
+def create_person(repo, person_dict):
     try:
-        return importer.create_person(person_dict)
+        return importer.create_person(repo, person_dict)
     except AssertionError:
         pass
     try:
         person_dict = maybe_add_required_keys(
             person_dict, (u'given_name', u'family_name'))
-        return importer.create_person(person_dict)
+        return importer.create_person(repo, person_dict)
     except AssertionError:
         logging.info(
             'skipping person %s as it cannot be made valid', person_dict)
         return None
 
 
-def create_note(note_dict):
-    # TODO(kpy): Pass a subdomain argument to importer.create_note.
-    try:
-        return importer.create_note(note_dict)
-    except AssertionError:
-        pass
+def create_note(repo, note_dict):
     try:
-        return importer.create_note(note_dict, requires_key=False)
+        return importer.create_note(repo, note_dict)
     except AssertionError:
         logging.info(
             'skipping note %s as it cannot be made valid', note_dict)
@@ -109,59 +95,61 @@ def maybe_update_index(entity):
           entity.update_index(['old', 'new'])
 
 
-def add_entities(entity_dicts, create_function, batch_size, kind, store_all):
-    """Adds the data in entity_dicts to storage as entities created by
-    calling create_function.  Uses next_n to group the entity_dicts into
-    batches that get stored using model.db.put(...), after being converted
-    into entities using create_function.
-
-    Args:
-        entity_dicts: an iterable of dictionaries containing data to be stored
-        create_function: a function that converts a dictionary to a new entity
-        batch_size: size of the batches used to write the entities to storage
-        kind: the text name of the entities for logging
-    """
-    batch_count = (len(entity_dicts) + batch_size - 1)/batch_size
-    for i, batch in enumerate(next_n(entity_dicts, batch_size)):
-        entities = [create_function(d) for d in batch]
-        entities = [e for e in entities if e]
-        for e in entities:
-            maybe_update_index(e)
-        db.put(entities)
-        if i % 10 == 0 or i == batch_count - 1:
-            logging.info('%s update: just added batch %d/%d', kind, i + 1,
-                         batch_count)
-
-def import_site_export(export_path, remote_api_host,
-                       app_id, batch_size, store_all):
-    # Log in, then use the pfif parser to parse the export file.  Use the
+CREATE_FUNCTIONS = {'person': create_person, 'note': create_note}
+
+
+def add_entities(repo, records):
+    """Converts a batch of ('person', dict) or ('note', dict) pairs to
+    entities and stores them with model.db.put(...)."""
+    entities = []
+    for kind, entity_dict in records:
+        entity = CREATE_FUNCTIONS[kind](repo, entity_dict)
+        if entity:
+            maybe_update_index(entity)
+            entities.append(entity)
+    db.put(entities)
+
+
+def is_clone_record(repo, record):
+    kind, entity_dict = record
+    return is_clone(repo, entity_dict.get(kind + '_record_id'))
+
+
+def import_site_export(export_path, remote_api_host, repo, batch_size,
+                       store_all, threads):
+    # Log in, then use the pfif parser to read the export file.  Use the
     # importer methods to convert the dicts to entities then add them as in
     # import.py, but less strict, to ensure that all exported data is available.
-    remote_api.connect(remote_api_host, app_id)
-    logging.info('%s: importing exported records from %s',
-                 remote_api_host, export_path)
+    remote_api.connect(remote_api_host)
+    logging.info('%s: importing exported records from %s into %s',
+                 remote_api_host, export_path, repo)
     if not export_path.endswith('.zip'):
         export_fd = open(export_path)
     else:
         export_fd = open_file_inside_zip(export_path)
-    persons, notes = pfif.parse_file(export_fd)
-    logging.info('loaded %d persons, %d notes', len(persons), len(notes))
+    records = pfif.generate_records(export_fd)
     if not store_all:
-        persons = [d for d in persons if is_clone(d.get('person_record_id'))]
-        notes = [d for d in notes if is_clone(d.get('note_record_id'))]
-        logging.info(
-            '... down to %d persons, %d notes after excluding %r records',
-            len(persons), len(notes), HOME_DOMAIN)
-    logging.info('... adding persons')
-    add_entities(persons, create_person, batch_size, 'person', store_all)
-    logging.info('... adding notes')
-    add_entities(notes, create_note, batch_size, 'note', store_all)
+        logging.info('... excluding %r records', HOME_DOMAIN)
+        records = (record for record in records
+                   if is_clone_record(repo, record))
+    loader = BatchLoader(lambda batch: add_entities(repo, batch),
+                         batch_size, threads,
+                         checkpoint_path=export_path + '.checkpoint')
+    count = loader.run(records)
+    logging.info('... added %d persons and notes', count)
 
 def parse_command_line():
     parser = optparse.OptionParser()
     parser.add_option('--import_batch_size',
+                      type='int',
                       default=100,
                       help='size of batches used during data import')
+    parser.add_option('--threads',
+                      type='int',
+                      default=4,
+                      help='number of batches to store at the same time')
+    parser.add_option('--repo',
+                      help='repository to import the records into (Required)')
     parser.add_option('--store_home_domain_records',
                       action='store_true',
                       dest='store_all',
@@ -174,12 +162,11 @@ def parse_command_line():
                         default='localhost:8080',
                         help='HOST endpoint to post to for importing data. '
                              '(Required)')
-    parser.add_option('--app_id',
-                        help='Application ID of endpoint (Optional for '
-                             '*.appspot.com)')
     options, args = parser.parse_args()
     if len(args) != 1:
         parser.error('One argument required - the path to the export file')
+    if not options.repo:
+        parser.error('--repo is required')
     return options, args
 
 ARE_YOU_SURE = ('You have specified --store_home_domain_records:\n'
@@ -196,8 +183,8 @@ def main():
             logging.info("... exiting")
             sys.exit(0)
     import_site_export(
-        export_path, options.host, options.app_id,
-        options.import_batch_size, options.store_all)
+        export_path, options.host, options.repo,
+        options.import_batch_size, options.store_all, options.threads)
 
 
 if __name__ == '__main__':
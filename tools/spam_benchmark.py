@@ -0,0 +1,77 @@
+#!/usr/bin/python2.7
+# Copyright 2014 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures how fast detect_spam compiles a bad word list and scores notes,
+using randomly generated words and notes.
+
+Usage:
+    From the personfinder root directory:
+    tools/spam_benchmark [--bad_words=N] [--notes=N] [--note_words=N]
+"""
+
+import optparse
+import random
+import time
+
+import detect_spam
+
+
+def make_word(rng):
+    """Makes up a random lowercase word."""
+    return ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz')
+                   for i in range(rng.randint(2, 10)))
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--bad_words', type='int', default=1000,
+                      help='number of bad words and phrases')
+    parser.add_option('--notes', type='int', default=10000,
+                      help='number of notes to score')
+    parser.add_option('--note_words', type='int', default=50,
+                      help='number of words in each note')
+    parser.add_option('--seed', type='int', default=0,
+                      help='seed for the random number generator')
+    options, args = parser.parse_args()
+
+    rng = random.Random(options.seed)
+    vocabulary = [make_word(rng) for i in range(5000)]
+    # About one in five bad words is a two-word phrase.
+    bad_words = ', '.join(
+        ' '.join(rng.sample(vocabulary, rng.random() < 0.2 and 2 or 1))
+        for i in range(options.bad_words))
+    texts = [' '.join(rng.choice(vocabulary)
+                      for j in range(options.note_words))
+             for i in range(options.notes)]
+
+    start = time.time()
+    detector = detect_spam.SpamDetector(bad_words)
+    compile_seconds = time.time() - start
+    print 'Compiled %d bad words into %d states in %.3f s' % (
+        len(detector.bad_words_set), len(detector.matcher.transitions),
+        compile_seconds)
+
+    start = time.time()
+    scores = detector.estimate_spam_scores(texts)
+    score_seconds = time.time() - start
+    print 'Scored %d notes of %d words in %.3f s (%.0f notes/s)' % (
+        len(texts), options.note_words, score_seconds,
+        len(texts)/max(score_seconds, 1e-6))
+    print '%d notes contained bad words' % len(
+        [score for score in scores if score > 0])
+
+
+if __name__ == '__main__':
+    main()